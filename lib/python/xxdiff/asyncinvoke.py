@@ -0,0 +1,157 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+Coroutine versions of the functions to invoke xxdiff, for use with asyncio.
+
+These run xxdiff as asyncio subprocesses, so that a script can have several
+viewers open while it fetches or transforms other files on the same event loop,
+without threads.  Instead of the 'nowait' waiter objects of xxdiff.invoke, an
+asyncio.Event can be passed as 'processed': xxdiff is then asked to indicate
+when it has read its input files and the event is set at that point, e.g. to
+delete temporary input files early.  The output of xxdiff is read by a single
+reader, so the indication cannot race with the results.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+# stdlib imports.
+import asyncio, locale
+from asyncio.subprocess import PIPE
+
+# xxdiff imports.
+from xxdiff.invoke import _decision_command, _decision_result
+from xxdiff.invoke import _display_command, _display_result
+
+
+async def xxdiff_decision(opts, *arguments, stdin=None, processed=None):
+    """
+    Run xxdiff in decision mode with the given arguments and return the decision
+    code, the temporary file containing merged output, and xxdiff's return
+    code, like xxdiff.invoke.xxdiff_decision().  'stdin' can be text or an open
+    file to pass to xxdiff, and 'processed' an asyncio.Event to set when xxdiff
+    has read its input (or has exited).
+    """
+    cmd, mergedf = _decision_command(opts, arguments, processed is not None)
+    returncode, stdout, stderr = await _run_xxdiff(cmd, opts, stdin, processed)
+    return _decision_result(cmd, returncode, stdout, stderr, mergedf)
+
+
+async def xxdiff_display(opts, *arguments, stdin=None, processed=None):
+    """
+    Run xxdiff with the given arguments, not in decision mode, and return its
+    return code, like xxdiff.invoke.xxdiff_display().  'stdin' and 'processed'
+    are as for xxdiff_decision().
+    """
+    if '--decision' in arguments:
+        raise RuntimeError("Internal error: use xxdiff_decision() "
+                           "instead of xxdiff_display() if you want a user "
+                           "return code.")
+
+    cmd = _display_command(opts, arguments, processed is not None)
+    returncode, stdout, stderr = await _run_xxdiff(cmd, opts, stdin, processed)
+    return _display_result(cmd, returncode, stderr)
+
+
+async def _run_xxdiff(cmd, opts, stdin, processed):
+    """
+    Run the given xxdiff command to completion, setting the 'processed' event
+    if given when xxdiff indicates it has read its input.  Return its return
+    code, and its standard output (without the indication) and error as text.
+    """
+    if getattr(opts, 'xxdiff_verbose', None):
+        print('===', ' '.join(cmd))
+
+    if stdin is not None:
+        assert '-' in cmd
+    if isinstance(stdin, str):
+        # stdin is text.
+        intype = PIPE
+    elif stdin is not None and hasattr(stdin, 'read'):
+        # stdin is an open pipe/file.
+        intype = stdin
+    else:
+        intype = None
+
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdin=intype, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        extramsg = ''
+        if e.errno == 2:
+            extramsg = '\nHint: Check if xxdiff is accessible in your path.'
+        raise SystemExit("Error: running xxdiff '%s'" % e + extramsg)
+
+    encoding = locale.getpreferredencoding(False)
+
+    async def write_stdin():
+        if intype is PIPE:
+            try:
+                p.stdin.write(stdin.encode(encoding))
+                await p.stdin.drain()
+                p.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    async def read_stdout():
+        lines = []
+        while True:
+            line = await p.stdout.readline()
+            if not line:
+                break
+            line = line.decode(encoding)
+            if (processed is not None and not processed.is_set() and
+                line.strip() == 'INPUT-PROCESSED'):
+                processed.set()
+            else:
+                lines.append(line)
+        return ''.join(lines)
+
+    async def read_stderr():
+        return (await p.stderr.read()).decode(encoding)
+
+    try:
+        _, stdout, stderr = await asyncio.gather(
+            write_stdin(), read_stdout(), read_stderr())
+        returncode = await p.wait()
+    except asyncio.CancelledError:
+        # Do not leave xxdiff running if the review was cancelled.
+        if p.returncode is None:
+            try:
+                p.terminate()
+            except ProcessLookupError:
+                pass
+            await p.wait()
+        raise
+    finally:
+        # Never leave a waiter hanging, even if xxdiff failed.
+        if processed is not None:
+            processed.set()
+
+    return returncode, stdout, stderr
+
+
+def test():
+    """
+    Test launcher: open xxdiff on each pair of the given files concurrently.
+    """
+    import sys
+
+    class Opts:
+        xxdiff_exec = 'xxdiff'
+
+    async def review(fn1, fn2):
+        processed = asyncio.Event()
+        task = asyncio.ensure_future(
+            xxdiff_decision(Opts, fn1, fn2, processed=processed))
+        await processed.wait()
+        print('Input processed: %s %s' % (fn1, fn2))
+        print(await task)
+
+    async def main(args):
+        await asyncio.gather(*[review(args[i], args[i+1])
+                               for i in range(0, len(args) - 1, 2)])
+
+    asyncio.run(main(sys.argv[1:]))
+
+if __name__ == '__main__':
+    test()
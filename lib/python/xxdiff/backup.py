@@ -8,15 +8,20 @@ __author__ = 'Martin Blais <blais@furius.ca>'
 
 
 # stdlib imports.
-import sys, os, shutil, optparse, tempfile
+import sys, os, shutil, optparse, tempfile, multiprocessing, atexit
 from os.path import *
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # xxdiff imports.
 from xxdiff.scripts import tmpprefix
+from xxdiff.backupstore import BackupStore, default_store
 
 
 # Different kinds of backups.
-backup_choices = ['along', 'other', 'none']
+backup_choices = ['along', 'other', 'store', 'none']
 
 def options_graft(parser, msg=None, deftype='other'):
     """
@@ -36,6 +41,11 @@ def options_graft(parser, msg=None, deftype='other'):
     group.add_option('--backup-dir', action='store',
                      help="Specify backup directory for type 'other'")
 
+    group.add_option('--backup-store', action='store', metavar='DIR',
+                     help="Specify the content-addressed backup store for type "
+                     "'store', where each version of a file is kept only once "
+                     "(default: %s).  See xx-backup-store." % default_store)
+
     group.add_option('--backup-prefix', action='store', default=None,
                      help=optparse.SUPPRESS_HELP)
 
@@ -51,15 +61,54 @@ def options_validate(opts, parser, logs=None):
     if opts.backup_type != 'other' and opts.backup_dir:
         parser.error(
             "option backup-dir is only valid for backups of type 'other'.")
+    if opts.backup_type != 'store' and getattr(opts, 'backup_store', None):
+        parser.error(
+            "option backup-store is only valid for backups of type 'store'.")
+
+
+def prepare_backup_dir(opts):
+    """
+    Create the backup directory for backups of type 'other', or the manifest
+    for backups of type 'store', if necessary.  Call this before forking
+    processes that make backups, so that they all share the same directory (and
+    the counts of backups for the reminder).
+    """
+    if getattr(opts, 'backup_counts', None) is None:
+        opts.backup_counts = multiprocessing.Array('L', len(backup_strategies))
+
+    if (opts.backup_type == 'store' and
+        getattr(opts, 'backup_manifest', None) is None):
+        store = BackupStore(getattr(opts, 'backup_store', None) or default_store)
+        opts.backup_manifest = store.new_manifest()
+        atexit.register(store.finish, opts.backup_manifest)
+
+    if opts.backup_type != 'other':
+        return
+
+    # If the backup directory has not been set, create a temporary one
+    if opts.backup_dir is None:
+        if opts.backup_prefix:
+            pfx = opts.backup_prefix + '.'
+        else:
+            pfx = ''
+        opts.backup_dir = tempfile.mkdtemp(prefix=tmpprefix + pfx)
+    # Otherwise create the specified directory if it does not exist
+    elif not exists(opts.backup_dir):
+        os.makedirs(opts.backup_dir)
 
 
-def backup_file(fn, opts, logs=None):
+def backup_file(fn, opts, logs=None, unlinked=False):
     """
     Compute backup filename and copy backup file.
 
     Arguments:
     - 'fn': filename to backup -> string
     - 'opts': program options -> Options instance
+    - 'unlinked': true if the file is about to be deleted or replaced by
+      renaming another file over it, rather than overwritten in place -> bool
+
+    The files are copied with the cheapest available strategy (see
+    backup_strategies).
     """
     if hasattr(logs, 'write'):
         logs = logs.write
@@ -86,23 +135,24 @@ def backup_file(fn, opts, logs=None):
         # Remove the leading slash (this may f*ck up under Windoze).
         relfn = relfn[1:]
 
-        # If the backup directory has not been set, create a temporary one
-        if opts.backup_dir is None:
-            if opts.backup_prefix:
-                pfx = opts.backup_prefix + '.'
-            else:
-                pfx = ''
-            opts.backup_dir = tempfile.mkdtemp(prefix=tmpprefix + pfx)
-        # Otherwise create the specified directory if it does not exist
-        elif not exists(opts.backup_dir):
-            os.makedirs(opts.backup_dir)
-
+        prepare_backup_dir(opts)
         backupfn = join(opts.backup_dir, relfn)
 
         if opts.verbose >= 0 and exists(backupfn) and logs:
             logs("(Warning: Overwriting existing file in backup '%s')\n" %
                  backupfn)
 
+    elif opts.backup_type == 'store':
+        # Store the contents in the shared backup store, and record them in the
+        # manifest of this run, which we return instead of a backup filename.
+        prepare_backup_dir(opts)
+        store = BackupStore(getattr(opts, 'backup_store', None) or default_store)
+        for strategy in store.backup(fn, opts.backup_manifest):
+            _count_strategy(opts, strategy)
+        if logs and opts.verbose >= 3:
+            logs('Backup: %s (in %s)\n' % (fn, opts.backup_manifest))
+        return opts.backup_manifest
+
     else: # opts.backup_type == 'none'
         backupfn = None
 
@@ -117,10 +167,15 @@ def backup_file(fn, opts, logs=None):
             os.makedirs(ddn)
 
         # Copy the original to the backup directory
+        def copy(src, dst):
+            strategy = backup_copy(src, dst, unlinked)
+            _count_strategy(opts, strategy)
+            return dst
+
         if isfile(fn) or islink(fn):
-            shutil.copy2(fn, backupfn)
+            copy(fn, backupfn)
         elif isdir(fn):
-            shutil.copytree(fn, backupfn, True)
+            shutil.copytree(fn, backupfn, True, copy_function=copy)
         else:
             raise RuntimeError("Internal error: cannot backup '%s'. " % fn,
                                "Invalid file type.")
@@ -128,14 +183,106 @@ def backup_file(fn, opts, logs=None):
     return backupfn
 
 
+# The strategies to copy files to their backups, from the cheapest:
+# - 'dedup': nothing to copy, the contents are already in the backup store;
+# - 'reflink': clone the file, sharing its data until either copy is modified
+#   (on copy-on-write filesystems, e.g. btrfs or XFS);
+# - 'hardlink': link the backup to the file, only if the file is going to be
+#   deleted or replaced by a rename (and on the same filesystem);
+# - 'copy': copy the data of the file.
+backup_strategies = ['dedup', 'reflink', 'hardlink', 'copy']
+
+# The FICLONE ioctl request of Linux.
+FICLONE = 0x40049409
+
+# The pairs of devices (of the file and of the backup directory) between which
+# cloning has failed, to avoid trying again for every file.
+_noreflink_devices = set()
+
+def backup_copy(src, dst, unlinked=False):
+    """
+    Copy the file 'src' to 'dst' for a backup, with the cheapest strategy that
+    works, and return the name of the strategy.  Hard links are only used if
+    'unlinked' is true (see backup_file()).  Symbolic links are followed.
+    """
+    if not islink(src):
+        if _reflink(src, dst):
+            return 'reflink'
+        if unlinked:
+            if lexists(dst):
+                os.unlink(dst)
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError:
+                pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def _reflink(src, dst):
+    """
+    Try to clone the file 'src' to 'dst' and copy its metadata.  Return true if
+    successful.  The clone is made to a temporary file first, so that 'dst' is
+    left untouched if cloning fails.
+    """
+    if fcntl is None:
+        return False
+    dstdir = dirname(abspath(dst))
+    devices = (os.stat(src).st_dev, os.stat(dstdir).st_dev)
+    if devices in _noreflink_devices:
+        return False
+    fd, tmpfn = tempfile.mkstemp(prefix='.' + basename(dst) + '.', dir=dstdir)
+    try:
+        with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                _noreflink_devices.add(devices)
+                return False
+        shutil.copystat(src, tmpfn)
+        os.replace(tmpfn, dst)
+    finally:
+        if lexists(tmpfn):
+            os.unlink(tmpfn)
+    return True
+
+def _count_strategy(opts, strategy):
+    """
+    Count a file backed up with the given strategy, for the reminder.  The
+    counts are shared with the processes forked after the first backup or the
+    preparation of the backup directory.
+    """
+    counts = getattr(opts, 'backup_counts', None)
+    if counts is None:
+        counts = opts.backup_counts = multiprocessing.Array(
+            'L', len(backup_strategies))
+    with counts.get_lock():
+        counts[backup_strategies.index(strategy)] += 1
+
+
 def print_reminder(opts):
     """
-    Print a reminder of the location of the backup files.
+    Print a reminder of the location of the backup files, and of how they were
+    copied.
     """
     # Print reminder of location of backup files at the end (for convenience).
-    if opts.backup_dir:
+    counts = getattr(opts, 'backup_counts', None) or []
+    used = ['%s %d' % (strategy, count)
+            for strategy, count in zip(backup_strategies, counts) if count]
+    manifest = getattr(opts, 'backup_manifest', None)
+    if opts.backup_dir or manifest or used:
         print()
-        print(("Backup files in: '%s'" % opts.backup_dir))
+        if opts.backup_dir:
+            print(("Backup files in: '%s'" % opts.backup_dir))
+        if manifest:
+            print("Backup manifest: '%s'" % manifest)
+            storeopt = ''
+            if getattr(opts, 'backup_store', None):
+                storeopt = "--store '%s' " % opts.backup_store
+            print("(Restore with: xx-backup-store %srestore '%s')" %
+                  (storeopt, manifest))
+        if used:
+            print("Backup strategy: %s" % ', '.join(used))
         print()
 
 
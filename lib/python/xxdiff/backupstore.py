@@ -0,0 +1,398 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+A content-addressed store for backup files.
+
+Instead of copying the original files to a new directory on every run, each
+version of a file is stored once in a shared store, under the hash of its
+contents, and every run writes a manifest that maps the paths of the files it
+backed up to their hashes.  Running over the same files again thus only adds
+the files that have changed.  The store looks like this::
+
+  <store>/objects/ab/cdef...  (the contents, read-only)
+  <store>/manifests/20240131-120000-1234-xx-rename.manifest
+  <store>/inprogress/20240131-120000-1234-xx-rename.manifest  (while running)
+
+A manifest contains one JSON object per line, with the 'kind' of the entry
+('file', 'link' or 'dir'), its absolute 'path', and for files, the 'hash' of the
+contents, the 'mode' and the 'mtime' of the original.
+
+Backed up files can be restored from a manifest, and old manifests can be
+removed by age or to bound the size of the store, along with the objects that
+are not referenced anymore.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+
+# stdlib imports.
+import os, json, time, hashlib, tempfile, shutil, stat
+from os.path import *
+
+# xxdiff imports.
+from xxdiff.scripts import script_name
+
+
+# Default location of the backup store.
+default_store = join(expanduser('~'), '.xxdiff-backups')
+
+# Runs in progress are marked, so that the objects they store are not collected
+# before they are added to their manifest: the objects stored or reused by a
+# run are touched, and the objects touched since the start of the oldest run in
+# progress are not collected.  The markers are refreshed on every backup, and
+# those that have not been for this many seconds (e.g. of a killed process) are
+# ignored.
+marker_timeout = 24 * 3600
+
+# The temporary files of objects being stored are only collected if they have
+# not been changed for this many seconds, since they may belong to a run that
+# has not marked itself yet.
+tmp_grace = 3600
+
+
+def file_hash(fn):
+    """
+    Compute the hash of the contents of the given file.
+    """
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+class BackupStore(object):
+    """
+    A content-addressed store of backup files.
+    """
+    def __init__(self, root):
+        self.root = abspath(root)
+        "The root directory of the store."
+
+        self.objdir = join(self.root, 'objects')
+        "The directory of the objects."
+
+        self.mandir = join(self.root, 'manifests')
+        "The directory of the manifests."
+
+        self.inprogdir = join(self.root, 'inprogress')
+        "The directory of the markers of the runs in progress."
+
+    def new_manifest(self):
+        """
+        Create a new empty manifest for a run, and mark the run in progress.
+        Return the manifest filename.  Call finish() at the end of the run.
+        """
+        os.makedirs(self.mandir, exist_ok=True)
+        os.makedirs(self.inprogdir, exist_ok=True)
+        basefn = '%s-%d-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                               script_name)
+        fd, manfn = tempfile.mkstemp(prefix=basefn + '.', suffix='.manifest',
+                                     dir=self.mandir)
+        os.close(fd)
+        self._mark(manfn)
+        return manfn
+
+    def finish(self, manfn):
+        """
+        Mark the run of the given manifest as finished.
+        """
+        try:
+            os.unlink(self._marker(manfn))
+        except OSError:
+            pass
+
+    def _marker(self, manfn):
+        """
+        Return the filename of the in-progress marker of the given manifest.
+        """
+        return join(self.inprogdir, basename(manfn))
+
+    def _mark(self, manfn):
+        """
+        Create or refresh the in-progress marker of the given manifest.  The
+        marker contains the time the run started.
+        """
+        markerfn = self._marker(manfn)
+        try:
+            os.utime(markerfn)
+        except FileNotFoundError:
+            os.makedirs(self.inprogdir, exist_ok=True)
+            with open(markerfn, 'w') as f:
+                f.write('%f\n' % time.time())
+
+    def object_path(self, digest):
+        """
+        Return the filename of the object with the given hash.
+        """
+        return join(self.objdir, digest[:2], digest[2:])
+
+    def store_file(self, fn):
+        """
+        Store the contents of the given file, if not already present.  Return
+        the hash of the contents, and the strategy used to copy them ('dedup' if
+        they were already stored, see xxdiff.backup.backup_copy() otherwise).
+        The objects are never hard links, which could be modified.
+        """
+        from xxdiff.backup import backup_copy
+
+        digest = file_hash(fn)
+        objfn = self.object_path(digest)
+        try:
+            # Touch it so that it is not collected while the manifest is being
+            # written (see marker_timeout).
+            os.utime(objfn)
+            return digest, 'dedup'
+        except FileNotFoundError:
+            pass
+
+        # Copy the file first and hash the copy, in case the file is changing.
+        os.makedirs(dirname(objfn), exist_ok=True)
+        fd, tmpfn = tempfile.mkstemp(prefix='.tmp', dir=dirname(objfn))
+        os.close(fd)
+        try:
+            strategy = backup_copy(fn, tmpfn)
+            copied = file_hash(tmpfn)
+            if copied != digest:
+                digest = copied
+                objfn = self.object_path(digest)
+                os.makedirs(dirname(objfn), exist_ok=True)
+            os.chmod(tmpfn, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            # The copy has the time of the original, touch it (see above).
+            os.utime(tmpfn)
+            os.replace(tmpfn, objfn)
+        finally:
+            if lexists(tmpfn):
+                os.unlink(tmpfn)
+        return digest, strategy
+
+    def backup(self, fn, manfn):
+        """
+        Store the given file or directory and record it in the given manifest.
+        Return the list of strategies used for each file.
+        """
+        # Refresh the in-progress marker of the run before storing anything.
+        self._mark(manfn)
+
+        entries, strategies = [], []
+        def add(path):
+            st = os.lstat(path)
+            entry = {'path': abspath(path), 'mode': stat.S_IMODE(st.st_mode),
+                     'mtime': st.st_mtime}
+            if stat.S_ISLNK(st.st_mode):
+                entry.update(kind='link', target=os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry['kind'] = 'dir'
+            else:
+                digest, strategy = self.store_file(path)
+                entry.update(kind='file', hash=digest)
+                strategies.append(strategy)
+            entries.append(entry)
+
+        add(fn)
+        if isdir(fn) and not islink(fn):
+            for root, dirs, files in os.walk(fn):
+                for name in dirs + files:
+                    add(join(root, name))
+
+        # Append all the entries in a single write, so that processes sharing
+        # the manifest do not interleave their lines.
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        fd = os.open(manfn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data.encode('utf-8'))
+        finally:
+            os.close(fd)
+        return strategies
+
+    def manifests(self):
+        """
+        Return the list of the filenames of the manifests, oldest first.
+        """
+        if not isdir(self.mandir):
+            return []
+        return sorted((join(self.mandir, x) for x in os.listdir(self.mandir)
+                       if x.endswith('.manifest')), key=getmtime)
+
+    def restore(self, manfn, paths=None, destdir=None, dry_run=False):
+        """
+        Restore the files recorded in the given manifest, or only those under
+        the given list of paths.  The files are restored to their original
+        location, or under 'destdir' if specified.  If a file has been backed up
+        several times in the run, the first version is restored.  Generate the
+        (path, kind) pairs of the restored entries.
+        """
+        paths = [abspath(x) for x in paths or []]
+        seen = set()
+
+        # The modes of the directories are set last, deepest first, so that
+        # read-only directories can be filled first.
+        dirmodes = []
+        try:
+            for entry in read_manifest(manfn):
+                path = entry['path']
+                if path in seen:
+                    continue
+                if paths and not any(path == p or path.startswith(join(p, ''))
+                                     for p in paths):
+                    continue
+                seen.add(path)
+
+                target = path if destdir is None else join(destdir, path[1:])
+                yield path, entry['kind']
+                if not dry_run:
+                    self._restore_entry(entry, target)
+                    if entry['kind'] == 'dir':
+                        dirmodes.append((target, entry['mode']))
+        finally:
+            dirmodes.sort(key=lambda x: x[0].count(os.sep), reverse=True)
+            for target, mode in dirmodes:
+                os.chmod(target, mode)
+
+    def _restore_entry(self, entry, target):
+        """
+        Restore a single manifest entry to the given target.
+        """
+        kind = entry['kind']
+        if kind == 'dir':
+            # Keep it writable until its contents are restored (see restore()).
+            os.makedirs(target, exist_ok=True)
+            os.chmod(target, entry['mode'] | stat.S_IRWXU)
+            return
+
+        os.makedirs(dirname(target), exist_ok=True)
+        fd, tmpfn = tempfile.mkstemp(prefix='.' + basename(target) + '.',
+                                     dir=dirname(target))
+        os.close(fd)
+        try:
+            if kind == 'link':
+                os.unlink(tmpfn)
+                os.symlink(entry['target'], tmpfn)
+            else:
+                objfn = self.object_path(entry['hash'])
+                if not exists(objfn):
+                    raise SystemExit("Error: missing object '%s' for '%s'." %
+                                     (entry['hash'], entry['path']))
+                shutil.copyfile(objfn, tmpfn)
+                os.chmod(tmpfn, entry['mode'])
+                os.utime(tmpfn, (entry['mtime'], entry['mtime']))
+            os.replace(tmpfn, target)
+        finally:
+            if lexists(tmpfn):
+                os.unlink(tmpfn)
+
+    def gc(self, max_age=None, max_size=None, dry_run=False):
+        """
+        Remove the manifests older than 'max_age' seconds, and then the oldest
+        manifests until the objects referenced by the remaining ones take at
+        most 'max_size' bytes.  Remove the objects that are not referenced by
+        any of the remaining manifests, except those that may be in use by a
+        run in progress.  Return the lists of the removed manifests and objects,
+        and the number of bytes freed.
+        """
+        now = time.time()
+        manifests = self.manifests()
+
+        # Find the manifests to keep, from the newest.  The manifests of the
+        # runs in progress are always kept.
+        active = self._active_markers(now, dry_run)
+        kept, referenced, size = [], set(), 0
+        for manfn in reversed(manifests):
+            if basename(manfn) not in active:
+                if max_age is not None and now - getmtime(manfn) > max_age:
+                    break
+            hashes = set(entry['hash'] for entry in read_manifest(manfn)
+                         if entry['kind'] == 'file')
+            added = sum(self._object_size(x) for x in hashes - referenced)
+            if (basename(manfn) not in active and
+                max_size is not None and size + added > max_size):
+                break
+            kept.append(manfn)
+            referenced |= hashes
+            size += added
+        removed_manifests = [x for x in manifests if x not in kept]
+
+        # Sweep the objects that are not referenced anymore.
+        candidates = []
+        if isdir(self.objdir):
+            for root, dirs, files in os.walk(self.objdir):
+                for name in files:
+                    digest = basename(root) + name
+                    if digest not in referenced:
+                        candidates.append(join(root, name))
+
+        # Check the runs in progress again just before removing, in case one
+        # has started since, and spare the objects they may have touched (with
+        # some slack for the granularity of the file times).
+        now = time.time()
+        active = self._active_markers(now, dry_run)
+        since = min(active.values()) - 1 if active else None
+        removed_objects, freed = [], 0
+        for objfn in candidates:
+            try:
+                st = os.lstat(objfn)
+            except OSError:
+                continue
+            if basename(objfn).startswith('.tmp'):
+                # The copy may have the time of the original, use the time of
+                # its last change (e.g. of mode) too.
+                if now - max(st.st_mtime, st.st_ctime) < tmp_grace:
+                    continue
+            elif since is not None and st.st_mtime >= since:
+                continue
+            removed_objects.append(objfn)
+            freed += st.st_size
+
+        if not dry_run:
+            for fn in removed_manifests + removed_objects:
+                os.unlink(fn)
+            for root, dirs, files in os.walk(self.objdir, topdown=False):
+                if root != self.objdir and not os.listdir(root):
+                    os.rmdir(root)
+
+        return removed_manifests, removed_objects, freed
+
+    def _active_markers(self, now, dry_run):
+        """
+        Return a map of the names of the markers of the runs in progress to
+        the time they started.  The stale markers are removed (unless 'dry_run'
+        is true).
+        """
+        active = {}
+        if not isdir(self.inprogdir):
+            return active
+        for name in os.listdir(self.inprogdir):
+            markerfn = join(self.inprogdir, name)
+            try:
+                mtime = os.stat(markerfn).st_mtime
+                with open(markerfn) as f:
+                    started = float(f.read().strip() or mtime)
+            except (OSError, ValueError):
+                continue
+            if now - mtime <= marker_timeout:
+                active[name] = min(started, mtime)
+            elif not dry_run:
+                try:
+                    os.unlink(markerfn)
+                except OSError:
+                    pass
+        return active
+
+    def _object_size(self, digest):
+        """
+        Return the size of the given object, or 0 if it is missing.
+        """
+        try:
+            return os.stat(self.object_path(digest)).st_size
+        except OSError:
+            return 0
+
+
+def read_manifest(manfn):
+    """
+    Generate the entries of the given manifest file.
+    """
+    with open(manfn, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
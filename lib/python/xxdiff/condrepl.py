@@ -10,15 +10,16 @@ __author__ = "Martin Blais <blais@furius.ca>"
 
 
 # stdlib imports.
-import sys, os, optparse, logging
+import sys, os, optparse, logging, tempfile
 from os.path import *
-from subprocess import Popen, PIPE
 import shutil
 
 # xxdiff imports.
 import xxdiff.backup
 import xxdiff.invoke
 import xxdiff.checkout
+import xxdiff.textdiff
+from xxdiff.scripts import tmpprefix
 
 
 __all__ = ('cond_replace',)
@@ -52,8 +53,28 @@ def options_validate(opts, parser, logs=None):
     pass
 
 
-# Side-by-side diff2 command.
-sbs_diff_cmd = ['diff', '--side-by-side', '--suppress-common-lines']
+def identical_files(fn1, fn2):
+    """
+    Return true if the two given files have the same contents, false if they
+    differ or could not be compared.
+    """
+    try:
+        return xxdiff.textdiff.identical(fn1, fn2)
+    except (IOError, OSError, ValueError):
+        return False
+
+def sbs_diff(fn1, fn2):
+    """
+    Compute a side-by-side diff of the changes between the two given files.
+    Return an empty string if they are identical, or None if they could not be
+    compared.
+    """
+    try:
+        return xxdiff.textdiff.sbs_diff(fn1, fn2)
+    except (IOError, OSError) as e:
+        logging.warn("Could not compare files '%s' and '%s': %s" %
+                     (fn1, fn2, e))
+        return None
 
 def cond_replace(origfn, newfn, opts, logs, exitonsame=False, replfn=None):
     """
@@ -85,37 +106,40 @@ def cond_replace(origfn, newfn, opts, logs, exitonsame=False, replfn=None):
 
       * opts.no_confirm: Apply the changes without confirmation.
 
-    - 'exitonsame': do not even pop xxdiff if the files are the same
+    - 'exitonsame': do not even pop xxdiff if the files are the same, even if
+      'replfn' is a third file.  (If the target file would not change, xxdiff
+      is never popped for identical files.)
 
     Returns the decision code for the file.
     """
     origfn = normpath(abspath(origfn))
 
+    if replfn is None:
+        replfn = origfn
+
     # Print header
     if opts.verbose >= 2:
         print('=' * 80, file=logs)
         print('File: ', origfn, file=logs)
 
-    if opts.verbose >= 2 or exitonsame:
-
-        # Run diff between the original and the new/modified file
-        p = Popen(sbs_diff_cmd + [origfn, newfn], stdout=PIPE, stderr=PIPE, encoding='utf-8')
-        diff_output, stderr = p.communicate()
+    # Check if the files are identical first, which is cheap, before running
+    # anything else.
+    same = identical_files(origfn, newfn)
+    if same:
+        if opts.verbose >= 2:
+            print("(Warning: no differences.)", file=logs)
 
-        # Print differences.
-        if p.returncode == 0:
-            if opts.verbose >= 2:
-                print("(Warning: no differences.)", file=logs)
+        target = normpath(abspath(replfn))
+        if exitonsame or target in (origfn, normpath(abspath(newfn))):
+            print_decision('NODIFF', origfn, opts, logs)
+            return 'NODECISION'
 
-            if exitonsame:
-                print_decision('NODIFF', origfn, opts, logs)
-                return 'NODECISION'
+    if opts.verbose >= 2 and not same:
+        # Diff the original and the new/modified file
+        diff_output = sbs_diff(origfn, newfn)
     else:
         diff_output = None
 
-    if replfn is None:
-        replfn = origfn
-
     if opts.no_confirm:
         # No graphical diff, just replace the files without asking.
         do_replace_file(replfn, newfn, opts, logs)
@@ -126,7 +150,7 @@ def cond_replace(origfn, newfn, opts, logs, exitonsame=False, replfn=None):
     else:
         # Call xxdiff!
         decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(
-            opts, '--title2', 'NEW FILE', origfn, newfn)
+            opts, inmemory=True, *replace_xxdiff_args(origfn, newfn))
 
         print_decision(decision, origfn, opts, logs)
 
@@ -148,10 +172,8 @@ def cond_replace(origfn, newfn, opts, logs, exitonsame=False, replfn=None):
 
         elif decision == 'MERGED':
             if opts.verbose >= 2:
-                # Run diff again to show the real changes that will be applied.
-                p = Popen(sbs_diff_cmd + [origfn, mergedf.name],
-                          stdout=PIPE, stderr=PIPE, encoding='utf-8')
-                diff_output, stderr = p.communicate()
+                # Diff again to show the real changes that will be applied.
+                diff_output = sbs_diff(origfn, mergedf.name)
 
                 if diff_output: print_diffs(diff_output, logs)
 
@@ -160,6 +182,25 @@ def cond_replace(origfn, newfn, opts, logs, exitonsame=False, replfn=None):
     return decision
 
 
+def replace_xxdiff_args(origfn, newfn):
+    """
+    Return the arguments that cond_replace() invokes xxdiff with.
+    """
+    return ('--title2', 'NEW FILE', normpath(abspath(origfn)), newfn)
+
+def prelaunch_replace(origfn, newfn, opts):
+    """
+    Prelaunch the xxdiff session that cond_replace() will use to confirm the
+    replacement of the given files, if a session pool is enabled and xxdiff will
+    be needed.
+    """
+    pool = getattr(opts, 'session_pool', None)
+    if (pool is not None and not opts.no_confirm and
+        not identical_files(origfn, newfn)):
+        pool.prelaunch('decision', inmemory=True,
+                       *replace_xxdiff_args(origfn, newfn))
+
+
 def print_decision(decision, origfn, opts, logs):
     """
     Print the decision string.
@@ -186,9 +227,11 @@ def do_replace_file(ofn, nfn, opts, logs):
     if opts.dry_run:
         return
 
-    # Backup the original file first.
+    # Backup the original file first.  If it is replaced atomically, the
+    # original file is renamed over and can be linked to.
     if hasattr(opts, 'backup_type'):
-        xxdiff.backup.backup_file(ofn, opts, logs)
+        xxdiff.backup.backup_file(ofn, opts, logs,
+                                  getattr(opts, 'atomic_replace', False))
 
     # Insure that the file is checked out.
     if getattr(opts, 'checkout', None):
@@ -197,12 +240,30 @@ def do_replace_file(ofn, nfn, opts, logs):
     # Copy the new file over the original.
     if not os.access(ofn, os.W_OK):
         logging.warn("Could not overwrite file '%s'." % ofn)
+    elif getattr(opts, 'atomic_replace', None):
+        replace_file_atomic(ofn, nfn)
     else:
         shutil.copyfile(nfn, ofn)
 
+def replace_file_atomic(ofn, nfn):
+    """
+    Replace the original file 'ofn' by a copy of 'nfn' atomically, by copying it
+    to a temporary file alongside the original first and renaming it over.  The
+    permissions of the original file are preserved.  If the original is a
+    symbolic link, the file it points to is replaced, not the link.
+    """
+    ofn = realpath(ofn)
+    fd, tmpfn = tempfile.mkstemp(prefix='.' + tmpprefix, dir=dirname(ofn))
+    os.close(fd)
+    try:
+        shutil.copyfile(nfn, tmpfn)
+        shutil.copymode(ofn, tmpfn)
+        os.replace(tmpfn, ofn)
+    finally:
+        if exists(tmpfn):
+            os.unlink(tmpfn)
 
 
-diff3_cmd = ['diff3']
 
 proper_decisions = ('ACCEPT', 'REJECT', 'MERGED')
 
@@ -249,19 +310,13 @@ def cond_resolve(mine, ancestor, yours, output, opts, logs=None, extra=None):
         print('File: ', output, file=logs)
 
     if opts.verbose >= 2:
-        # Run diff between the three files.
-        p = Popen(diff3_cmd + files3, stdout=PIPE, stderr=PIPE, encoding='utf-8')
-        diff_output, stderr = p.communicate()
-
-        # Print differences.
-        if not diff_output: # Note: we cannot rely on the return code.
+        # Check for differences between the three files.
+        if identical_files(mine, ancestor) and identical_files(mine, yours):
             if opts.verbose >= 2:
                 print("(Warning: no differences.)", file=logs)
 
             print_decision('NODIFF', mine, opts, logs)
             return 'NODECISION'
-    else:
-        diff_output = None
 
     # Add arguments to identify files in the title bars.
     dargs = xxdiff.invoke.title_opts('%s (WORKING)' % mine,
@@ -272,7 +327,8 @@ def cond_resolve(mine, ancestor, yours, output, opts, logs=None, extra=None):
 
     # Call xxdiff!
     dargs.extend(files3)
-    decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(opts, *dargs)
+    decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(
+        opts, inmemory=True, *dargs)
 
     print_decision(decision, mine, opts, logs)
 
@@ -299,10 +355,9 @@ def cond_resolve(mine, ancestor, yours, output, opts, logs=None, extra=None):
         pass
 
     if opts.verbose >= 2 and decision in proper_decisions:
-        # Run diff again to show the real changes that will be applied to
-        # 'mine' into the output file.
-        p = Popen(sbs_diff_cmd + [mine, output], stdout=PIPE, stderr=PIPE, encoding='utf-8')
-        diff_output, stderr = p.communicate()
+        # Diff again to show the real changes that will be applied to 'mine'
+        # into the output file.
+        diff_output = sbs_diff(mine, output)
 
         if diff_output:
             print_diffs(diff_output, logs)
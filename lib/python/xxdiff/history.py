@@ -8,7 +8,7 @@ __author__ = 'Martin Blais <blais@furius.ca>'
 
 
 # stdlib imports.
-import os, optparse
+import os, optparse, hashlib, atexit
 from os.path import *
 
 # xxdiff imports.
@@ -35,6 +35,25 @@ def options_graft(parser):
     group.add_option('--history-file', action='store', metavar='FILENAME',
                      help="Use the specified file to record history.")
 
+    group.add_option('--history-flush', action='store', type='int',
+                     metavar='COUNT', default=1,
+                     help="Flush the history file to disk every COUNT new "
+                     "entries only (default is every entry).  The entries "
+                     "that are not flushed are lost if the process is "
+                     "killed.")
+
+    group.add_option('--content-history', action='store_true',
+                     help="Record the reviewed files by a digest of their "
+                     "contents rather than by their size and modification "
+                     "time, so that files that are touched or changed back "
+                     "are not reviewed again, across sessions and machines "
+                     "sharing the history file (where supported).")
+
+    group.add_option('--compact-history', action='store_true',
+                     help="Record only digests of the entries in a new "
+                     "history file, in a compact binary format, for long "
+                     "reviews.  Existing history files keep their format.")
+
     parser.add_option_group(group)
 
     return group
@@ -46,6 +65,38 @@ def options_validate(opts, parser, logs=None):
     """
     if not opts.history and opts.history_file:
         parser.error("You cannot specify a history file and disable history.")
+    if opts.history_flush < 1:
+        parser.error("The history flush count must be positive.")
+
+
+# Header of the compact history files, which contain a sequence of fixed-size
+# digests of the entries instead of the entries themselves, and the size of the
+# digests.
+compact_magic = b'xxdiff-history-digests-1\n'
+digest_size = 16
+
+def item_digest(histitem):
+    """
+    Compute the digest of a history item for compact history files.
+    """
+    return hashlib.blake2b(histitem.encode('utf-8', 'surrogateescape'),
+                           digest_size=digest_size).digest()
+
+def content_digest(*filenames):
+    """
+    Compute a digest of the contents of the given files, for history items that
+    identify changes by contents.  None stands for a non-existing file.
+    """
+    digest = hashlib.blake2b(digest_size=digest_size)
+    for fn in filenames:
+        fdigest = hashlib.blake2b(digest_size=digest_size)
+        if fn is not None:
+            with open(fn, 'rb') as f:
+                for data in iter(lambda: f.read(1 << 20), b''):
+                    fdigest.update(data)
+        digest.update(fdigest.digest())
+    return digest.hexdigest()
+
 
 
 class History(object):
@@ -55,7 +106,9 @@ class History(object):
 
     The history is saved one file per-line, but you can put whatever you like in
     that one line, for example, the filename, the status of the file, its last
-    modification time, etc.  It is basically used as a hash.
+    modification time, etc.  It is basically used as a hash.  With the
+    --compact-history option, only a fixed-size digest of each line is saved
+    instead, which keeps large histories small and quick to load.
 
     Note: eventually we might want to put more stuff in the history item.  We
     could then consider using a pickle instead.  I have found this unnecessary
@@ -67,16 +120,26 @@ class History(object):
     review all the past differences.
     """
     def __init__(self, opts, resilient_dir):
-        self.history = []
-        "Existing history file lines."
+        self.history = None
+        """Set of the existing history entries (or of their digests), read
+        from the file on first use."""
+
+        self.histfn = None
+        "The name of the history file."
 
         self.histf = None
-        """A file object opened in write mode so that we can write new entries
+        """A file object opened in append mode so that we can write new entries
         there."""
 
+        self.compact = False
+        "True if the history file is in the compact format."
+
+        self.unflushed = 0
+        "The number of entries written since the file was last flushed."
+
         self.opts = opts
         "A reference to the options for use later."
-        
+
         self._initialize(resilient_dir)
 
     def _initialize(self, resilient_dir):
@@ -84,7 +147,7 @@ class History(object):
         Initialize the history module.
         """
         opts = self.opts
-        
+
         # Calculate the location of the history file.
         if opts.history_file:
             histfn = opts.history_file
@@ -98,16 +161,62 @@ class History(object):
         # Prepare and create a history file if one does not already exist.
         if not opts.history:
             return
+        self.histfn = histfn
         if not exists(histfn):
             makedirs(dirname(histfn), False)
-            self.histf = open(histfn, 'w')
+            self.compact = bool(getattr(opts, 'compact_history', False))
+            if self.compact:
+                self.histf = open(histfn, 'wb')
+                self.histf.write(compact_magic)
+                self.histf.flush()
+            else:
+                self.histf = open(histfn, 'w')
+            self.history = set()
+
+        # Otherwise the history file contents are read when first needed, in
+        # the format of the existing file.
+        else:
+            with open(histfn, 'rb') as f:
+                self.compact = (f.read(len(compact_magic)) == compact_magic)
+            self.histf = open(histfn, 'ab' if self.compact else 'a')
 
-        # Otherwise read the history file contents.
+            # Drop a partial digest written when the process was killed.
+            if self.compact:
+                size = self.histf.seek(0, os.SEEK_END)
+                self.histf.truncate(size - (size - len(compact_magic)) %
+                                    digest_size)
+
+        atexit.register(self.flush)
+
+    def _load(self):
+        """
+        Read the existing history file contents, if not done already.
+        """
+        if self.history is not None:
+            return self.history
+        self.history = set()
+        if self.compact:
+            with open(self.histfn, 'rb') as f:
+                f.seek(len(compact_magic))
+                while True:
+                    data = f.read(digest_size * 4096)
+                    self.history.update(data[i:i + digest_size]
+                                        for i in range(0, len(data) -
+                                                       digest_size + 1,
+                                                       digest_size))
+                    if len(data) < digest_size * 4096:
+                        break
         else:
-            f = open(histfn, 'r')
-            self.history.extend(x.strip() for x  in f.readlines() if x)
-            f.close()
-            self.histf = open(histfn, 'a')
+            with open(self.histfn, 'r') as f:
+                self.history.update(x.strip() for x in f)
+        return self.history
+
+    def _key(self, histitem):
+        """
+        Return the key of the given history item in the history set.
+        """
+        histitem = histitem.strip()
+        return item_digest(histitem) if self.compact else histitem
 
     def __contains__(self, histitem):
         """
@@ -125,7 +234,7 @@ class History(object):
         if not self.opts.history:
             return False
 
-        return histitem in self.history
+        return self._key(histitem) in self._load()
 
     def append(self, histitem):
         """
@@ -137,25 +246,41 @@ class History(object):
             return
 
         # Don't add itmes which are already present in the history.
-        if histitem in self.history:
+        key = self._key(histitem)
+        history = self._load()
+        if key in history:
             return
 
         # Append the new item to the history.
-        histitem = histitem.strip()
-        self.history.append(histitem)
-        
+        history.add(key)
+        if self.compact:
+            self.histf.write(key)
+        else:
+            self.histf.write(histitem.strip())
+            self.histf.write('\n')
+
         # Update the history file and make sure that all changes are flushed to
-        # disk so that if we get interrupted nothing is lost.
-        self.histf.write(histitem)
-        self.histf.write('\n')
-        self.histf.flush()
+        # disk so that if we get interrupted nothing is lost, every so many
+        # entries.
+        self.unflushed += 1
+        if self.unflushed >= getattr(self.opts, 'history_flush', 1):
+            self.flush()
+
+    def flush(self):
+        """
+        Flush the entries appended to the history file.
+        """
+        if self.histf is not None and not self.histf.closed:
+            self.histf.flush()
+        self.unflushed = 0
 
     def delete(self):
         """
         Delete the history file.  (This also clears the history.)
         Call this when your process completed succesfully.
         """
-        histfn = self.histf.name
+        if self.histf is None:
+            return
         self.histf.close()
-        xxdiff.resilient.resilient_remove(histfn)
-
+        self.history = set()
+        xxdiff.resilient.resilient_remove(self.histfn)
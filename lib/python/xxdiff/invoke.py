@@ -9,8 +9,9 @@ Functions to invoke xxdiff in various ways.
 __author__ = 'Martin Blais <blais@furius.ca>'
 
 # stdlib imports.
-import os, optparse, tempfile, logging, io
+import os, optparse, tempfile, logging, io, atexit, mmap
 from os.path import *
+from collections import deque
 from subprocess import Popen, PIPE
 
 # xxdiff imports.
@@ -38,6 +39,13 @@ def options_graft(parser):
     group.add_option('-Y', '--xxdiff-verbose', action='store_true',
                      help="Output xxdiff commands on stdout, for debugging.")
 
+    group.add_option('--prelaunch', action='store', type='int', default=0,
+                     metavar='N',
+                     help="Launch xxdiff for up to N of the next files while "
+                     "the current one is being reviewed, to hide the startup "
+                     "time of xxdiff.  Their windows open ahead of time. "
+                     "(default is 0, launch xxdiff when it is needed).")
+
     parser.add_option_group(group)
 
     return group
@@ -47,13 +55,18 @@ def options_validate(opts, parser, logs=None):
     """
     Validate xxdiff options.
     """
-    pass
+    if opts.prelaunch < 0:
+        parser.error("The number of sessions to prelaunch must be positive.")
+    opts.session_pool = None
+    if opts.prelaunch:
+        opts.session_pool = SessionPool(opts, opts.prelaunch)
 
 
-def _run_xxdiff(cmd, opts, stdin):
+def _run_xxdiff(cmd, opts, stdin, pass_fds=()):
     """
     Runs the given xxdiff command and return a Popen object.
     'stdin' is the optional stdin text or open file to send to xxdiff.
+    'pass_fds' are file descriptors for xxdiff to inherit.
 
     Note: this is an internal function, not meant to be called from the outside.
     """
@@ -77,6 +90,7 @@ def _run_xxdiff(cmd, opts, stdin):
                   stdout=PIPE,
                   stderr=PIPE,
                   stdin=intype,
+                  pass_fds=pass_fds,
                   text=True)
     except OSError as e:
         extramsg = ''
@@ -128,9 +142,83 @@ def xxdiff_decision(opts, *arguments, **kwds):
       # Wait for the xxdiff results
       decision, merged, retcode = xxwait()
 
+    If 'inmemory' (in kwds) is true, the merged output is captured in memory
+    instead of a temporary file on disk, in a MergedOutput object which
+    supports the same uses, and also provides the raw bytes without copying.
+
+    If a session with the same arguments was prelaunched in the session pool
+    of the options, it is used instead of starting a new xxdiff.  (The pool
+    launches its sessions with 'deferred' set, which returns without waiting for
+    the input to be processed; the waiter then has a 'wait_processed' method to
+    do so.)
+    """
+    waiter = _take_prelaunched(opts, 'decision', arguments, kwds)
+    if waiter is not None:
+        return waiter if kwds.get('nowait') else waiter()
+
+    # If we're not waiting, we only want to return after all the input has been
+    # processed.  This is always the case.
+    nowait = kwds.pop('nowait', None)
+    deferred = kwds.pop('deferred', False)
+    cmd, mergedf = _decision_command(opts, arguments, nowait,
+                                     kwds.pop('inmemory', False))
+
+    # Run xxdiff.
+    p = _run_xxdiff(cmd, opts, kwds.pop('stdin', None),
+                    getattr(mergedf, 'pass_fds', ()))
+
+    # Define waiter object.
+    def waiter():
+        # Select-wait for stdout and stderr
+        stdout, stderr = p.communicate()
+        return _decision_result(cmd, p.returncode, stdout, stderr, mergedf)
+    waiter.process = p
+
+    # Eat up the processed tag, or leave it to the session pool.
+    if nowait and p.returncode is None:
+        waiter.wait_processed = lambda: _wait_processed(p, cmd)
+        if not deferred:
+            waiter.wait_processed()
+        return waiter
+
+    # Wait for the results and return them.
+    return waiter()
+
+
+def _wait_processed(p, cmd):
+    """
+    Wait for xxdiff to indicate that it has processed its input, and eat up the
+    tag from its output.
+
+    Note: the tag is read from the pipe one byte at a time rather than through
+    the buffered output file, which could otherwise also swallow the decision
+    that follows if it has already been output when we read the tag, and hide
+    it from communicate().
+    """
+    fd = p.stdout.fileno()
+    line = b''
+    while not line.endswith(b'\n'):
+        c = os.read(fd, 1)
+        if not c:
+            break
+        line += c
+    if line.strip() != b'INPUT-PROCESSED':
+        stdout, stderr = p.communicate()
+        logging.error("Error: running xxdiff as '%s'.\n" %
+                      ' '.join(cmd) + stderr)
+
+
+def _decision_command(opts, arguments, nowait, inmemory=False):
+    """
+    Build the command to run xxdiff in decision mode with the given arguments.
+    Return the command and the temporary file created for the merged output (or
+    the MergedOutput if 'inmemory' is true).
     """
     # Create a temporary file to contain the output or merged results.
-    mergedf = tempfile.NamedTemporaryFile(mode='w+', prefix=tmpprefix)
+    if inmemory:
+        mergedf = MergedOutput()
+    else:
+        mergedf = tempfile.NamedTemporaryFile(mode='w+', prefix=tmpprefix)
 
     # Get the appropriate xxdiff executable and options.
     xexec = getattr(opts, 'xxdiff_exec', 'xxdiff')
@@ -143,62 +231,95 @@ def xxdiff_decision(opts, *arguments, **kwds):
     assert '--merged-filename' not in (list(arguments) + options), (list(arguments) + options)
     alloptions = options + ['--merged-filename', mergedf.name] + list(arguments)
 
-    # If we're not waiting, we only want to return after all the input has been
-    # processed.  This is always the case.
-    nowait = kwds.pop('nowait', None)
     if nowait and '--indicate-input-processed' not in alloptions:
         alloptions.insert(0, '--indicate-input-processed')
 
-    # Run xxdiff.
-    cmd = [xexec] + alloptions
-    p = _run_xxdiff(cmd, opts, kwds.pop('stdin', None))
-
-    # Define waiter object.
-    def waiter():
-        # Select-wait for stdout and stderr
-        stdout, stderr = p.communicate()
-
-        # If xxdiff failed, we bail out of the script.
-        if p.returncode == 2:
-            logging.error("Error: running xxdiff as '%s'.\n" %
-                          ' '.join(cmd) + stderr)
-            return 'NODECISION', None, -1
-
-        # Get the decision code from xxdiff.
-        lines = stdout.splitlines()
-        if not lines:
-            logging.error("Error: running xxdiff as '%s'.\n" %
-                          ' '.join(cmd) + stderr)
-            return 'NODECISION', None, -1
-
-        decision = lines[0].strip()
-        assert decision in decisions
-
-        if decision == 'NODECISION':
-            mergedf.close()
-            out_mergedf = None
-        else:
-            out_mergedf = mergedf
+    return [xexec] + alloptions, mergedf
 
-        return decision, out_mergedf, p.returncode
+def _decision_result(cmd, returncode, stdout, stderr, mergedf):
+    """
+    Interpret the results of an xxdiff decision command, and return the
+    decision code, the merged file and the return code (see xxdiff_decision()).
+    """
+    # If xxdiff failed, we bail out of the script.
+    if returncode == 2:
+        logging.error("Error: running xxdiff as '%s'.\n" %
+                      ' '.join(cmd) + stderr)
+        return 'NODECISION', None, -1
+
+    # Get the decision code from xxdiff.
+    lines = stdout.splitlines()
+    if not lines:
+        logging.error("Error: running xxdiff as '%s'.\n" %
+                      ' '.join(cmd) + stderr)
+        return 'NODECISION', None, -1
+
+    decision = lines[0].strip()
+    assert decision in decisions
+
+    if decision == 'NODECISION':
+        mergedf.close()
+        out_mergedf = None
+    else:
+        out_mergedf = mergedf
 
-    # Eat up the processed tag.
-    #
-    # Important note: there is a subtle race condition that can cause an error
-    # here, but it is rather unlikely to happen (in practice it will never
-    # happen because xxdiff is faster than the user's fingers).
-    if nowait and p.returncode is None:
-        # Wait for the processed tag.
-        line = p.stdout.readline().strip()
-        if line != 'INPUT-PROCESSED':
-            stdout, stderr = p.communicate()
-            logging.error("Error: running xxdiff as '%s'.\n" %
-                          ' '.join(cmd) + stderr)
+    return decision, out_mergedf, returncode
 
-        return waiter
 
-    # Wait for the results and return them.
-    return waiter()
+class MergedOutput(object):
+    """
+    An in-memory file for xxdiff to write the merged output to, in place of the
+    temporary file.  It is an anonymous memory file (memfd) that xxdiff inherits
+    and opens through its /dev/fd path, so nothing is written to disk, and
+    memory is only used for what xxdiff writes.  Where memory files are not
+    available, a temporary file is used instead.
+
+    Like the temporary file, it has a 'name' that can be used to copy it while
+    it is open, and it can be read as text.  The contents can also be obtained
+    as bytes with getvalue(), or as a memoryview with getbuffer(), which maps
+    them without copying (release the view before closing).
+    """
+    def __init__(self):
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create('xxdiff-merged', os.MFD_CLOEXEC)
+            self.file = open(fd, 'r')
+            self.name = '/dev/fd/%d' % fd
+            self.pass_fds = (fd,)
+        else:
+            self.file = tempfile.NamedTemporaryFile(mode='w+',
+                                                    prefix=tmpprefix)
+            self.name = self.file.name
+            self.pass_fds = ()
+        self.mapping = None
+
+    def __getattr__(self, name):
+        # Delegate the other file methods (read(), seek(), etc.)
+        return getattr(self.file, name)
+
+    def getvalue(self):
+        """
+        Return the contents as bytes.
+        """
+        fd = self.file.fileno()
+        return os.pread(fd, os.fstat(fd).st_size, 0)
+
+    def getbuffer(self):
+        """
+        Return a read-only memoryview of the contents, mapped in memory.
+        """
+        fd = self.file.fileno()
+        if not os.fstat(fd).st_size:
+            return memoryview(b'')
+        if self.mapping is not None:
+            self.mapping.close()
+        self.mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        return memoryview(self.mapping)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.file.close()
 
 
 def xxdiff_display(opts, *arguments, **kwds):
@@ -216,60 +337,236 @@ def xxdiff_display(opts, *arguments, **kwds):
 
     We do not create a merged file, but you are free to pass in these options if
     so desired.
+
+    Like for xxdiff_decision(), prelaunched sessions are used if available.
     """
+    waiter = _take_prelaunched(opts, 'display', arguments, kwds)
+    if waiter is not None:
+        return waiter if kwds.get('nowait') else waiter()
+
     if '--decision' in arguments:
         raise RuntimeError("Internal error: use xxdiff_decision() "
                            "instead of xxdiff_display() if you want a user "
                            "return code.")
 
-    # Get the appropriate xxdiff executable and options.
-    xexec = getattr(opts, 'xxdiff_exec', 'xxdiff')
-    options = getattr(opts, 'xxdiff_options', [])
-
-    alloptions = options + list(arguments)
-
     # If we're not waiting, we only want to return after all the input has been
     # processed.  This is always the case.
     nowait = kwds.pop('nowait', None)
-    if nowait and '--indicate-input-processed' not in alloptions:
-        alloptions.insert(0, '--indicate-input-processed')
+    deferred = kwds.pop('deferred', False)
+    cmd = _display_command(opts, arguments, nowait)
 
     # Run xxdiff.
-    cmd = [xexec] + alloptions
     p = _run_xxdiff(cmd, opts, kwds.pop('stdin', None))
 
     # Define waiter object.
     def waiter():
         # Select-wait for stdout and stderr
         stdout, stderr = p.communicate()
+        return _display_result(cmd, p.returncode, stderr)
+    waiter.process = p
 
-        # If xxdiff failed, we bail out of the script.
-        if p.returncode == 2:
-            logging.error("Error: running xxdiff as '%s'.\n" %
-                          ' '.join(cmd) + stderr)
-            return -1
-
-        return p.returncode
-
-    # Eat up the processed tag.
-    #
-    # Important note: there is a subtle race condition that can cause an error
-    # here, but it is rather unlikely to happen (in practice it will never
-    # happen because xxdiff is faster than the user's fingers).
+    # Eat up the processed tag, or leave it to the session pool.
     if nowait and p.returncode is None:
-        # Wait for the processed tag.
-        line = p.stdout.readline().strip()
-        if line != 'INPUT-PROCESSED':
-            stdout, stderr = p.communicate()
-            logging.error("Error: running xxdiff as '%s'.\n" %
-                          ' '.join(cmd) + stderr)
-
+        waiter.wait_processed = lambda: _wait_processed(p, cmd)
+        if not deferred:
+            waiter.wait_processed()
         return waiter
 
     # Wait for the results and return them.
     return waiter()
 
 
+def _display_command(opts, arguments, nowait):
+    """
+    Build the command to run xxdiff for display with the given arguments.
+    """
+    # Get the appropriate xxdiff executable and options.
+    xexec = getattr(opts, 'xxdiff_exec', 'xxdiff')
+    options = getattr(opts, 'xxdiff_options', [])
+
+    alloptions = options + list(arguments)
+
+    if nowait and '--indicate-input-processed' not in alloptions:
+        alloptions.insert(0, '--indicate-input-processed')
+
+    return [xexec] + alloptions
+
+def _display_result(cmd, returncode, stderr):
+    """
+    Interpret the results of an xxdiff display command, and return its return
+    code (see xxdiff_display()).
+    """
+    # If xxdiff failed, we bail out of the script.
+    if returncode == 2:
+        logging.error("Error: running xxdiff as '%s'.\n" %
+                      ' '.join(cmd) + stderr)
+        return -1
+
+    return returncode
+
+
+def _take_prelaunched(opts, kind, arguments, kwds):
+    """
+    Return the waiter of a session prelaunched with the given arguments, or None
+    if there is none.
+    """
+    pool = getattr(opts, 'session_pool', None)
+    if pool is None or kwds.get('stdin') is not None:
+        return None
+    return pool.take(kind, arguments)
+
+
+class SessionPool(object):
+    """
+    A pool of xxdiff sessions launched ahead of time, to hide the startup time
+    of xxdiff (which is significant on remote displays).  The sessions are
+    started with --indicate-input-processed like the 'nowait' invocations, and
+    their waiters are parked until xxdiff_decision() or xxdiff_display() is
+    called with the same arguments, which then hand them over.  Launching a
+    session does not wait for xxdiff to start up: the indication that it has
+    processed its input is only read when the session is taken.  The sessions
+    that are never used are killed on exit.
+    """
+    def __init__(self, opts, size):
+        self.opts = opts
+        "The options used to launch the sessions."
+
+        self.size = size
+        "The number of sessions to launch ahead of the one in use."
+
+        self.parked = deque()
+        "A list of (kind, arguments, waiter) for the parked sessions."
+
+        atexit.register(self.close)
+
+    def prelaunch(self, kind, *arguments, **kwds):
+        """
+        Launch a session of the given kind ('decision' or 'display') with the
+        given arguments (and keyword arguments) and park it, if there is room in the pool (the
+        session of the current item may still be parked until it is taken).
+        """
+        if len(self.parked) > self.size:
+            return
+        if any(pkind == kind and parguments == arguments
+               for pkind, parguments, _ in self.parked):
+            return
+
+        launch = xxdiff_decision if kind == 'decision' else xxdiff_display
+        pool, self.opts.session_pool = self.opts.session_pool, None
+        try:
+            waiter = launch(self.opts, *arguments, nowait=1, deferred=True,
+                            **kwds)
+        finally:
+            self.opts.session_pool = pool
+
+        if callable(waiter):
+            self.parked.append((kind, arguments, waiter))
+
+    def take(self, kind, arguments):
+        """
+        Remove and return the waiter of a parked session with the given kind and
+        arguments, or None if there is none.
+        """
+        arguments = tuple(arguments)
+        for item in self.parked:
+            if item[:2] == (kind, arguments):
+                self.parked.remove(item)
+                waiter = item[2]
+                waiter.wait_processed()
+                return waiter
+        return None
+
+    def close(self):
+        """
+        Kill the sessions that are still parked.
+        """
+        while self.parked:
+            _, _, waiter = self.parked.popleft()
+            if waiter.process.poll() is None:
+                waiter.process.terminate()
+            waiter.process.communicate()
+
+def prelaunch_ahead(iterable, count, launch):
+    """
+    Generator that yields the items of 'iterable', reading up to 'count' items
+    ahead and calling 'launch' on each item as it is read, so that the sessions
+    for the next items can be prelaunched while the current one is reviewed.
+    """
+    pending = deque()
+    for item in iterable:
+        launch(item)
+        pending.append(item)
+        if len(pending) > count:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def review_batch(opts, items, decision=False, viewers=2):
+    """
+    Generator that reviews a batch of files and yields the results of the
+    reviews, in the order of the items.  Each item is a tuple of one to three
+    filenames (left, right and ancestor), optionally followed by a sequence of
+    titles for them, e.g. (left, right, ['old', 'new']).  The results are the
+    same as those of xxdiff_decision() if 'decision' is true, or else the return
+    codes of xxdiff_display().
+
+    Each invocation of xxdiff can only compare a single set of files, so the
+    items are driven through a pool of up to 'viewers' sessions that are opened
+    ahead of the one whose result is awaited: the next items are already loaded
+    when the user is done with the current one.  Sessions that are still open
+    when the generator is closed early are killed.
+    """
+    launch = xxdiff_decision if decision else xxdiff_display
+    pending = deque()
+    try:
+        for item in items:
+            waiter = launch(opts, *batch_arguments(item), nowait=1)
+            pending.append(waiter)
+            if len(pending) >= viewers:
+                yield _batch_result(pending.popleft())
+        while pending:
+            yield _batch_result(pending.popleft())
+    finally:
+        for waiter in pending:
+            if callable(waiter):
+                if waiter.process.poll() is None:
+                    waiter.process.terminate()
+                waiter.process.communicate()
+
+def _batch_result(waiter):
+    """
+    Wait for the given session of a batch and return its result.  The launch may
+    have failed and returned its result already.
+    """
+    return waiter() if callable(waiter) else waiter
+
+def batch_arguments(item):
+    """
+    Return the xxdiff arguments for an item of review_batch().  The ancestor is
+    displayed in the middle.
+    """
+    item = list(item)
+    titles = []
+    if item and not isinstance(item[-1], str):
+        titles = list(item.pop())
+    if not 1 <= len(item) <= 3 or len(titles) > len(item):
+        raise ValueError("Invalid item to review: %r" % (item,))
+
+    # Display position of each of the files.
+    positions = [0, 2, 1] if len(item) == 3 else list(range(len(item)))
+    files = [None] * len(item)
+    topts = []
+    for fn, pos, title in zip(item, positions, titles + [None] * len(item)):
+        files[pos] = fn
+        if title is not None:
+            topts.extend(['--title%d' % (pos+1), title])
+
+    if len(item) == 1:
+        files.insert(0, '--single')
+    return topts + files
+
+
 def title_opts(*titles):
     """
     Generate title options for each of the given titles.  This returns a list of
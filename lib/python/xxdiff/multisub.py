@@ -0,0 +1,233 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+Perform many substitutions in a single pass over a text.
+
+Applying a long list of (from, to) substitutions one after the other scans the
+text once per substitution.  Here, the literal strings to replace are compiled
+into a single regexp that is structured as a trie of their characters, so that
+the regexp engine finds the leftmost-longest match at each position by walking
+the trie, and the replacement is looked up in a table.  Regular expressions are
+combined into a single alternation instead, and the matching alternative
+dispatches to its replacement.
+
+Note that this performs all the substitutions simultaneously: the replaced text
+is never matched again by the other substitutions, unlike when they are applied
+one after the other.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+
+# stdlib imports.
+import re
+
+# xxdiff imports.
+from xxdiff.selectfiles import groupref_re, sre_parse, max_literals
+from xxdiff.selectfiles import _expand_literals
+
+
+class MultiSubstituter(object):
+    """
+    A set of substitutions to perform simultaneously.  The substitutions are
+    given as a list of (compiled regexp, replacement template) pairs.  If
+    'literal' is true, the patterns of the regexps are escaped literal strings,
+    which are searched for with leftmost-longest semantics; otherwise, the first
+    regexp that matches at the leftmost position wins.
+    """
+    def __init__(self, renames, literal):
+        self.renames = list(renames)
+        "The list of (regexp, template) pairs."
+
+        self.table = None
+        "For literal strings, a map of the strings to their replacement."
+
+        self.regexp = None
+        "The combined regexp, or None if the regexps could not be combined."
+
+        if literal:
+            self.table = {}
+            for refrom, sto in self.renames:
+                sfrom = literal_string(refrom)
+                # Expand the template once, the replacement is constant.
+                self.table.setdefault(sfrom, refrom.sub(sto, sfrom))
+            self.regexp = re.compile(trie_pattern(self.table),
+                                     self.renames[0][0].flags)
+        else:
+            self.regexp = combine_alternatives(
+                [refrom for refrom, sto in self.renames])
+
+    def subn(self, text):
+        """
+        Perform the substitutions on the text, and return the new text and the
+        number of substitutions made, like re.subn().
+        """
+        if self.table is not None:
+            table = self.table
+            return self.regexp.subn(lambda mo: table[mo.group(0)], text)
+
+        elif self.regexp is not None:
+            renames = self.renames
+            def dispatch(mo):
+                refrom, sto = renames[int(mo.lastgroup[len(alt_prefix):])]
+                # Rematch with the original regexp to expand its own groups.
+                return refrom.match(mo.string, mo.start()).expand(sto)
+            return self.regexp.subn(dispatch, text)
+
+        else:
+            # The regexps could not be combined, apply them one by one.
+            nbrepl = 0
+            for refrom, sto in self.renames:
+                text, n = refrom.subn(sto, text)
+                nbrepl += n
+            return text, nbrepl
+
+
+def literal_string(regexp):
+    """
+    Return the literal string matched by a regexp compiled from re.escape().
+    """
+    return re.sub(r'\\(.)', r'\1', regexp.pattern, flags=re.DOTALL)
+
+
+def trie_pattern(strings):
+    """
+    Build a regexp pattern that matches any of the given literal strings, as a
+    trie, with the longest match preferred.
+    """
+    trie = {}
+    for s in strings:
+        node = trie
+        for c in s:
+            node = node.setdefault(c, {})
+        node[''] = None
+    return _trie_node_pattern(trie)
+
+def _trie_node_pattern(node):
+    """
+    Build the pattern for the given trie node.
+    """
+    branches = [re.escape(c) + _trie_node_pattern(child)
+                for c, child in sorted(node.items()) if c]
+    if not branches:
+        return ''
+    elif '' in node:
+        # Greedy: try to extend the match before ending it here.
+        return '(?:%s)?' % '|'.join(branches)
+    elif len(branches) == 1:
+        return branches[0]
+    else:
+        return '(?:%s)' % '|'.join(branches)
+
+
+# Prefix of the names of the groups that identify the alternatives.
+alt_prefix = '_xxalt'
+
+def combine_alternatives(regexps):
+    """
+    Combine the given compiled regexps into a single one, with each alternative
+    in a named group identifying it.  Return None if this is not possible (e.g.
+    they use backreferences, conflicting group names or different flags).
+    """
+    flags = set(regexp.flags for regexp in regexps)
+    if len(flags) != 1 or any(groupref_re.search(regexp.pattern)
+                              for regexp in regexps):
+        return None
+    try:
+        return re.compile('|'.join('(?P<%s%d>%s)' % (alt_prefix, i, r.pattern)
+                                   for i, r in enumerate(regexps)),
+                          flags.pop())
+    except (re.error, OverflowError, RecursionError):
+        return None
+
+
+# Regexp to detect scoped case-insensitive flags, e.g. '(?i:abc)'.
+scoped_icase_re = re.compile(r'\(\?[aLmsux]*i')
+
+def required_literals(regexp):
+    """
+    Return a set of literal strings such that any match of the given compiled
+    regexp contains at least one of them, or None if no such set could be found
+    (e.g. if the regexp can match the empty string).
+    """
+    if (regexp.flags & re.IGNORECASE or
+        scoped_icase_re.search(regexp.pattern)):
+        return None
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return None
+    return _required_literals(list(parsed))
+
+def _required_literals(parsed):
+    """
+    Find the best set of required literals for a parsed sequence.  Consecutive
+    items that match finite sets of non-empty strings are joined in runs of
+    literals, and groups and repetitions are searched recursively.
+    """
+    best = None
+    run = {''}
+    for op, av in parsed + [(None, None)]:
+        choices = None
+        if op is not None:
+            choices = _expand_literals([(op, av)])
+            if choices is not None and '' not in choices:
+                newrun = {r + c for r in run for c in choices}
+                if len(newrun) <= max_literals:
+                    run = newrun
+                    continue
+
+        # The current run of literals ends here.
+        if run != {''}:
+            best = _better_literals(best, run)
+        run = {''}
+        if choices is not None and '' not in choices:
+            run = choices
+            continue
+
+        if op is sre_parse.SUBPATTERN and not av[1]:
+            best = _better_literals(best, _required_literals(list(av[-1])))
+        elif op is sre_parse.BRANCH:
+            alternatives = set()
+            for branch in av[1]:
+                literals = _required_literals(list(branch))
+                if literals is None:
+                    break
+                alternatives.update(literals)
+            else:
+                best = _better_literals(best, alternatives)
+        elif (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and
+              av[0] >= 1):
+            best = _better_literals(best, _required_literals(list(av[2])))
+
+    return best
+
+def _better_literals(lit1, lit2):
+    """
+    Return the more selective of two sets of required literals, i.e. the one
+    whose shortest string is the longest.
+    """
+    if lit1 is None or lit2 is None:
+        return lit1 if lit2 is None else lit2
+    return max(lit1, lit2, key=lambda lits: (min(map(len, lits)), -len(lits)))
+
+
+def literal_prefilter(literals, encoding):
+    """
+    Build a compiled bytes regexp that searches for any of the given literal
+    strings in the raw contents of files in the given encoding.  Return None if
+    the literals cannot be searched for in the raw contents, e.g. if the
+    encoding is not compatible with ASCII, or if they contain newlines, which
+    are translated when the files are read as text.
+    """
+    try:
+        if 'ab'.encode(encoding) != b'ab':
+            return None
+        encoded = set(lit.encode(encoding) for lit in literals)
+    except (UnicodeError, LookupError):
+        return None
+    if not all(encoded) or any(b'\n' in lit or b'\r' in lit
+                               for lit in encoded):
+        return None
+    return re.compile(trie_pattern(lit.decode('latin-1')
+                                   for lit in encoded).encode('latin-1'))
@@ -40,7 +40,7 @@ def resilient_for_paths(paths):
     # Compute a unique hash from the given absolute paths.
     comhash = hashlib.md5()
     for p in paths:
-        comhash.update(abspath(p))
+        comhash.update(abspath(p).encode('utf-8'))
     resdir = join(resilient_dir, comhash.hexdigest())
     return resdir
 
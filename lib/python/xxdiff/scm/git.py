@@ -0,0 +1,180 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+Functions for Git.
+
+Note: we read the index file directly rather than spawning git commands, because
+this is used to enumerate the files of large checkouts quickly.  Only the parts
+of the index format that we need are supported (versions 2, 3 and 4, without
+mandatory extensions like split or sparse indexes); use tracked_files() to list
+the files with git otherwise.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+
+# stdlib imports.
+import os, struct
+from os.path import join, isdir, isfile, dirname, abspath
+from subprocess import Popen, PIPE
+
+
+def find_toplevel(path):
+    """
+    Find the top-level directory of the git checkout that contains 'path' and
+    its git directory.  Return a pair of (toplevel, gitdir), or (None, None) if
+    the path is not in a git checkout.
+    """
+    path = abspath(path)
+    while True:
+        dotgit = join(path, '.git')
+        if isdir(dotgit):
+            return path, dotgit
+
+        # Worktrees and submodules have a file pointing to the git directory.
+        elif isfile(dotgit):
+            with open(dotgit, 'r') as f:
+                line = f.readline().strip()
+            if line.startswith('gitdir:'):
+                gitdir = line[len('gitdir:'):].strip()
+                return path, join(path, gitdir)
+
+        parent = dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+def _hash_size(gitdir):
+    """
+    Return the size of the object ids used in the repository.
+    """
+    # Worktrees have a 'commondir' file pointing to the main git directory.
+    commonfn = join(gitdir, 'commondir')
+    if isfile(commonfn):
+        with open(commonfn, 'r') as f:
+            gitdir = join(gitdir, f.read().strip())
+
+    try:
+        with open(join(gitdir, 'config'), 'r') as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if (key.strip().lower() == 'objectformat' and
+                    value.strip().lower() == 'sha256'):
+                    return 32
+    except IOError:
+        pass
+    return 20
+
+
+# Mode of gitlinks (submodules), which are not files in the checkout.
+gitlink_mode = 0o160000
+
+def read_index(gitdir):
+    """
+    Read the index of the given git directory and return the list of paths of
+    the files it contains (relative to the top-level directory, in index order,
+    with each path only once even if it has conflicts).  Raise ValueError if the
+    index uses features that are not supported.
+    """
+    with open(join(gitdir, 'index'), 'rb') as f:
+        data = f.read()
+
+    signature, version, count = struct.unpack_from('>4sLL', data, 0)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise ValueError("Unsupported git index file in '%s'." % gitdir)
+
+    # Offsets of the mode and of the flags within an entry.
+    hash_size = _hash_size(gitdir)
+    mode_offset = 24
+    flags_offset = 40 + hash_size
+
+    paths = []
+    offset = 12
+    prevname = b''
+    for _ in range(count):
+        start = offset
+        mode, = struct.unpack_from('>L', data, start + mode_offset)
+        flags, = struct.unpack_from('>H', data, start + flags_offset)
+        offset = start + flags_offset + 2
+        if version >= 3 and flags & 0x4000:
+            # Extended flags.
+            offset += 2
+
+        if version == 4:
+            # The name is compressed relative to the previous one.
+            strip, offset = _read_varint(data, offset)
+            end = data.index(b'\0', offset)
+            name = prevname[:len(prevname) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            # The name is NUL-padded to a multiple of eight bytes.
+            end = data.index(b'\0', offset)
+            name = data[offset:end]
+            offset = start + ((end - start) // 8 + 1) * 8
+
+        if mode != gitlink_mode and name != prevname:
+            paths.append(os.fsdecode(name))
+        prevname = name
+
+    # Check the extensions, which are followed by the checksum.  Those whose
+    # signature does not start with an uppercase letter must be understood to
+    # read the index correctly (e.g. 'link' for split indexes, 'sdir' for
+    # sparse indexes).
+    end = len(data) - hash_size
+    while offset + 8 <= end:
+        signature, size = struct.unpack_from('>4sL', data, offset)
+        if not b'A' <= signature[:1] <= b'Z':
+            raise ValueError("Unsupported extension '%s' in git index in '%s'."
+                             % (signature.decode('ascii', 'replace'), gitdir))
+        offset += 8 + size
+
+    return paths
+
+def _read_varint(data, offset):
+    """
+    Read a variable-length integer in git's offset encoding.  Return the value
+    and the new offset.
+    """
+    c = data[offset]
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+
+def tracked_files(toplevel, relpath=''):
+    """
+    Return the list of files tracked under 'relpath' in the given checkout,
+    relative to the top-level directory, like read_index() but by spawning a
+    git process, which supports all the index formats.
+    """
+    return _ls_files(toplevel, ['--cached'], relpath, "tracked")
+
+def untracked_files(toplevel, relpath=''):
+    """
+    Return the list of untracked files that are not ignored under 'relpath' in
+    the given checkout, relative to the top-level directory.  This spawns a
+    single git process.
+    """
+    return _ls_files(toplevel, ['--others', '--exclude-standard'], relpath,
+                     "untracked")
+
+def _ls_files(toplevel, options, relpath, kind):
+    """
+    Run 'git ls-files' with the given options and return the list of files.
+    """
+    cmd = (['git', '-C', toplevel, 'ls-files', '-z'] + options +
+           ['--', relpath or '.'])
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        raise SystemExit("Error: running git: %s" % e)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise SystemExit("Error: listing %s files:\n%s" %
+                         (kind, stderr.decode('utf-8', 'replace')))
+    return [os.fsdecode(x) for x in stdout.split(b'\0') if x]
@@ -15,9 +15,10 @@ __author__ = 'Martin Blais <blais@furius.ca>'
 
 
 # stdlib imports.
-import os, tempfile, re
+import os, tempfile, re, shutil, sqlite3, contextlib
+from xml.etree import ElementTree
 from subprocess import Popen, call, PIPE
-from os.path import abspath, isabs
+from os.path import abspath, isabs, isfile, join, dirname, relpath
 
 # xxdiff imports.
 from xxdiff.scripts import script_name, tmpprefix
@@ -76,121 +77,166 @@ def resolve(filename):
 
 class SvnStatus(object):
     """
-    Status result for a file in a subversion repository.
+    Status result for a file in a subversion repository.  The attributes hold
+    the characters of the columns of the 'svn status' output, e.g. 'M' for a
+    modified file.
     """
-
-def status(rootdirs):
+    __slots__ = ('status', 'modprops', 'dirlocked', 'withhist', 'switched',
+                 'locktoken', 'mconflict', 'filename')
+
+    @property
+    def parsed_line(self):
+        "The line that 'svn status' outputs for this file."
+        return '%s%s%s%s%s%s%s %s' % (
+            self.status, self.modprops, self.dirlocked, self.withhist,
+            self.switched, self.locktoken, self.mconflict, self.filename)
+
+
+# Mappings of the values of the XML status attributes to the characters of the
+# first two columns of the text output of 'svn status':
+#
+#   First column: Says if item was added, deleted, or otherwise changed
+#     ' ' no modifications
+#     'A' Added
+#     'C' Conflicted
+#     'D' Deleted
+#     'G' Merged
+#     'I' Ignored
+#     'M' Modified
+#     'R' Replaced
+#     'X' item is unversioned, but is used by an externals definition
+#     '?' item is not under version control
+#     '!' item is missing (removed by non-svn command) or incomplete
+#     '~' versioned item obstructed by some item of a different kind
+#
+#   Second column: Modifications of a file's or directory's properties
+#     ' ' no modifications
+#     'C' Conflicted
+#     'M' Modified
+item_codes = {
+    'none': ' ',
+    'normal': ' ',
+    'added': 'A',
+    'conflicted': 'C',
+    'deleted': 'D',
+    'merged': 'G',
+    'ignored': 'I',
+    'modified': 'M',
+    'replaced': 'R',
+    'external': 'X',
+    'unversioned': '?',
+    'missing': '!',
+    'incomplete': '!',
+    'obstructed': '~',
+    }
+
+props_codes = {
+    'none': ' ',
+    'normal': ' ',
+    'conflicted': 'C',
+    'modified': 'M',
+    }
+
+def iter_status(rootdirs):
     """
-    Obtains the status from all the given root directories.
-    A list of status objects is returned.
+    Obtains the status from all the given root directories.  This is a generator
+    that yields the status objects as 'svn status' outputs them, so that the
+    files can be processed before the status of the entire working copy has
+    been computed.
     """
     if isinstance(rootdirs, str):
         rootdirs = [rootdirs]
     else:
         assert isinstance(rootdirs, (list, tuple))
     if len(rootdirs) == 0:
-        rootdirs.append(os.getcwd())
+        rootdirs = [os.getcwd()]
+
+    # Note: since we specify abspaths we should get abspaths on the output.  We
+    # parse the XML output incrementally, reading whatever is available on the
+    # pipe rather than waiting for large blocks.
+    p = Popen(['svn', 'status', '--xml'] + list(map(abspath, rootdirs)),
+              stdout=PIPE)
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+
+    # The open elements, to remove the entries from their parent ('target' or
+    # 'changelist') once processed, so that memory does not grow with them.
+    stack = []
+    try:
+        while True:
+            data = p.stdout.read1(0x10000)
+            if data:
+                parser.feed(data)
+            else:
+                parser.close()
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem.tag == 'entry':
+                    status = _entry_status(elem)
+                    if stack:
+                        stack[-1].remove(elem)
+                    elem.clear()
+                    yield status
+            if not data:
+                break
+        p.wait()
+    except ElementTree.ParseError as e:
+        raise SystemExit("Error: parsing the output of svn status: %s" % e)
+    finally:
+        # Do not leave svn running if we stop early.
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        p.stdout.close()
 
-    # Note: since we specify abspaths we should get abspaths on the output
-    p = Popen(['svn', 'status'] + list(map(abspath, rootdirs)), stdout=PIPE, text=True)
-    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise SystemExit("Error: running svn status (return code %d)." %
+                         p.returncode)
+
+def _entry_status(elem):
+    """
+    Create a status object from an 'entry' element of the XML output.
+    """
+    wcstatus = elem.find('wc-status')
+    attrib = wcstatus.attrib if wcstatus is not None else {}
 
-    statii = []
-    for line in stdout.splitlines():
-        if not line or re.match('^Performing', line):
-            continue
-
-        status = SvnStatus()
-        status.parsed_line = line
-
-        # The first six columns in the output are each one character wide:
-        lc = iter(line)
-
-        #   First column: Says if item was added, deleted, or otherwise
-        #   changed
-        #     ' ' no modifications
-        #     'A' Added
-        #     'C' Conflicted
-        #     'D' Deleted
-        #     'G' Merged
-        #     'I' Ignored
-        #     'M' Modified
-        #     'R' Replaced
-        #     'X' item is unversioned, but is used by an externals
-        #         definition
-        #     '?' item is not under version control
-        #     '!' item is missing (removed by non-svn command) or incomplete
-        #     '~' versioned item obstructed by some item of a different kind
-        status.status = next(lc)
-
-        #   Second column: Modifications of a file's or directory's
-        #   properties
-        #     ' ' no modifications
-        #     'C' Conflicted
-        #     'M' Modified
-        status.modprops = next(lc)
-
-        #   Third column: Whether the working copy directory is locked
-        #     ' ' not locked
-        #     'L' locked
-        status.dirlocked = next(lc)
-
-        #   Fourth column: Scheduled commit will contain
-        #   addition-with-history
-        #     ' ' no history scheduled with commit
-        #     '+' history scheduled with commit
-        status.withhist = next(lc)
-
-        #   Fifth column: Whether the item is switched relative to its
-        #   parent
-        #     ' ' normal
-        #     'S' switched
-        status.switched = next(lc)
-
-        #   Sixth column: Repository lock token
-        #     (without -u)
-        #     ' ' no lock token
-        #     'K' lock token present
-        #     (with -u)
-        #     ' ' not locked in repository, no lock token
-        #     'K' locked in repository, lock toKen present
-        #     'O' locked in repository, lock token in some Other working
-        #          copy
-        #     'T' locked in repository, lock token present but sTolen
-        #     'B' not locked in repository, lock token present but Broken
-        status.locktoken = next(lc)
-
-        #   Seventh column: Repository lock token
-        #     'C'   (conflict on merged files)
-        #     '>'   (conflict comments)
-        status.mconflict = next(lc)
-        if status.mconflict == '>':
-            continue
-
-        # There is a space and the rest is a filename:
-        status.filename = line[7:].strip()
-        assert isabs(status.filename), (
-            f"Filename {status.filename} is not a path. Check output of svn-foreign.")
-
-        statii.append(status)
+    status = SvnStatus()
+    status.filename = elem.get('path')
+    assert isabs(status.filename), (
+        f"Filename {status.filename} is not a path. Check output of svn-foreign.")
 
+    status.status = item_codes.get(attrib.get('item'), ' ')
+    status.modprops = props_codes.get(attrib.get('props'), ' ')
 
-    # Note: we could parse this information, but this requires server access:
-    # -----------------------------------------------------------------------
-    #   The out-of-date information appears in the eighth column (with -u):
-    #       '*' a newer revision exists on the server
-    #       ' ' the working copy is up to date
-    #
-    #   Remaining fields are variable width and delimited by spaces:
-    #     The working revision (with -u or -v)
-    #     The last committed revision and last committed author (with -v)
-    #     The working copy path is always the final field, so it can
-    #       include spaces.
+    #   Third column: Whether the working copy directory is locked ('L')
+    status.dirlocked = 'L' if attrib.get('wc-locked') == 'true' else ' '
+
+    #   Fourth column: Scheduled commit will contain addition-with-history ('+')
+    status.withhist = '+' if attrib.get('copied') == 'true' else ' '
+
+    #   Fifth column: Whether the item is switched relative to its parent ('S')
+    status.switched = 'S' if attrib.get('switched') == 'true' else ' '
 
-    return statii
+    #   Sixth column: Repository lock token ('K' when present, without -u)
+    status.locktoken = ('K' if wcstatus is not None and
+                        wcstatus.find('lock') is not None else ' ')
 
+    #   Seventh column: Whether the item is the victim of a tree conflict ('C')
+    status.mconflict = 'C' if attrib.get('tree-conflicted') == 'true' else ' '
 
+    # Note: we could parse this information, but this requires server access:
+    # the out-of-date information ('repos-status' element, with -u).
+
+    return status
 
+def status(rootdirs):
+    """
+    Obtains the status from all the given root directories.
+    A list of status objects is returned.
+    """
+    return list(iter_status(rootdirs))
 
 
 def getinfo(filename):
@@ -226,6 +272,82 @@ def cat_revision_temp(filename, revision):
 
 
 
+def find_wcroot(filename):
+    """
+    Find the root directory of the working copy that contains 'filename', i.e.
+    the directory with the administrative database.  Return None if there is
+    none (e.g. for working copies older than Subversion 1.7).
+    """
+    path = dirname(abspath(filename))
+    while True:
+        if isfile(join(path, '.svn', 'wc.db')):
+            return path
+        parent = dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+# Properties that make 'svn cat' translate the text of the pristine copy.
+translating_props = (b'svn:keywords', b'svn:eol-style', b'svn:special')
+
+def pristine_file(filename):
+    """
+    Return the path of the pristine copy of 'filename' in the working copy's
+    pristine store, i.e. its text as of BASE (for copies, the text of their
+    source), or None if it is not available or would not be identical to the
+    output of 'svn cat' (e.g. with keywords to expand).
+    """
+    wcroot = find_wcroot(filename)
+    if wcroot is None:
+        return None
+    local_relpath = relpath(abspath(filename), wcroot).replace(os.sep, '/')
+
+    try:
+        dburi = 'file:%s?mode=ro' % join(wcroot, '.svn', 'wc.db')
+        with contextlib.closing(sqlite3.connect(dburi, uri=True)) as db:
+            row = db.execute(
+                "SELECT n.checksum, n.properties, p.compression "
+                "FROM nodes n JOIN pristine p ON p.checksum = n.checksum "
+                "WHERE n.local_relpath = ? AND n.presence = 'normal' "
+                "ORDER BY n.op_depth DESC LIMIT 1", (local_relpath,)).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+
+    checksum, properties, compression = row
+    if compression or any(prop in (properties or b'')
+                          for prop in translating_props):
+        return None
+    if not checksum.startswith('$sha1$'):
+        return None
+    digest = checksum[len('$sha1$'):]
+    pristine_fn = join(wcroot, '.svn', 'pristine', digest[:2],
+                       '%s.svn-base' % digest)
+    return pristine_fn if isfile(pristine_fn) else None
+
+def base_temp(filename):
+    """
+    Fetches the BASE revision of a file and place it in a temporary file, which
+    is returned.  The text is copied from the pristine store of the working copy
+    if possible, which does not require running 'svn cat'.
+    """
+    pristine_fn = pristine_file(filename)
+    if pristine_fn is None:
+        return cat_revision_temp(filename, 'BASE')
+
+    tmpf = tempfile.NamedTemporaryFile(mode='wb', prefix=tmpprefix)
+    try:
+        with open(pristine_fn, 'rb') as f:
+            shutil.copyfileobj(f, tmpf)
+        tmpf.flush()
+    except IOError:
+        tmpf.close()
+        return cat_revision_temp(filename, 'BASE')
+    return tmpf
+
+
 
 
 def test():
@@ -236,7 +358,7 @@ def test():
     parser = optparse.OptionParser(__doc__.strip())
     opts, args = parser.parse_args()
 
-    for s in status(args[0]):
+    for s in iter_status(args[0]):
         print(s.filename, ':', s.status)
 
 
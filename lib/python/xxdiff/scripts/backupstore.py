@@ -0,0 +1,129 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""xx-backup-store [<options>] list|restore|gc [<args>]
+
+Manage the content-addressed backup store used by the scripts when invoked with
+the '--backup-type=store' option.  Each version of the backed up files is kept
+only once in the store, and each run of a script records the files it backed up
+in a manifest.  The commands are:
+
+  list
+    List the manifests in the store, oldest first, with the number of entries.
+
+  restore <manifest> [<path> ...]
+    Restore the files recorded in the given manifest (a filename, or the name of
+    a manifest in the store) to their original location, or only those under
+    the given paths.  Files that were backed up several times during the run are
+    restored to their first version.
+
+  gc
+    Remove the manifests older than --max-age days, then the oldest manifests
+    until the files they refer to take at most --max-size megabytes, and the
+    stored files that are not referred to anymore.
+"""
+
+__author__ = "Martin Blais <blais@furius.ca>"
+__depends__ = ['xxdiff', 'Python-2.4']
+
+
+# stdlib imports.
+from os.path import *
+
+# xxdiff imports.
+import xxdiff.scripts
+from xxdiff.backupstore import BackupStore, default_store, read_manifest
+
+
+def parse_options():
+    """
+    Parse the options.
+    """
+    import optparse
+    parser = optparse.OptionParser(__doc__.strip())
+
+    parser.add_option('-s', '--store', action='store', metavar='DIR',
+                      default=default_store,
+                      help="The backup store (default: %default).")
+
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help="Print what would be restored or removed, without "
+                      "doing it.")
+
+    parser.add_option('-d', '--dest', '--destination', action='store',
+                      metavar='DIR',
+                      help="Restore the files under the given directory "
+                      "instead of their original location.")
+
+    parser.add_option('--max-age', action='store', type='float',
+                      metavar='DAYS',
+                      help="Remove the manifests older than this (for gc).")
+
+    parser.add_option('--max-size', action='store', type='float',
+                      metavar='MB',
+                      help="Bound the size of the stored files (for gc).")
+
+    xxdiff.scripts.install_autocomplete(parser)
+    opts, args = parser.parse_args()
+
+    if not args or args[0] not in ('list', 'restore', 'gc'):
+        parser.error("you must specify one of the list, restore or gc "
+                     "commands.")
+    command, args = args[0], args[1:]
+
+    if command == 'restore' and not args:
+        parser.error("you must specify the manifest to restore.")
+    elif command != 'restore' and args:
+        parser.error("too many arguments.")
+    if command == 'gc' and opts.max_age is None and opts.max_size is None:
+        parser.error("you must specify --max-age or --max-size for gc.")
+    if command != 'restore' and opts.dest:
+        parser.error("option --dest is only valid for restore.")
+
+    return opts, command, args
+
+
+def backupstore_main():
+    """
+    Main program for backup-store script.
+    """
+    opts, command, args = parse_options()
+    store = BackupStore(opts.store)
+
+    if command == 'list':
+        for manfn in store.manifests():
+            nbentries = sum(1 for _ in read_manifest(manfn))
+            print('%s  (%d entries)' % (manfn, nbentries))
+
+    elif command == 'restore':
+        manfn = args[0]
+        if not exists(manfn) and exists(join(store.mandir, manfn)):
+            manfn = join(store.mandir, manfn)
+        if not exists(manfn):
+            raise SystemExit("Error: manifest '%s' not found." % manfn)
+
+        for path, kind in store.restore(manfn, args[1:], opts.dest,
+                                        opts.dry_run):
+            if kind != 'dir':
+                print('%s: %s' % ('Would restore' if opts.dry_run
+                                  else 'Restored', path))
+
+    elif command == 'gc':
+        max_age = max_size = None
+        if opts.max_age is not None:
+            max_age = opts.max_age * 24 * 3600
+        if opts.max_size is not None:
+            max_size = int(opts.max_size * 1024 * 1024)
+
+        manifests, objects, freed = store.gc(max_age, max_size, opts.dry_run)
+        for manfn in manifests:
+            print('%s: %s' % ('Would remove' if opts.dry_run else 'Removed',
+                              manfn))
+        print('(%d manifests and %d files removed, %.1f MB freed)' %
+              (len(manifests), len(objects), freed / (1024. * 1024.)))
+
+
+def main():
+    xxdiff.scripts.interruptible_main(backupstore_main)
+
+if __name__ == '__main__':
+    main()
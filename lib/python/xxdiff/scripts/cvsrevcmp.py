@@ -208,6 +208,12 @@ def cvsxxdiff_bi_bj(diff_files, prevcounts):
     """
     Compare two relative revision numbers.
     """
+    review_files(bi_bj_items(diff_files, prevcounts))
+
+def bi_bj_items(diff_files, prevcounts):
+    """
+    Generate the items to review for two relative revision numbers.
+    """
     for fn in diff_files:
         print(mkheader(fn))
 
@@ -226,12 +232,19 @@ def cvsxxdiff_bi_bj(diff_files, prevcounts):
         for r in revs:
             print('\n'.join(get_revision_log(fn, r)))
 
-        # Launch xxdiff.
-        xxdiff.invoke.xxdiff_display(
-            opts,
-            '--title1', "%s ( %s )" % (fn, v1),
-            '--title2', "%s ( %s )" % (fn, v2),
-            *[x.name for x in tmpfiles])
+        # Review the files.  The temporary files are kept until xxdiff has
+        # read them, i.e. until the next item is requested.
+        yield (tmpfiles[0].name, tmpfiles[1].name,
+               ["%s ( %s )" % (fn, v1), "%s ( %s )" % (fn, v2)])
+
+def review_files(items):
+    """
+    Review the given items in a batch, with the next one loaded in xxdiff while
+    the current one is being viewed (more with --prelaunch).
+    """
+    viewers = max(2, opts.prelaunch + 1)
+    for _ in xxdiff.invoke.review_batch(opts, items, viewers=viewers):
+        pass
 
 def cvsxxdiff_bi(diff_files, prevcount):
     """
@@ -287,6 +300,12 @@ def cvsxxdiff_ri_rj(diff_files, actions):
     """
     Compare to two absolute revision numbers.
     """
+    review_files(ri_rj_items(diff_files, actions))
+
+def ri_rj_items(diff_files, actions):
+    """
+    Generate the items to review for two absolute revision numbers.
+    """
     revisions = [x[1] for x in actions]
     for fn in diff_files:
         print(mkheader(fn))
@@ -304,12 +323,10 @@ def cvsxxdiff_ri_rj(diff_files, actions):
             for r in revs:
                 print('\n'.join(get_revision_log(fn, r)))
 
-        # Launch xxdiff.
-        xxdiff.invoke.xxdiff_display(
-            opts,
-            '--title1', "%s ( %s )" % (fn, revisions[0]),
-            '--title2', "%s ( %s )" % (fn, revisions[1]),
-            *[x.name for x in tmpfiles])
+        # Review the files.
+        yield (tmpfiles[0].name, tmpfiles[1].name,
+               ["%s ( %s )" % (fn, revisions[0]),
+                "%s ( %s )" % (fn, revisions[1])])
 
 def cvsxxdiff_rep(diff_files):
     """
@@ -102,15 +102,16 @@ def diffproxy_main():
 
     # Decision xxdiff: if we force it or if we have 3 arguments.
     if opts.decision or len(args) == 3:
-        decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(opts, *dargs)
+        decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(
+            opts, inmemory=True, *dargs)
 
         # If the user merged, copy the merged file over the original.
         if decision in ('MERGED', 'ACCEPT'):
-            mergedf.flush()
-            mergedf.seek(0)
-            text = mergedf.read()
+            sys.stdout.flush()
+            merged = mergedf.getbuffer()
+            sys.stdout.buffer.write(merged)
+            merged.release()
             mergedf.close()
-            sys.stdout.write(text)
     
         elif decision in ('NODECISION', 'REJECT'):
             pass # do nothing
@@ -129,8 +129,8 @@ def diff_encrypted(textlist, opts, outmerged=None):
     if opts.recipient is None:
         opts.recipient = get_recipient(textlist[0], opts.gpg)
 
-    # Always create a temporary file for the merged file, we will delete it for
-    # sure, since it would contain decrypted content if saved.
+    # Always capture the merged output in memory, since it would contain
+    # decrypted content if saved to disk.
 
     # Decode the files.
     for i in range(len(textlist)):
@@ -145,7 +145,7 @@ def diff_encrypted(textlist, opts, outmerged=None):
 
     # Spawn xxdiff on the temporary/decoded files.
     waiter = xxdiff.invoke.xxdiff_decision(
-        opts, nowait=1, *[x.name for x in tempfiles])
+        opts, nowait=1, inmemory=True, *[x.name for x in tempfiles])
 
     # Close and automatically delete the temporary/decoded files.
     for f in tempfiles:
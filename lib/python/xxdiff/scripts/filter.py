@@ -11,6 +11,22 @@ filenames (or by default, process all files found), then the given filter
 command is run with the selected file as input and its output captured,
 compared, if the files differ, a graphical diff is presented to ask the user
 whether he wants to apply the changes or not.
+
+Filters with a slow startup (e.g. code formatters) can be kept running as
+coprocesses (see --coprocesses), if they support one of these simple framing
+protocols to receive the contents of the files on their input and write the
+filtered contents on their output:
+
+- 'null': each file is sent followed by a NUL character, and the filter must
+  write the filtered file followed by a NUL character (and flush its output),
+  e.g. 'sed -u -z -e s/foo/bar/g' (files that contain NUL characters are run
+  through the filter once per file instead);
+
+- 'length': each file is sent prefixed by its length in bytes in decimal and a
+  newline, and the filter must write the filtered file in the same format.
+
+Filters that do not support either protocol are run once per file; use the
+--prefetch option to run them ahead of the review and hide their startup time.
 """
 
 __author__ = "Martin Blais <blais@furius.ca>"
@@ -18,9 +34,9 @@ __depends__ = ['xxdiff', 'Python-2.4']
 
 
 # stdlib imports.
-import sys, os, filecmp
+import sys, os, filecmp, threading, queue
 from os.path import *
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
 
 # xxdiff imports.
 import xxdiff.scripts
@@ -36,7 +52,36 @@ class FilterTransformer(xxdiff.xformloop.Transformer):
         xxdiff.xformloop.Transformer.__init__(self, opts)
         self.filtcmd = filtcmd
 
+        if getattr(opts, 'coprocesses', None):
+            self.pool = CoprocessPool(filtcmd, opts.coprocesses, opts.framing)
+        else:
+            self.pool = None
+
+    def close(self):
+        """
+        Terminate the filter coprocesses, if any.
+        """
+        if self.pool is not None:
+            self.pool.close()
+
     def transform(self, fn, outf):
+        # Data that the framing protocol cannot carry goes through the command
+        # run for this file alone.
+        if self.pool is not None:
+            try:
+                with open(fn, 'rb') as inf:
+                    data = inf.read()
+            except IOError as e:
+                raise SystemExit("Error: Could not read file '%s':\n  %s" %
+                                 (fn, e))
+            if self.pool.carries(data):
+                output = self.pool.filter(data)
+
+                # Write the output as is, bypassing the text layer.
+                outf.flush()
+                outf.buffer.write(output)
+                return output != data
+
         # Open input file.
         inf = open(fn, 'r')
 
@@ -59,10 +104,156 @@ class FilterTransformer(xxdiff.xformloop.Transformer):
         return not filecmp.cmp(fn, outf.name)
 
 
+class CoprocessPool(object):
+    """
+    A pool of long-running filter processes, which are fed the files through a
+    framing protocol on their input and output, so that their startup cost is
+    only paid once per process.  This may be used from many threads.  A process
+    that fails is replaced by a new one.
+    """
+    def __init__(self, filtcmd, nbprocs, framing):
+        self.filtcmd, self.framing = filtcmd, framing
+        self.procs = []
+        self.idle = queue.Queue()
+        for _ in range(nbprocs):
+            try:
+                self.idle.put(self._spawn())
+            except OSError as e:
+                raise SystemExit("Error: running filter '%s': %s" %
+                                 (filtcmd, e))
+
+    def _spawn(self):
+        """
+        Start a new filter process and return it.
+        """
+        p = Popen(self.filtcmd, shell=True,
+                  stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        p.pending = b''
+        self.procs.append(p)
+        return p
+
+    def close(self):
+        """
+        Close the inputs of the filter processes and wait for them to exit.
+        """
+        for p in self.procs:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+        for p in self.procs:
+            p.wait()
+
+    def carries(self, data):
+        """
+        Return True if the given data can be sent with the framing protocol.
+        """
+        return self.framing != 'null' or b'\0' not in data
+
+    def filter(self, data):
+        """
+        Run the given data through one of the idle filter processes and return
+        its output.  The data must be supported by the framing protocol (see
+        carries()).
+        """
+        p = self.idle.get()
+        if p is None:
+            # A failed process could not be replaced, let the others know.
+            self.idle.put(None)
+            raise SystemExit("Error: could not restart filter '%s'." %
+                             self.filtcmd)
+
+        writer = None
+        try:
+            if self.framing == 'null':
+                frame = data + b'\0'
+            else:
+                frame = b'%d\n' % len(data) + data
+
+            # Write from another thread, so that the filter never blocks on
+            # writing its output while we are blocked writing its input.
+            writer = threading.Thread(target=self._write, args=(p, frame))
+            writer.start()
+            if self.framing == 'null':
+                output = self._read_until(p, b'\0')[:-1]
+            else:
+                header = self._read_until(p, b'\n')
+                try:
+                    length = int(header)
+                except ValueError:
+                    raise SystemExit("Error: invalid frame header from "
+                                     "filter '%s'." % self.filtcmd)
+                output = self._read_length(p, length)
+            writer.join()
+        except BaseException:
+            # Do not reuse a coprocess that may be out of sync, replace it so
+            # that the other threads do not wait for it forever.
+            p.kill()
+            if writer is not None:
+                writer.join()
+            p.wait()
+            self.procs.remove(p)
+            try:
+                self.idle.put(self._spawn())
+            except OSError:
+                self.idle.put(None)
+            raise
+        self.idle.put(p)
+        return output
+
+    def _write(self, p, frame):
+        try:
+            p.stdin.write(frame)
+            p.stdin.flush()
+        except (IOError, OSError):
+            pass # The reader will notice the missing output.
+
+    def _read_chunk(self, p):
+        chunk = os.read(p.stdout.fileno(), 65536)
+        if not chunk:
+            raise SystemExit("Error: filter '%s' exited unexpectedly." %
+                             self.filtcmd)
+        return chunk
+
+    def _read_until(self, p, delim):
+        buf = p.pending
+        start = 0
+        while True:
+            idx = buf.find(delim, start)
+            if idx != -1:
+                p.pending = buf[idx+1:]
+                return buf[:idx+1]
+            start = len(buf)
+            buf += self._read_chunk(p)
+
+    def _read_length(self, p, length):
+        chunks = [p.pending]
+        size = len(p.pending)
+        while size < length:
+            chunk = self._read_chunk(p)
+            chunks.append(chunk)
+            size += len(chunk)
+        buf = b''.join(chunks)
+        p.pending = buf[length:]
+        return buf[:length]
+
+
 def parse_options():
     import optparse
     parser = optparse.OptionParser(__doc__.strip())
 
+    parser.add_option('--coprocesses', action='store', type='int',
+                      default=0, metavar='N',
+                      help="Keep N filter processes running and feed them "
+                      "the files using the framing protocol selected by "
+                      "--framing, instead of running the filter once per "
+                      "file.")
+
+    parser.add_option('--framing', action='store', type='choice',
+                      choices=('null', 'length'), default='null',
+                      help="Select the framing protocol for the filter "
+                      "coprocesses: 'null' (default) or 'length'.")
+
     opts, args, selector = xxdiff.xformloop.parse_args(parser)
 
     # Check that we got two arguments
@@ -70,6 +261,12 @@ def parse_options():
         parser.error("You must specify a filter command to run on the files.")
     filtcmd = args[0]
 
+    if opts.coprocesses < 0:
+        parser.error("The number of coprocesses must be positive.")
+    if opts.coprocesses and opts.apply_jobs > 1:
+        parser.error("You cannot use filter coprocesses with parallel "
+                     "apply jobs.")
+
     # Force to always perform a diff on output.
     opts.verbose = 2
 
@@ -90,6 +287,7 @@ def filter_main():
         decision_map = xxdiff.xformloop.transform_replace_loop(
             opts, selector, xformer, sys.stdout)
     finally:
+        xformer.close()
         xxdiff.xformloop.postloop_footer(opts)
 
 
@@ -30,21 +30,31 @@ from subprocess import Popen, PIPE
 # xxdiff imports.
 import xxdiff.scripts
 import xxdiff.xformloop
+import xxdiff.sed
+from xxdiff.selectfiles import read_text
 
 
 class GrepSedTransformer(xxdiff.xformloop.Transformer):
     """
     Transformer that greps the file for a regular expression, and if it matches,
     runs it through a sed command.
+
+    Common sed programs are run in-process; the external sed command is only
+    used for programs that are not supported by xxdiff.sed, or if requested.
     """
     def __init__(self, opts, regexp, sedprog):
         xxdiff.xformloop.Transformer.__init__(self, opts)
         self.regexp, self.sedprog = regexp, sedprog
 
+        if getattr(opts, 'external_sed', None):
+            self.sedengine = None
+        else:
+            self.sedengine = xxdiff.sed.compile_sed(sedprog)
+
     def transform(self, fn, outf):
         # Grep the input file.
         try:
-            text = open(fn, 'r').read()
+            text = read_text(fn)
         except IOError as e:
             # Don't bail out if we cannot read a file.
             print("Warning: cannot read file '%s'." % fn, file=sys.stderr)
@@ -59,6 +69,11 @@ class GrepSedTransformer(xxdiff.xformloop.Transformer):
         if self.opts.dry_run and not os.access(fn, os.W_OK):
             raise SystemExit("Error: cannot write to file '%s'." % fn)
 
+        # Perform the sed replacement in-process if possible.
+        if self.sedengine is not None:
+            outf.write(self.sedengine.run(text))
+            return True
+
         # Perform sed replacement to a temporary file
         p = Popen(['sed', '-e', self.sedprog],
                   stdin=PIPE, stdout=outf, stderr=PIPE, text=True)
@@ -78,6 +93,11 @@ class GrepSedTransformer(xxdiff.xformloop.Transformer):
 def parse_options():
     import optparse
     parser = optparse.OptionParser(__doc__.strip())
+
+    parser.add_option('--external-sed', action='store_true',
+                      help="Always run the external sed command, even for "
+                      "programs that can be run in-process.")
+
     opts, args, selector = xxdiff.xformloop.parse_args(parser)
 
     # Check that we got two arguments
@@ -62,20 +62,22 @@ def match_main():
         dn, bn = os.path.split(fn)
         bnmap.setdefault(bn, []).append(fn)
 
-    # Invoke xxdiff's on alphabetical order of the basenames
-    bnkeys = list(bnmap.keys())
-    bnkeys.sort()
-    for bn in bnkeys:
+    # Invoke xxdiff's on alphabetical order of the basenames, with the next one
+    # already loaded while the current one is being viewed.  Note that the files
+    # are given to xxdiff in the order that they show up on the command-line.
+    items = []
+    for bn in sorted(bnmap.keys()):
         filenames = bnmap[bn]
-        if len(filenames) == 2 or len(filenames) == 3:
-            extra = []
-        elif len(filenames) == 1:
-            extra = ['--single']
-        else:
-            # ignore the files.
-            continue
-
-        xxdiff.invoke.xxdiff_display(Opts, *(extra + filenames))
+        if len(filenames) == 3:
+            # The middle file is displayed as the ancestor.
+            left, middle, right = filenames
+            items.append((left, right, middle))
+        elif len(filenames) in (1, 2):
+            items.append(filenames)
+        # else ignore the files.
+
+    for _ in xxdiff.invoke.review_batch(Opts, items):
+        pass
 
 
 def main():
@@ -66,6 +66,8 @@ __depends__ = ['xxdiff', 'Python-2.4', 'diffutils']
 import sys, os
 import shutil
 from tempfile import NamedTemporaryFile
+from subprocess import Popen, PIPE
+from collections import deque
 
 # xxdiff imports
 from xxdiff.scripts import tmpprefix
@@ -116,6 +118,70 @@ def parse_options():
     return opts, args
 
 
+def apply_subpatch(filename, patch, opts):
+    """
+    Apply the patch for a single file to a temporary file.  Return the filename
+    and patch, the output of patch, the temporary file, the stripped filename,
+    the left and right files to display, and the arguments to invoke xxdiff
+    with.
+    """
+    # feed diffs to patch, patch will do its deed and save the output to
+    # a temporary file.
+    tmpfp = NamedTemporaryFile(prefix=tmpprefix)
+
+    popts = opts.patch_options
+    if opts.reverse:
+        popts += ' --reverse'
+    if opts.strip:
+        popts += ' --strip=%d' % opts.strip
+    cmd = 'patch %s --output "%s"' % (popts, tmpfp.name)
+    p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, text=True)
+
+    # read output from patch.
+    output = p.communicate('Index: %s\n' % filename + patch)[0]
+    if p.returncode != 0:
+        print("Error: running patch.", file=sys.stderr)
+
+    # compute stripped filename
+    sfilename = filename
+    if opts.strip:
+        sfilename = os.sep.join(sfilename.split(os.sep)[opts.strip:])
+
+    pno = 2
+    leftfn, rightfn = sfilename, tmpfp.name
+
+###FIXME not finished have to deal with deleted and added files
+
+    # swap files if requested
+    if opts.invert:
+        leftfn, rightfn = rightfn, leftfn
+        pno = 1
+
+    xxargs = ('--title%d' % pno, '%s (patched)' % sfilename, leftfn, rightfn)
+    return (filename, patch, output, tmpfp, sfilename, leftfn, rightfn, xxargs)
+
+
+def apply_ahead(chunks, opts, count):
+    """
+    Generator that applies the subpatches like apply_subpatch(), up to 'count'
+    ahead of the one being reviewed, and prelaunches the xxdiff sessions for
+    them.  A subpatch is not applied until the decisions on the previous ones
+    for the same file have been made, since it applies to the file that results
+    from them.
+    """
+    pool = opts.session_pool
+    pending = deque()
+    for filename, patch in chunks:
+        while pending and (len(pending) > count or
+                           any(a[0] == filename for a in pending)):
+            yield pending.popleft()
+        applied = apply_subpatch(filename, patch, opts)
+        pool.prelaunch('decision', *applied[-1])
+        pending.append(applied)
+    while pending:
+        yield pending.popleft()
+
+
 def patch_main():
     """
     Main program for patch script.
@@ -144,9 +210,18 @@ def patch_main():
         chunks += xxdiff.patches.splitpatch(text)
 
     #
-    # For each subpatch, apply it individually
+    # For each subpatch, apply it individually (ahead of the review of the
+    # previous ones if xxdiff sessions are prelaunched for them)
     #
-    for filename, patch in chunks:
+    pool = opts.session_pool
+    if pool is not None:
+        applied = apply_ahead(chunks, opts, pool.size)
+    else:
+        applied = (apply_subpatch(filename, patch, opts)
+                   for filename, patch in chunks)
+
+    for (filename, patch, output, tmpfp,
+         sfilename, leftfn, rightfn, xxargs) in applied:
         # print patch contents for this file.
         print()
         print()
@@ -155,48 +230,12 @@ def patch_main():
         print(patch)
         print('*' * 40)
 
-        # feed diffs to patch, patch will do its deed and save the output to
-        # a temporary file.
-        tmpfp = NamedTemporaryFile(prefix=tmpprefix)
-
-        popts = opts.patch_options
-        popts += ['--reverse', ''][ opts.reverse == None ]
-        if opts.strip:
-            popts += '--strip=%d' % opts.strip
-        cmd = 'patch %s --output "%s"' % (popts, tmpfp.name)
-        cin, cout = os.popen2(cmd, 'rw')
-        cin.write('Index: %s\n' % filename)
-        cin.write(patch)
-        cin.close()
-
-        # read output from patch.
-        print(cout.read())
-        if cout.close() != None:
-            print("Error: running patch.", file=sys.stderr)
-
-        #
-        # spawn xxdiff
-        #
-
-        # compute stripped filename
-        sfilename = filename
-        if opts.strip:
-            sfilename = os.sep.join(sfilename.split(os.sep)[opts.strip:])
-
-        pno = 2
-        leftfn, rightfn = sfilename, tmpfp.name
-
-###FIXME not finished have to deal with deleted and added files
-
-        # swap files if requested
-        if opts.invert:
-            leftfn, rightfn = rightfn, leftfn
-            pno = 1
+        # print output from patch.
+        print(output)
 
         # Invoke xxdiff.
         decision, mergedf, retcode = xxdiff.invoke.xxdiff_decision(
-            opts, '--title%d' % pno, '%s (patched)' % sfilename,
-            leftfn, rightfn)
+            opts, *xxargs)
 
         # print output of xxdiff command.
         if decision:
@@ -31,58 +31,137 @@ from os.path import *
 # xxdiff imports.
 import xxdiff.scripts
 import xxdiff.xformloop
+from xxdiff.selectfiles import read_text
 
 
 class PylineTransformer(xxdiff.xformloop.Transformer):
     """
-    Transformer that greps the file for a regular expression, and if it matches,
-    runs it through a sed command.
+    Transformer that runs a Python expression on each line of the file, and
+    replaces the line by its result.
+
+    The expression is compiled into a function that loops over the lines, with
+    'line', 'num', 'numz', 'words' and 'fn' as local variables ('words' is only
+    computed if the expression refers to it).  In batch mode, the expression is
+    instead evaluated once per file, with 'lines' and 'fn' as local variables.
     """
     def __init__(self, opts, expr):
         xxdiff.xformloop.Transformer.__init__(self, opts)
 
         # Try to compile the given expression.
         try:
-            self.codeobj = compile(expr, 'command', 'eval')
+            codeobj = compile(expr, 'command', 'eval')
         except Exception:
             raise SystemExit("Error: could not compile expression:\n%s" %
                              traceback.format_exc(limit=0))
 
+        if getattr(opts, 'batch', None):
+            source = batch_template % {'expr': expr}
+        else:
+            if 'words' in code_names(codeobj):
+                words = ("words = [w for w in line.strip().split(' ') "
+                         "if len(w)]")
+            else:
+                words = 'pass'
+            source = line_template % {'expr': expr, 'words': words}
+
+        namespace = {}
+        exec(compile(source, 'command', 'exec'), globals(), namespace)
+        self.func = namespace['_pyl_run']
+
     def transform(self, fn, outf):
         # Open and read input file in memory.
         try:
-            inf = open(fn, 'r')
+            text = read_text(fn)
         except IOError as e:
             raise SystemExit("Error: Could not read file '%s':\n  %s" % (fn, e))
 
-        # Run the code on each line.
-        modified = False
-        for numz, line in enumerate(inf):
-            line = line[:-1]
-            num = numz + 1
-            words = [w for w in line.strip().split(' ') if len(w)]
-            try:
-                result = eval(self.codeobj, globals(), locals())
-            except Exception:
-                raise SystemExit("Error: running expression on line %d:\n%s\n%s"
-                                 % (numz, line, traceback.format_exc(limit=0)))
-
-            if result is None or result is False:
-                modified = True
-                continue
-            elif isinstance(result, list) or isinstance(result, tuple):
-                result = ' '.join(map(str, result))
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+
+        # Run the code on the lines.
+        output, modified = self.func(lines, fn)
+        outf.write(output)
+        return modified
+
+
+# Source of the function that runs the expression on each line.
+line_template = """
+def _pyl_run(_pyl_lines, fn, _pyl_str=str):
+    _pyl_out = []
+    _pyl_append = _pyl_out.append
+    _pyl_modified = False
+    for numz, line in enumerate(_pyl_lines):
+        num = numz + 1
+        %(words)s
+        try:
+            _pyl_result = (
+%(expr)s
+            )
+        except Exception:
+            _pyl_error(numz, line)
+
+        if _pyl_result is None or _pyl_result is False:
+            _pyl_modified = True
+            continue
+        elif _pyl_result.__class__ is not _pyl_str:
+            if isinstance(_pyl_result, (list, tuple)):
+                _pyl_result = ' '.join(map(_pyl_str, _pyl_result))
             else:
-                result = str(result)
+                _pyl_result = _pyl_str(_pyl_result)
 
-            if not modified and line != result:
-                modified = True
+        if _pyl_result != line:
+            _pyl_modified = True
 
-            outf.write(result)
-            if not result.endswith('\n'):
-                outf.write('\n')
+        _pyl_append(_pyl_result)
+        if not _pyl_result.endswith('\\n'):
+            _pyl_append('\\n')
+    return ''.join(_pyl_out), _pyl_modified
+"""
 
-        return modified
+# Source of the function that runs the expression on all the lines at once.
+batch_template = """
+def _pyl_run(lines, fn):
+    _pyl_orig = list(lines)
+    try:
+        _pyl_result = (
+%(expr)s
+        )
+    except Exception:
+        _pyl_error(None, None)
+
+    if _pyl_result is None or _pyl_result is False:
+        _pyl_result = []
+    elif isinstance(_pyl_result, str):
+        return _pyl_result, _pyl_result != ''.join(x + '\\n' for x in _pyl_orig)
+
+    _pyl_result = list(map(str, _pyl_result))
+    _pyl_out = ''.join(x if x.endswith('\\n') else x + '\\n'
+                       for x in _pyl_result)
+    return _pyl_out, _pyl_result != _pyl_orig
+"""
+
+def _pyl_error(numz, line):
+    """
+    Report an error in the evaluation of the expression.
+    """
+    if numz is None:
+        raise SystemExit("Error: running expression:\n%s" %
+                         traceback.format_exc(limit=0))
+    raise SystemExit("Error: running expression on line %d:\n%s\n%s"
+                     % (numz, line, traceback.format_exc(limit=0)))
+
+def code_names(codeobj):
+    """
+    Return the set of names used by the given code object, including in nested
+    code objects (e.g. lambdas and comprehensions).
+    """
+    names = set(codeobj.co_names) | set(codeobj.co_varnames)
+    names |= set(codeobj.co_freevars)
+    for const in codeobj.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= code_names(const)
+    return names
 
 
 def parse_options():
@@ -93,6 +172,12 @@ def parse_options():
                       default=[],
                       help="Import the given module before running the script.")
 
+    parser.add_option('-B', '--batch', action='store_true',
+                      help="Evaluate the expression once per file, with the "
+                      "list of lines (without newlines) in 'lines'.  The "
+                      "result should be a list of lines, or a string for the "
+                      "entire file contents.")
+
     opts, args, selector = xxdiff.xformloop.parse_args(parser)
 
     # Check that we got two arguments
@@ -13,7 +13,11 @@ graphical diff is presented to ask the user whether he wants to apply the
 changes or not.
 
 Note that if you specify multiple from/to pairs as arguments, all the renamings
-will be performed simultaneously, in the order that they are given.
+will be performed one after the other, in the order that they are given.  With
+the --one-pass option, they are instead performed simultaneously in a single
+pass over each file, which is much faster for long lists of renames: literal
+strings are replaced by the leftmost-longest match, and regular expressions by
+the first one that matches at the leftmost position.
 """
 
 __author__ = "Martin Blais <blais@furius.ca>"
@@ -22,13 +26,16 @@ __depends__ = ['xxdiff', 'Python-2.4']
 
 # stdlib imports.
 import sys, os, re
-import logging
+import logging, locale, multiprocessing
 from os.path import *
 
 # xxdiff imports.
 import xxdiff.scripts
 import xxdiff.xformloop
 from xxdiff.utils import idify
+from xxdiff.selectfiles import read_data, read_text
+from xxdiff.multisub import MultiSubstituter, literal_string
+from xxdiff.multisub import required_literals, literal_prefilter
 
 
 class RenameTransformer(xxdiff.xformloop.Transformer):
@@ -63,20 +70,56 @@ class RenameTransformer(xxdiff.xformloop.Transformer):
 
             self.renames.append( (refrom, sto) )
 
+        # Combine the renames for a single pass if requested.
+        if self.opts.one_pass:
+            self.multisub = MultiSubstituter(self.renames, not self.opts.regexp)
+        else:
+            self.multisub = None
+
+        # Build a prefilter that rejects the files that contain none of the
+        # literal strings that any of the renames requires, on their raw
+        # contents, before decoding them.
+        literals = set()
+        for refrom, sto in self.renames:
+            if self.opts.regexp:
+                required = required_literals(refrom)
+            else:
+                required = {literal_string(refrom)}
+            if not required:
+                literals = None
+                break
+            literals.update(required)
+        self.prefilter = (literal_prefilter(literals,
+                                            locale.getpreferredencoding(False))
+                          if literals else None)
+
+        # Counts of the files that passed and were rejected by the prefilter,
+        # in shared memory to include those of the parallel workers.
+        self.prefilter_counts = multiprocessing.Array('L', 2)
+
     def transform(self, fn, outf):
         # Open and read input file in memory.
         try:
-            inf = open(fn, 'r')
-            text = inf.read()
+            data = read_data(fn)
+            if self.prefilter is not None:
+                matched = self.prefilter.search(data) is not None
+                with self.prefilter_counts.get_lock():
+                    self.prefilter_counts[0 if matched else 1] += 1
+                if not matched:
+                    return False
+            text = read_text(fn, data)
         except (IOError, UnicodeDecodeError) as e:
             logging.info("Error: Could not read file '%s':\n  %s", (fn, e))
             return False
 
         # Replace the string or regexp.
-        nbrepl = 0
-        for refrom, sto in self.renames:
-            text, n = refrom.subn(sto, text)
-            nbrepl += n
+        if self.multisub is not None:
+            text, nbrepl = self.multisub.subn(text)
+        else:
+            nbrepl = 0
+            for refrom, sto in self.renames:
+                text, n = refrom.subn(sto, text)
+                nbrepl += n
 
         # If there were no replacements, skip the file.
         if nbrepl == 0:
@@ -85,6 +128,17 @@ class RenameTransformer(xxdiff.xformloop.Transformer):
         outf.write(text)
         return True
 
+    def print_prefilter_stats(self, logs):
+        """
+        Print the counts of files that passed and were rejected by the prefilter.
+        """
+        if self.prefilter is None:
+            return
+        passed, rejected = self.prefilter_counts
+        print(file=logs)
+        print('Prefilter: %d files passed, %d files rejected.' %
+              (passed, rejected), file=logs)
+
 
 def parse_options():
     import optparse
@@ -93,6 +147,11 @@ def parse_options():
     parser.add_option('-R', '--regexp', '--re', action='store_true',
                       help="Interpret <from-string> as a regular expression.")
 
+    parser.add_option('--one-pass', '--simultaneous', action='store_true',
+                      help="Perform all the renames simultaneously in a "
+                      "single pass over each file, rather than one after the "
+                      "other.  This is much faster for many renames.")
+
     ## FIXME: TODO, implement this one day, this would be tremendously cool.
     ##     parser.add_option('-e', '--emacs-case', '--preserve-case',
     ##                       action='store_true',
@@ -138,6 +197,7 @@ def rename_main():
         decision_map = xxdiff.xformloop.transform_replace_loop(
             opts, selector, xformer, sys.stdout)
     finally:
+        xformer.print_prefilter_stats(sys.stdout)
         xxdiff.xformloop.postloop_footer(opts)
 
 def main():
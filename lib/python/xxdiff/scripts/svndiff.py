@@ -12,8 +12,10 @@ __author__ = "Martin Blais <blais@furius.ca>"
 __depends__ = ['xxdiff', 'Python-2.4', 'Subversion']
 
 # stdlib imports.
-import sys, os, tempfile, datetime
+import sys, os, tempfile, datetime, itertools
 from os.path import *
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # xxdiff imports.
 import xxdiff.scripts
@@ -30,12 +32,88 @@ from xxdiff.scm import subversion
 from xxdiff.scripts.svnforeign import query_unregistered_svn_files
 
 
-def review_file(sobj, opts):
+# Number of files whose BASE text is fetched ahead of the file being reviewed,
+# and of threads fetching them.
+prefetch_count = 8
+prefetch_threads = 4
+
+def needs_base(sobj):
+    """
+    Return true if reviewing the given status object requires its BASE text.
     """
-    Check the given status object and if necessary, spawn xxdiff on it.
+    if isdir(sobj.filename):
+        return False
+    return (sobj.status in ('M', 'C', 'D') or
+            (sobj.status == 'A' and sobj.withhist == '+'))
+
+def prefetch_bases(statii, content=False):
+    """
+    Generator that yields pairs of the given status objects and a future for a
+    pair of the temporary file containing their BASE text (or None if it is not
+    needed) and, if 'content' is true, their content history item.  These are
+    computed by a pool of threads, ahead of the file being reviewed, so that
+    they are ready by the time the user gets to it.
+    """
+    executor = ThreadPoolExecutor(prefetch_threads)
+    pending = deque()
+    try:
+        for s in statii:
+            future = None
+            if content and not isdir(s.filename):
+                future = executor.submit(prefetch, s, True)
+            elif needs_base(s):
+                future = executor.submit(prefetch, s, False)
+            pending.append((s, future))
+            if len(pending) > prefetch_count:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown()
+
+def prefetch(sobj, content):
+    """
+    Fetch the BASE text of the given status object if needed and compute its
+    content history item if 'content' is true.  Return the pair of them.
+    """
+    base = subversion.base_temp(sobj.filename) if needs_base(sobj) else None
+    histitem = None
+    if content:
+        histitem = content_histitem(sobj, base)
+    return base, histitem
+
+def content_histitem(sobj, base):
+    """
+    Compute a history item for the given status object from the contents of its
+    BASE and working files (given the temporary file of the BASE text), which
+    does not depend on the location of the working copy.
+    """
+    wcroot = subversion.find_wcroot(sobj.filename)
+    if wcroot is not None:
+        fn = relpath(sobj.filename, wcroot).replace(os.sep, '/')
+    else:
+        fn = sobj.filename
+    digest = xxdiff.history.content_digest(
+        base.name if base is not None else None,
+        sobj.filename if isfile(sobj.filename) else None)
+    return ' '.join(('content', digest, sobj.status, fn))
+
+def review_file(sobj, opts, base=None):
+    """
+    Check the given status object and if necessary, spawn xxdiff on it.  'base'
+    is a future for the temporary file containing the BASE text of the file (see
+    prefetch_bases()), if it has been prefetched.
 
     Return a pair of ((file type description, action) waiter-object).
     """
+    def base_temp():
+        if base is not None:
+            return base.result()[0]
+        return subversion.base_temp(sobj.filename)
+
     msg = ('normal', 'display')
     dopts = []
     merged = sobj.filename
@@ -47,7 +125,7 @@ def review_file(sobj, opts):
 
         # Diff modified files
         if sobj.status in ('M', 'C'):
-            tmpf = subversion.cat_revision_temp(sobj.filename, 'BASE')
+            tmpf = base_temp()
             left, right = tmpf.name, sobj.filename
 
             dopts.extend(title_opts('%s (BASE)' % sobj.filename))
@@ -65,7 +143,7 @@ def review_file(sobj, opts):
                 from_url, from_rev = [info.get('Copied From %s' % x, None)
                                       for x in ['URL', 'Rev']]
 
-                tmpf = subversion.cat_revision_temp(sobj.filename, 'BASE')
+                tmpf = base_temp()
                 dopts.extend(title_opts('%s (%s)' % (from_url, from_rev)))
             else:
                 tmpf = tempfile.NamedTemporaryFile(mode='w', prefix=tmpprefix)
@@ -75,7 +153,7 @@ def review_file(sobj, opts):
 
         # Diff deleted files
         elif sobj.status == 'D':
-            tmpf = subversion.cat_revision_temp(sobj.filename, 'BASE')
+            tmpf = base_temp()
             tmpf_empty = tempfile.NamedTemporaryFile(mode='w', prefix=tmpprefix)
 
             dopts.extend(title_opts('%s (BASE)' % sobj.filename,
@@ -94,7 +172,8 @@ def review_file(sobj, opts):
         pass
 
     # Check for non-text files.
-    if not xxdiff.utils.istextfile(left) or not xxdiff.utils.istextfile(right):
+    if not all(xxdiff.utils.istextfile(fn, opts.use_file_command)
+               for fn in (left, right)):
         return ('non-text', 'skip'), None
 
     # Run xxdiff on the files.
@@ -145,6 +224,11 @@ def parse_options():
                       "unregistered files and ask the user one by one about "
                       "what to do with them.")
 
+    parser.add_option('--use-file-command', action='store_true',
+                      help="Use the 'file' utility to tell text from binary "
+                      "files, instead of looking at their contents "
+                      "directly.")
+
     for mod in xxdiff.invoke, xxdiff.history:
         mod.options_graft(parser)
     xxdiff.backup.options_graft(parser,
@@ -198,19 +282,19 @@ def svndiff_main():
         print()
         print()
 
-    # Get the status of the working copy.
-    statii = subversion.status(args)
+    # Get the status of the working copy.  The files are reviewed as the status
+    # is output, so we only wait for the first one here.
+    statii = subversion.iter_status(args)
 
     # Ignore the comments file from the svn status output.
-    statii = [s for s in statii if abspath(s.filename) not in ignofiles]
+    statii = (s for s in statii if abspath(s.filename) not in ignofiles)
 
-    if not statii:
+    first = next(statii, None)
+    if first is None:
         print('(Nothing to do, exiting.)')
         hist.delete()
         return
-
-    # First print out the status to a string.
-    renstatus = os.linesep.join(x.parsed_line for x in statii)
+    statii = itertools.chain([first], statii)
 
     if opts.commit:
         # File to delete after a successful commit.
@@ -227,22 +311,21 @@ def svndiff_main():
     # Spawn an editor if requested before starting the review.
     if opts.commit:
         m = {'date': datetime.datetime.now()}
-        comments = None # renstatus
+        comments = None
         edit_waiter = xxdiff.editor.spawn_editor(comments, filename=comfn)
 
-    # First print out the status to the user.
-    print('Status Of Files To Be Diffed')
-    print('----------------------------')
-    print(renstatus)
-
-    # Then we start printing each file and the associated decision.
+    # Print each file with its status and the associated decision.
     msgfmt = '  %-10s | %-10s | %s'
     print()
     print(msgfmt % ('Type', 'Action', 'Status'))
     print(msgfmt % ('-'*10, '-'*10, '-'*40))
 
     # Main loop for graphical diffs, over each of the files reported by status.
-    for s in statii:
+    # The displayed files are waited for after up to 'prelaunch' of the next
+    # files have been launched, so that they are ready when the user gets to
+    # them.
+    pending = deque()
+    for s, base in prefetch_bases(statii, opts.content_history):
         kind, action = 'unknown', 'exception' # Initialize for in case of an
                                               # exception.
         try:
@@ -255,14 +338,18 @@ def svndiff_main():
                 continue
 
             # Compute unique string for history recorder.  We use the size, last
-            # modification time, and status info to hash on this.
-            if exists(s.filename):
-                fstat = os.lstat(s.filename)
-                sz, mtime = fstat.st_size, fstat.st_mtime
+            # modification time, and status info to hash on this, or the
+            # contents of the files if requested.
+            if opts.content_history:
+                histitem = base.result()[1]
             else:
-                # Deal with files that have been deleted.
-                sz, mtime = 0, 0
-            histitem = ' '.join((str(sz), str(mtime), s.parsed_line))
+                if exists(s.filename):
+                    fstat = os.lstat(s.filename)
+                    sz, mtime = fstat.st_size, fstat.st_mtime
+                else:
+                    # Deal with files that have been deleted.
+                    sz, mtime = 0, 0
+                histitem = ' '.join((str(sz), str(mtime), s.parsed_line))
 
             # If the file has already been reviewed in the history, skip it.
             if hist.check(histitem):
@@ -270,14 +357,25 @@ def svndiff_main():
                 continue
 
             # Review the file.
-            (kind, action), waiter = review_file(s, opts)
+            (kind, action), waiter = review_file(s, opts, base)
         finally:
             print(msgfmt % (kind, action, s.parsed_line))
 
-        if waiter is not None:
+        if waiter is None:
+            # We have succesfully finished viewing the file, add it to the
+            # history.
+            hist.append(histitem)
+            continue
+
+        pending.append((waiter, histitem))
+        while len(pending) > opts.prelaunch:
+            waiter, histitem = pending.popleft()
             waiter()
+            hist.append(histitem)
 
-        # We have succesfully finished viewing the file, add it to the history.
+    while pending:
+        waiter, histitem = pending.popleft()
+        waiter()
         hist.append(histitem)
 
     # Commit the files if requested.
@@ -342,7 +342,8 @@ def query_unregistered_svn_files(filenames, opts, output=sys.stdout,
                 elif c == 'd': # Delete
                     # Do backups if requested.
                     if backup is not None:
-                        backupfn = backup.backup_file(fn, opts, output)
+                        backupfn = backup.backup_file(fn, opts, output,
+                                                      unlinked=True)
                         if backupfn:
                             write("Backed up to: '%s'\n" % backupfn)
                     elif opts.verbose >= 1:
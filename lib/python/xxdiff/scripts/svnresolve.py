@@ -78,18 +78,16 @@ def svnresolve_main():
     """
     opts, args = parse_options()
 
-    # Get the status of the working copy.
-    statii = subversion.status(args)
-
-    # First print out the list/status of the conflicting files to the user.
-    for s in select_conflicts(statii):
-        print(s.parsed_line)
-    print()
+    # Get the status of the working copy.  The conflicts are resolved as the
+    # status is output.
+    statii = subversion.iter_status(args)
 
     logs = sys.stdout
 
     # For each of the files reported by status
     for s in select_conflicts(statii):
+        # Print out the status of the conflicting file to the user.
+        print(s.parsed_line)
 
         # Get the three files before the merge conflicts.
         info = subversion.getinfo(s.filename)
@@ -0,0 +1,659 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+An in-process implementation of a common subset of sed programs.
+
+This is used to avoid running a sed subprocess for each file that is processed.
+The supported subset is:
+
+- commands 's' (with flags 'g', 'p', 'i'/'I' and a number), 'd' and 'p',
+  separated by newlines or semicolons;
+
+- addresses made of a line number, '$' or a regular expression ('/re/' or
+  '\\cREc', optionally followed by 'I'), ranges of two of these, and negation
+  with '!';
+
+- basic regular expressions, with the GNU extensions ('\\+', '\\?', '\\|',
+  '\\w', '\\s', '\\b', '\\<', '\\>', etc.).
+
+compile_sed() returns None for programs outside of this subset, so that the
+caller can fall back on running the external sed command.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+
+# stdlib imports.
+import re
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+class SedError(Exception):
+    """
+    Raised when a sed program cannot be compiled by this module.
+    """
+
+
+def compile_sed(prog):
+    """
+    Compile the given sed program.  Return a SedProgram, or None if the program
+    uses features that are not supported.
+    """
+    try:
+        return SedProgram(prog)
+    except SedError:
+        return None
+
+
+class SedProgram(object):
+    """
+    A compiled sed program, which can be run on text.
+    """
+    def __init__(self, prog):
+        self.commands = _Parser(prog).parse()
+        "The list of compiled commands."
+
+        self.simple = all(isinstance(cmd, _Substitute) and cmd.addr1 is None
+                          and not cmd.printflag and not cmd.newline
+                          for cmd in self.commands)
+        """True if the program is only made of substitutions that apply to all
+        lines and do not change the line structure, which can be run on the
+        entire text one command at a time."""
+
+    def run(self, text):
+        """
+        Run the program on the given text and return the output text, like
+        'sed -e <prog>' would.
+        """
+        if self.simple:
+            for cmd in self.commands:
+                text = cmd.substitute_text(text)
+            return text
+
+        out = []
+        missing_newline = [False]
+
+        def output(line, newline):
+            if missing_newline[0]:
+                out.append('\n')
+                missing_newline[0] = False
+            out.append(line)
+            if newline:
+                out.append('\n')
+            else:
+                missing_newline[0] = True
+
+        # Note: sed only splits lines on newlines.
+        lines = text.split('\n')
+        final_newline = lines[-1] == ''
+        if final_newline:
+            lines.pop()
+        nblines = len(lines)
+        for cmd in self.commands:
+            cmd.reset()
+
+        for idx, line in enumerate(lines):
+            num = idx + 1
+            last = num == nblines
+            newline = final_newline or not last
+
+            deleted = False
+            for cmd in self.commands:
+                if not cmd.selects(line, num, last):
+                    continue
+                if cmd.name == 'd':
+                    deleted = True
+                    break
+                elif cmd.name == 'p':
+                    output(line, newline)
+                else:
+                    line, replaced = cmd.substitute(line)
+                    if replaced and cmd.printflag:
+                        output(line, newline)
+
+            if not deleted:
+                output(line, newline)
+
+        return ''.join(out)
+
+
+class _Address(object):
+    """
+    A single address: a line number, the last line, or a regexp.
+    """
+    def __init__(self, line=None, last=False, regexp=None):
+        self.line, self.last, self.regexp = line, last, regexp
+
+    def matches(self, line, num, last):
+        if self.regexp is not None:
+            return self.regexp.search(line) is not None
+        elif self.last:
+            return last
+        else:
+            return num == self.line
+
+
+class _Command(object):
+    """
+    A command with its optional address or address range.
+    """
+    def __init__(self, name, addr1=None, addr2=None, negate=False):
+        self.name = name
+        self.addr1, self.addr2, self.negate = addr1, addr2, negate
+        self.reset()
+
+    def reset(self):
+        self.inrange = False
+
+    def selects(self, line, num, last):
+        """
+        Return True if this command applies to the given line.
+        """
+        if self.addr1 is None:
+            selected = True
+        elif self.addr2 is None:
+            selected = self.addr1.matches(line, num, last)
+        elif self.inrange:
+            # The range ends on the line matching the second address, or right
+            # away if it is a line number that we have already passed.
+            selected = True
+            addr2 = self.addr2
+            if addr2.line is not None and not addr2.last:
+                if num >= addr2.line:
+                    self.inrange = False
+            elif addr2.matches(line, num, last):
+                self.inrange = False
+        elif self.addr1.matches(line, num, last):
+            selected = True
+            addr2 = self.addr2
+            if addr2.line is not None and not addr2.last:
+                self.inrange = addr2.line > num
+            else:
+                self.inrange = not (addr2.last and last)
+        else:
+            selected = False
+        return selected != self.negate
+
+
+class _Substitute(_Command):
+    """
+    An 's' command.
+    """
+    def __init__(self, regexp, template, newline, globalflag, occurrence,
+                 printflag, *args):
+        _Command.__init__(self, 's', *args)
+        self.regexp, self.template = regexp, template
+        self.newline = newline
+        self.globalflag, self.occurrence = globalflag, occurrence
+        self.printflag = printflag
+
+        self.mlregexp = re.compile(regexp.pattern,
+                                   (regexp.flags | re.MULTILINE) & ~re.DOTALL)
+
+        # If the regexp cannot match the empty string, Python's rules for
+        # substitutions are the same as sed's and we can let re do the work.
+        self.count = None
+        if self.occurrence == 1:
+            parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+            if parsed.getwidth()[0] > 0:
+                self.count = 0 if globalflag else 1
+
+    def substitute_text(self, text):
+        """
+        Perform the substitution on all the lines of the given text.  The regexp
+        is searched on the entire text to find the lines that may match quickly
+        (any match within a line is also a match in the entire text), and only
+        these are processed.
+        """
+        out = []
+        pos = 0
+        length = len(text)
+        while True:
+            mo = self.mlregexp.search(text, pos)
+            if mo is None:
+                break
+            bol = text.rfind('\n', 0, mo.start()) + 1
+            if bol >= length:
+                break
+            eol = text.find('\n', mo.start())
+            if eol == -1:
+                eol = length
+            out.append(text[pos:bol])
+            out.append(self.substitute(text[bol:eol])[0])
+            pos = eol
+            if pos >= length:
+                break
+
+            # Search from the next line.
+            out.append('\n')
+            pos += 1
+        out.append(text[pos:])
+        return ''.join(out)
+
+    def substitute(self, line):
+        """
+        Perform the substitution on the line, following sed's rules for empty
+        matches.  Return the new line and whether a replacement was made.
+        """
+        if self.count is not None:
+            line, nbrepl = self.regexp.subn(self.template, line, self.count)
+            return line, nbrepl > 0
+
+        out = []
+        pos = 0
+        prev_end = -1
+        count = 0
+        replaced = False
+        length = len(line)
+        while pos <= length:
+            mo = self.regexp.search(line, pos)
+            if mo is None:
+                break
+            start, end = mo.span()
+
+            # An empty match right after the previous match is not a match.
+            if start == end == prev_end:
+                if start >= length:
+                    break
+                out.append(line[pos:start+1])
+                pos = start + 1
+                continue
+
+            count += 1
+            out.append(line[pos:start])
+            if count >= self.occurrence:
+                out.append(mo.expand(self.template))
+                replaced = True
+            else:
+                out.append(mo.group(0))
+            pos = prev_end = end
+
+            if replaced and not self.globalflag:
+                break
+
+            # Skip over a character after an empty match.
+            if start == end:
+                if end >= length:
+                    break
+                out.append(line[end])
+                pos = end + 1
+
+        if not replaced:
+            return line, False
+        out.append(line[pos:])
+        return ''.join(out), True
+
+
+# Translation of POSIX character classes to Python sets.
+posix_classes = {
+    'alpha': 'a-zA-Z',
+    'digit': '0-9',
+    'alnum': 'a-zA-Z0-9',
+    'upper': 'A-Z',
+    'lower': 'a-z',
+    'xdigit': '0-9A-Fa-f',
+    'space': ' \\t\\n\\r\\f\\v',
+    'blank': ' \\t',
+    'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+    }
+
+# Escapes with the same meaning in GNU sed and in Python.
+same_escapes = 'wWsSbB.*[]\\^$/nt'
+
+# Escapes that are special in basic regexps and not in Python.
+bre_escapes = {'(': '(', ')': ')', '{': '{', '}': '}', '+': '+', '?': '?',
+               '|': '|', '<': '\\b(?=\\w)', '>': '\\b(?<=\\w)'}
+
+class _Parser(object):
+    """
+    A parser for the supported subset of sed programs.
+    """
+    def __init__(self, prog):
+        self.prog = prog
+        self.pos = 0
+
+    def error(self, msg='unsupported sed program'):
+        raise SedError(msg)
+
+    def peek(self):
+        return self.prog[self.pos] if self.pos < len(self.prog) else ''
+
+    def next(self):
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def skip_blanks(self):
+        while self.peek() in (' ', '\t') and self.peek():
+            self.pos += 1
+
+    def parse(self):
+        commands = []
+        while True:
+            # Skip separators.
+            while self.peek() and self.peek() in ' \t\n;':
+                self.pos += 1
+            if not self.peek():
+                break
+            commands.append(self.parse_command())
+
+            self.skip_blanks()
+            if self.peek() and self.peek() not in '\n;':
+                self.error()
+        return commands
+
+    def parse_command(self):
+        addr1 = self.parse_address()
+        addr2 = None
+        if addr1 is not None and self.peek() == ',':
+            self.pos += 1
+            addr2 = self.parse_address()
+            if addr2 is None:
+                self.error()
+        self.skip_blanks()
+        negate = False
+        if self.peek() == '!':
+            negate = True
+            self.pos += 1
+            self.skip_blanks()
+
+        name = self.next()
+        if name in ('d', 'p'):
+            return _Command(name, addr1, addr2, negate)
+        elif name == 's':
+            return self.parse_substitute(addr1, addr2, negate)
+        else:
+            self.error()
+
+    def parse_address(self):
+        c = self.peek()
+        if c.isdigit():
+            start = self.pos
+            while self.peek().isdigit():
+                self.pos += 1
+            line = int(self.prog[start:self.pos])
+            if line == 0 or self.peek() == '~':
+                self.error()
+            return _Address(line=line)
+        elif c == '$':
+            self.pos += 1
+            return _Address(last=True)
+        elif c in ('/', '\\'):
+            self.pos += 1
+            if c == '\\':
+                c = self.next()
+                if not c or c in '\n\\':
+                    self.error()
+            regexp = self.read_delimited(c)
+            flags = 0
+            if self.peek() == 'I':
+                self.pos += 1
+                flags = re.IGNORECASE
+            return _Address(regexp=self.compile_regexp(regexp, c, flags))
+        return None
+
+    def read_delimited(self, delim):
+        """
+        Read up to the next unescaped delimiter, and return the text in between
+        (with the escapes left as they are).
+        """
+        start = self.pos
+        while True:
+            c = self.next()
+            if not c or c == '\n':
+                self.error('unterminated sed command')
+            if c == '\\':
+                if not self.peek():
+                    self.error('unterminated sed command')
+                self.pos += 1
+            elif c == delim:
+                return self.prog[start:self.pos-1]
+
+    def parse_substitute(self, addr1, addr2, negate):
+        delim = self.next()
+        if not delim or delim in '\n\\':
+            self.error()
+        regexp = self.read_delimited(delim)
+        template = self.read_delimited(delim)
+
+        globalflag, occurrence, printflag, flags = False, 1, False, 0
+        while True:
+            c = self.peek()
+            if c == 'g' and not globalflag:
+                globalflag = True
+            elif c == 'p' and not printflag:
+                printflag = True
+            elif c in ('i', 'I'):
+                flags = re.IGNORECASE
+            elif c.isdigit() and occurrence == 1:
+                start = self.pos
+                while self.peek().isdigit():
+                    self.pos += 1
+                occurrence = int(self.prog[start:self.pos])
+                if occurrence == 0:
+                    self.error()
+                continue
+            else:
+                break
+            self.pos += 1
+
+        regexp = self.compile_regexp(regexp, delim, flags)
+        template, newline = self.translate_template(template, delim)
+        for ref in re.findall(r'\\g<(\d)>', template):
+            if int(ref) > regexp.groups:
+                self.error("invalid reference \\%s on s command's RHS" % ref)
+
+        # 'Ng' combinations replace the Nth match and all the following ones.
+        return _Substitute(regexp, template, newline, globalflag, occurrence,
+                           printflag, addr1, addr2, negate)
+
+    def compile_regexp(self, bre, delim, flags):
+        """
+        Translate a basic regular expression into a compiled Python regexp.
+        """
+        if not bre:
+            # The empty regexp refers to the last one used.
+            self.error()
+        try:
+            # In sed, '.' also matches the newlines inserted by substitutions.
+            return re.compile(translate_bre(bre, delim), flags | re.DOTALL)
+        except re.error:
+            self.error()
+
+    def translate_template(self, template, delim):
+        """
+        Translate a sed replacement into a Python template for Match.expand().
+        Return the template, and whether it inserts newlines.
+        """
+        out = []
+        newline = False
+        it = iter(template)
+        for c in it:
+            if c == '&':
+                out.append('\\g<0>')
+            elif c == '\\':
+                c = next(it)
+                if c.isdigit():
+                    out.append('\\g<%s>' % c)
+                elif c == 'n':
+                    out.append('\\n')
+                    newline = True
+                elif c == 't':
+                    out.append('\\t')
+                elif c in ('&', '\\', delim, '\n'):
+                    out.append(c.replace('\\', '\\\\'))
+                    newline = newline or c == '\n'
+                else:
+                    # E.g. case conversions '\\U', '\\L', etc.
+                    self.error()
+            else:
+                out.append(c)
+        return ''.join(out), newline
+
+
+def translate_bre(bre, delim='/'):
+    """
+    Translate the given basic regular expression (with GNU extensions) into a
+    Python regular expression.  Raise SedError if this is not possible.
+    """
+    out = []
+    i, n = 0, len(bre)
+
+    # True when at the start of the regexp or a subexpression or alternative,
+    # where '*' is literal and '^' is an anchor.
+    atstart = True
+    while i < n:
+        c = bre[i]
+        i += 1
+        if c == '\\' and bre[i] == delim:
+            # Like GNU sed, an escaped delimiter stands for the plain character.
+            c = delim
+            i += 1
+        elif c == '\\':
+            c = bre[i]
+            i += 1
+            if c in bre_escapes:
+                out.append(bre_escapes[c])
+                if c in '(|':
+                    atstart = True
+                    continue
+            elif c in same_escapes:
+                out.append('\\' + c)
+            elif c.isdigit() and c != '0':
+                out.append('\\' + c)
+            else:
+                raise SedError("unsupported escape '\\%s'" % c)
+            atstart = False
+            continue
+
+        if c == '[':
+            # Copy the bracket expression, translating its contents.
+            j = i
+            if j < n and bre[j] == '^':
+                j += 1
+            if j < n and bre[j] == ']':
+                j += 1
+            parts = ['[']
+            if bre[i:j]:
+                parts.append(bre[i:j].replace(']', '\\]'))
+            while True:
+                if j >= n:
+                    raise SedError("unterminated bracket expression")
+                c = bre[j]
+                if c == ']':
+                    j += 1
+                    break
+                if bre.startswith('[:', j):
+                    end = bre.find(':]', j+2)
+                    if end == -1 or bre[j+2:end] not in posix_classes:
+                        raise SedError("unsupported character class")
+                    parts.append(posix_classes[bre[j+2:end]])
+                    j = end + 2
+                    continue
+                if bre.startswith('[.', j) or bre.startswith('[=', j):
+                    raise SedError("unsupported collating element")
+                if c == '\\' and j+1 < n and bre[j+1] in 'nt':
+                    # GNU sed translates these escapes in brackets too.
+                    parts.append('\\' + bre[j+1])
+                    j += 2
+                    continue
+                if c in '\\[&~|':
+                    parts.append('\\' + c)
+                else:
+                    parts.append(c)
+                j += 1
+            parts.append(']')
+            out.append(''.join(parts))
+            i = j
+        elif c == '*' and atstart:
+            out.append('\\*')
+        elif c == '^':
+            out.append('^' if atstart else '\\^')
+        elif c == '$':
+            # Only an anchor at the end of the regexp or subexpression.
+            if i == n or bre.startswith('\\)', i) or bre.startswith('\\|', i):
+                out.append('$')
+            else:
+                out.append('\\$')
+        elif c in '(){}+?|':
+            out.append('\\' + c)
+        else:
+            out.append(re.escape(c) if c not in '.*' else c)
+        atstart = False
+
+    return ''.join(out)
+
+
+# Programs and inputs checked against the external sed command by test().
+test_cases = [
+    (r's/a/x\ny/;s/^y/Z/', 'ar\n'),
+    (r's/a/x\ny/;s/x$/Q/', 'ar\na\n'),
+    (r's/a/x\ny/;s/x.y/D/', 'ab\n'),
+    ('s/a/x\\\ny/;s/^y/Z/', 'ar\n'),
+    (r's/a/x\\ny/;s/^y/Z/', 'ar\nyes\n'),
+    (r's/a/b/g;s/^b*$/-/', 'aaa\nab\n'),
+    (r's/\</X/g', 'foo bar\n'),
+    (r's/\>/X/g', 'foo bar\n'),
+    (r's/[\n]/N/g', 'trailing\n'),
+    (r's/[\t]/T/g', 'a\tb t\n'),
+    (r's/a/x\ny/;s/[\n]/N/', 'ar\n'),
+    (r's/[\/]/S/g', 'a/b\\c\n'),
+    (r's/[\\]/B/g', 'a/b\\c\n'),
+    ]
+
+def test():
+    """
+    Test and benchmark the in-process engine against the external sed command,
+    with the files and sed program given on the command-line, or check the
+    test cases above if none are given.
+    """
+    import sys, time, optparse
+    from subprocess import Popen, PIPE
+    parser = optparse.OptionParser('%prog [<sed-prog> <file> [<file> ...]]')
+    opts, args = parser.parse_args()
+    if not args:
+        failed = 0
+        for prog, text in test_cases:
+            p = Popen(['sed', '-e', prog], stdin=PIPE, stdout=PIPE, text=True)
+            extout = p.communicate(text)[0]
+            sedprog = compile_sed(prog)
+            out = sedprog.run(text) if sedprog is not None else extout
+            if out != extout:
+                print('Differs: %r on %r: %r instead of %r' %
+                      (prog, text, out, extout))
+                failed += 1
+        print('%d of %d test cases differ.' % (failed, len(test_cases)))
+        sys.exit(1 if failed else 0)
+    if len(args) < 2:
+        parser.error("You must specify a sed program and some files.")
+    prog, filenames = args[0], args[1:]
+
+    sedprog = compile_sed(prog)
+    if sedprog is None:
+        raise SystemExit("Program not supported in-process: %s" % prog)
+
+    texts = [open(fn, 'r').read() for fn in filenames]
+
+    t = time.time()
+    outputs = [sedprog.run(text) for text in texts]
+    tinproc = time.time() - t
+
+    t = time.time()
+    extoutputs = []
+    for text in texts:
+        p = Popen(['sed', '-e', prog], stdin=PIPE, stdout=PIPE, text=True)
+        extoutputs.append(p.communicate(text)[0])
+    texternal = time.time() - t
+
+    for fn, out, extout in zip(filenames, outputs, extoutputs):
+        if out != extout:
+            print('Differs: %s' % fn)
+    print('In-process: %.3fs' % tinproc)
+    print('External:   %.3fs' % texternal)
+
+
+if __name__ == '__main__':
+    test()
@@ -10,8 +10,13 @@ __author__ = 'Martin Blais <blais@furius.ca>'
 
 
 # stdlib imports.
-import sys, os, re, optparse
-from os.path import join, isfile, exists
+import sys, os, re, optparse, io, mmap, pickle, time, struct
+from os.path import join, isfile, exists, dirname, abspath, relpath
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 
 def options_graft(parser):
@@ -82,6 +87,31 @@ def options_graft(parser):
                      "(default is CWD).  You can use this option many times"
                      "for multiple roots.")
 
+    group.add_option('-j', '--jobs', action='store', type='int',
+                     default=1, metavar='N',
+                     help="Walk the directories with N parallel workers "
+                     "(default is 1, sequential; use 0 for the number of "
+                     "CPUs).  Files are still output in the same order.")
+
+    group.add_option('--select-index', action='store_true',
+                     help="Keep a persistent index of the directories and "
+                     "grep results in the resilient directory, so that "
+                     "subsequent runs over the same roots only rescan the "
+                     "directories and regrep the files that have changed.")
+
+    group.add_option('--select-index-rebuild', action='store_true',
+                     help="Ignore the existing selection index and rebuild "
+                     "it from scratch (implies --select-index).")
+
+    group.add_option('--select-git', '--git', action='store_true',
+                     help="Do not recurse through directories to find files "
+                     "but instead read the list of files tracked in the git "
+                     "checkouts of the root directories from their index.")
+
+    group.add_option('--select-git-untracked', action='store_true',
+                     help="Like --select-git, but also include the untracked "
+                     "files that are not ignored by git.")
+
     # This is a convenient option rather than making a test script, because we
     # don't pollute the bin directory with a script that does not do much, and
     # the option is available in all the scripts that use the select files
@@ -116,6 +146,12 @@ def options_validate(opts, parser, logs=None):
         if opts.roots:
             parser.error("You cannot use select-from-file and specify "
                          "a list of root directories to search for.")
+        if opts.select_index or opts.select_index_rebuild:
+            parser.error("You cannot use select-from-file and a "
+                         "selection index together.")
+        if opts.select_git or opts.select_git_untracked:
+            parser.error("You cannot use select-from-file and select "
+                         "files from git together.")
         # Note: eventually we might want to support chaining the generators
         # instead.
     else:
@@ -136,6 +172,28 @@ def options_validate(opts, parser, logs=None):
         if not opts.select:
             opts.select.append(re.compile('.*'))
 
+        # Combine the patterns for fast matching.
+        opts.select_matcher = FilenameMatcher(opts.select)
+        opts.ignore_matcher = FilenameMatcher(opts.ignore)
+
+        # Figure out how many workers to walk the directories with.
+        if opts.jobs < 0:
+            parser.error("The number of jobs must be positive.")
+        if opts.jobs == 0:
+            opts.jobs = os.cpu_count() or 1
+
+        if opts.select_index_rebuild:
+            opts.select_index = True
+        if opts.select_index and opts.jobs > 1:
+            parser.error("You cannot use a selection index with "
+                         "parallel jobs.")
+
+        if opts.select_git_untracked:
+            opts.select_git = True
+        if opts.select_git and opts.select_index:
+            parser.error("You cannot use a selection index and select "
+                         "files from git together.")
+
     # Compile the regular expressions if given.
     for regname in 'select_grep', 'ignore_grep':
         regstr = getattr(opts, regname)
@@ -148,6 +206,8 @@ def options_validate(opts, parser, logs=None):
     # Create an appropriate generator for the "select" method
     if opts.select_from_file:
         selector = select_from_file(opts.select_from_file)
+    elif opts.select_git:
+        selector = select_from_git(opts.roots, opts)
     else:
         selector = select_patterns(opts.roots, opts)
 
@@ -169,21 +229,34 @@ def select_patterns(rootdirs, opts):
     - rootdirs: root directories -> list of strings
     - select: patterns to select -> list of re regexp objects
     - ignore: patterns to ignore -> list of re regexp objects
+    - jobs: number of parallel workers to walk with -> integer
 
     Yields: selected filenames -> string
     """
+    # Make sure the combined matchers are available (if called directly).
+    if getattr(opts, 'select_matcher', None) is None:
+        opts.select_matcher = FilenameMatcher(opts.select)
+    if getattr(opts, 'ignore_matcher', None) is None:
+        opts.ignore_matcher = FilenameMatcher(opts.ignore)
+    prepare_greps(opts)
+
+    if getattr(opts, 'select_index', None):
+        for fn in select_patterns_indexed(rootdirs, opts):
+            yield fn
+        return
+
+    if getattr(opts, 'jobs', 1) > 1:
+        for fn in select_patterns_parallel(rootdirs, opts):
+            yield fn
+        return
+
     # Walk the tree of files and select files as requested
     for root in rootdirs:
         for dn, dirs, files in os.walk(root):
             # Filter directories.
             for d in list(dirs):
-                add = True
                 # Only ignore applies to directories.
-                for ire in opts.ignore:
-                    if ire.match(d):
-                        add = False
-                        break
-                if not add:
+                if ignore_dir(d, opts):
                     dirs.remove(d)
 
             # Filter files.
@@ -192,42 +265,710 @@ def select_patterns(rootdirs, opts):
                 if not isfile(join(dn, fn)):
                     continue
 
-                add = False
-
-                # Select.
-                for sre in opts.select:
-                    if sre.match(fn):
-                        add = True
-                        break
-
-                # Further restrict by grepping the file for a pattern.
-                if add and opts.select_grep:
-                    try:
-                        text = open(join(dn, fn), 'r').read()
-                    except IOError as e:
-                        raise SystemExit(
-                            "Error: could not read file '%s' for grep." % fn)
-                    if not opts.select_grep.search(text):
-                        add = False
-
-                # Ignore files.
-                for ire in opts.ignore:
-                    if ire.match(fn):
-                        add = False
-                        break
-
-                # Further ignore by grepping the file for a pattern.
-                if add and opts.ignore_grep:
-                    try:
-                        text = open(join(dn, fn), 'r').read()
-                    except IOError as e:
-                        raise SystemExit(
-                            "Error: could not read file for ignore '%s'." % fn)
-                    if opts.ignore_grep.search(text):
-                        add = False
-
-                if add:
-                    yield join(dn, fn)
+                selfn = select_file(dn, fn, opts)
+                if selfn is not None:
+                    yield selfn
+
+
+# Number of directory scans submitted ahead of the one being consumed, per
+# worker thread of select_patterns_parallel().
+scan_window = 4
+
+# Maximum total size of the file contents kept along the filenames selected in a
+# single directory by select_patterns_parallel() (see GreppedFilename).
+max_scan_kept_size = 16 << 20
+
+def select_patterns_parallel(rootdirs, opts):
+    """
+    Generator that selects files to process by regexps, like select_patterns(),
+    but that scans the directories and greps the files over a pool of
+    'opts.jobs' worker threads.  Each directory is scanned only once with
+    os.scandir(), using the cached entry types to avoid extra stats.
+
+    The next directories in the order of the sequential walk are scanned ahead,
+    a bounded number of them, and the results are consumed in the same order,
+    so that the files are yielded in the same order and the caller can start
+    processing the first selected files right away.
+    """
+    limit = opts.jobs * scan_window
+    with ThreadPoolExecutor(max_workers=opts.jobs) as executor:
+        # A stack of the directories to scan, in reverse order of output, as
+        # [dirname, future] pairs (the future is None until submitted).
+        pending = [[root, None] for root in reversed(rootdirs)]
+        inflight = 0
+
+        def submit_ahead():
+            # Submit the next directories to output, up to the limit.
+            nonlocal inflight
+            for item in reversed(pending):
+                if inflight >= limit:
+                    break
+                if item[1] is None:
+                    item[1] = executor.submit(_scan_dir, item[0], opts)
+                    inflight += 1
+        try:
+            while pending:
+                submit_ahead()
+                dn, fut = pending.pop()
+                inflight -= 1
+                selected, subdirs = fut.result()
+
+                # Queue the subdirectories, and scan ahead before yielding.
+                pending.extend([sdn, None] for sdn in reversed(subdirs))
+                submit_ahead()
+
+                for fn in selected:
+                    yield fn
+        finally:
+            # Do not bother finishing the walk if the caller bails out early.
+            for dn, fut in pending:
+                if fut is not None:
+                    fut.cancel()
+
+def _scan_dir(dn, opts):
+    """
+    Scan a single directory and return a pair of the list of selected filenames
+    within it and the list of subdirectories to descend into, both in directory
+    listing order.
+
+    Note: this is run from the worker threads of select_patterns_parallel().
+    """
+    selected, subdirs = [], []
+    try:
+        entries = list(os.scandir(dn))
+    except OSError:
+        # Silently skip unreadable directories, like os.walk() does.
+        return selected, subdirs
+
+    kept = 0
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                # Do not follow symlinks to directories, like os.walk().
+                if (not entry.is_symlink() and
+                    not ignore_dir(entry.name, opts)):
+                    subdirs.append(entry.path)
+
+            # Skip special files (but not symlinks to files, like isfile()).
+            elif entry.is_file():
+                selfn = select_file(dn, entry.name, opts)
+                if selfn is not None:
+                    # Bound the contents kept until the results are consumed.
+                    if getattr(selfn, 'data', None) is not None:
+                        kept += len(selfn.data)
+                        if kept > max_scan_kept_size:
+                            selfn.data = None
+                    selected.append(selfn)
+        except OSError:
+            continue
+
+    return selected, subdirs
+
+
+def select_patterns_indexed(rootdirs, opts):
+    """
+    Generator that selects files to process by regexps, like select_patterns(),
+    but that uses a persistent SelectionIndex to avoid rescanning unchanged
+    directories and regrepping unchanged files.  The files are yielded in the
+    same order as the sequential walk.
+    """
+    import xxdiff.resilient
+    indexfn = join(xxdiff.resilient.resilient_for_paths(rootdirs),
+                   'selection-index')
+    index = SelectionIndex(indexfn, opts, opts.select_index_rebuild)
+
+    complete = False
+    try:
+        pending = list(reversed(rootdirs))
+        while pending:
+            dn = pending.pop()
+            files, subdirs = index.listdir(dn)
+
+            for fn in files:
+                selfn = select_file(dn, fn, opts, index.grep)
+                if selfn is not None:
+                    yield selfn
+
+            pending.extend(join(dn, d) for d in reversed(subdirs)
+                           if not ignore_dir(d, opts))
+        complete = True
+    finally:
+        index.save(complete)
+
+
+class SelectionIndex(object):
+    """
+    A persistent index of directory listings and grep results, used to make
+    repeated selections over the same roots incremental.
+
+    For each directory, we record its modification time and the names of its
+    files and subdirectories; a directory whose modification time has not
+    changed is not listed again.  For each grepped file, we record its size,
+    modification time and the result of the greps; an unchanged file is not
+    grepped again.  The grep results are discarded if the grep patterns change.
+    The filename patterns are always applied anew, so they may change freely.
+    """
+    # Directories modified less than this number of seconds before being listed
+    # are not recorded, because they could change again within the resolution
+    # of the modification time.
+    racy_delay = 2
+
+    def __init__(self, fn, opts, rebuild=False):
+        self.fn = fn
+        "The filename of the index."
+
+        self.greps_key = tuple((r.pattern, r.flags) if r else None
+                               for r in (opts.select_grep, opts.ignore_grep))
+        "The grep patterns that the recorded grep results are valid for."
+
+        self.dirs, self.greps = {}, {}
+        """The loaded directory listings and grep results, mapping directory
+        names to (mtime, files, subdirs) and filenames to (size, mtime,
+        selected)."""
+
+        self.newdirs, self.newgreps = {}, {}
+        "The directory listings and grep results seen during this run."
+
+        if not rebuild:
+            self._load()
+
+    def _load(self):
+        """
+        Load the index file, if it exists and is readable.
+        """
+        try:
+            with open(self.fn, 'rb') as f:
+                greps_key, self.dirs, self.greps = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if greps_key != self.greps_key:
+            self.greps = {}
+
+    def listdir(self, dn):
+        """
+        Return the lists of filenames and subdirectory names in directory 'dn',
+        from the index if the directory has not changed.  Like os.walk(),
+        symlinks to directories are not listed as subdirectories, and special
+        files are not listed at all.
+        """
+        try:
+            mtime = os.stat(dn).st_mtime_ns
+        except OSError:
+            return [], []
+
+        cached = self.dirs.get(dn)
+        if cached is not None and cached[0] == mtime:
+            self.newdirs[dn] = cached
+            return cached[1:]
+
+        files, subdirs = [], []
+        try:
+            entries = list(os.scandir(dn))
+        except OSError:
+            return files, subdirs
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                continue
+
+        if time.time() - mtime / 1e9 > self.racy_delay:
+            self.newdirs[dn] = (mtime, files, subdirs)
+        return files, subdirs
+
+    def grep(self, fn, opts):
+        """
+        Like grep_file(), but reuse the recorded result if the file has not
+        changed.
+        """
+        st = os.stat(fn)
+        key = (st.st_size, st.st_mtime_ns)
+
+        cached = self.greps.get(fn)
+        if cached is not None and cached[:2] == key:
+            self.newgreps[fn] = cached
+            return fn if cached[2] else None
+
+        selfn = grep_file(fn, opts)
+        self.newgreps[fn] = key + (selfn is not None,)
+        return selfn
+
+    def save(self, complete):
+        """
+        Save the index file.  If the walk was not 'complete', the entries that
+        have not been visited in this run are preserved.
+        """
+        if not complete:
+            for old, new in ((self.dirs, self.newdirs),
+                             (self.greps, self.newgreps)):
+                for key, value in old.items():
+                    new.setdefault(key, value)
+
+        tmpfn = '%s.tmp' % self.fn
+        try:
+            if not exists(dirname(self.fn)):
+                os.makedirs(dirname(self.fn))
+            with open(tmpfn, 'wb') as f:
+                pickle.dump((self.greps_key, self.newdirs, self.newgreps), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfn, self.fn)
+        except (IOError, OSError) as e:
+            print("Warning: could not save selection index '%s': %s" %
+                  (self.fn, e), file=sys.stderr)
+
+
+def ignore_dir(d, opts):
+    """
+    Return True if the given directory name 'd' should not be descended into.
+    """
+    return opts.ignore_matcher.match(d)
+
+def select_file(dn, fn, opts, grep=None):
+    """
+    Check if the file 'fn' in directory 'dn' should be selected, given the
+    select and ignore patterns and greps from the options.  Return the filename
+    to be yielded if selected, None otherwise.  'grep' is an alternative to
+    grep_file() to grep the file with.
+    """
+    # Select and ignore by filename (cheap, so do this before grepping).
+    if not opts.select_matcher.match(fn) or opts.ignore_matcher.match(fn):
+        return None
+
+    fn = join(dn, fn)
+    if not (opts.select_grep or opts.ignore_grep):
+        return fn
+
+    # Further restrict and ignore by grepping the file for patterns.
+    try:
+        return (grep or grep_file)(fn, opts)
+    except (IOError, ValueError) as e:
+        raise SystemExit(
+            "Error: could not read file '%s' for grep." % fn)
+
+
+class GreppedFilename(str):
+    """
+    A filename that was selected by grepping its contents.  The contents that
+    were read are kept in the 'data' attribute (as bytes) for small files, so
+    that they can be handed on to the transformer without reading the file
+    again (see read_text()).
+    """
+    data = None
+
+# Maximum size of file contents to keep along the selected filenames.
+max_kept_size = 1 << 20
+
+# Number of bytes to check for NUL characters to detect binary files.
+binary_sniff_size = 8192
+
+def prepare_greps(opts):
+    """
+    Compile the equivalents of the grep patterns for searching bytes, if
+    possible, for grep_file().
+    """
+    opts.greps = tuple(map(bytes_regexp, (opts.select_grep, opts.ignore_grep)))
+
+    # The text is read with universal newlines, so the bytes patterns that
+    # depend on the line endings are only run on files without CR characters.
+    opts.greps_crlf = any(
+        _crlf_sensitive(sre_parse.parse(regexp.pattern, regexp.flags))
+        for regexp in opts.greps if regexp is not None)
+
+def bytes_regexp(regexp):
+    """
+    Compile an equivalent of the given text regexp for searching bytes, or
+    return None if this is not possible.  This is only done for ASCII patterns
+    that match the same whether the text is decoded or not, i.e. without '.',
+    negated sets, class escapes ('\\w', '\\s', '\\d', '\\b', ...) or ignoring
+    case, which would match differently on non-ASCII characters.
+    """
+    if regexp is None:
+        return None
+    if (not regexp.pattern.isascii() or regexp.flags & re.IGNORECASE or
+        isinstance(regexp.pattern, bytes)):
+        return None
+    try:
+        if not _bytes_safe(sre_parse.parse(regexp.pattern, regexp.flags)):
+            return None
+        return re.compile(regexp.pattern.encode('ascii'),
+                          regexp.flags & ~re.UNICODE)
+    except (re.error, UnicodeError):
+        return None
+
+def _bytes_safe(parsed):
+    """
+    Return True if the given parsed regular expression matches the same on
+    bytes as on the decoded text (see bytes_regexp()).
+    """
+    for op, av in parsed:
+        if op in (sre_parse.ANY, sre_parse.NOT_LITERAL, sre_parse.CATEGORY):
+            return False
+        elif op is sre_parse.LITERAL:
+            if av > 0x7f:
+                return False
+        elif op is sre_parse.AT:
+            if av in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return False
+        elif op is sre_parse.IN:
+            for iop, iav in av:
+                if iop in (sre_parse.NEGATE, sre_parse.CATEGORY):
+                    return False
+                elif iop is sre_parse.LITERAL and iav > 0x7f:
+                    return False
+                elif iop is sre_parse.RANGE and iav[1] > 0x7f:
+                    return False
+        elif op is sre_parse.SUBPATTERN and (av[1] or av[2]):
+            # Scoped flags, e.g. '(?i:...)'.
+            return False
+        elif op is sre_parse.BRANCH:
+            if not all(_bytes_safe(branch) for branch in av[1]):
+                return False
+        elif isinstance(av, tuple):
+            # Repeats, groups, assertions, etc.
+            for sub in av:
+                if (isinstance(sub, sre_parse.SubPattern) and
+                    not _bytes_safe(sub)):
+                    return False
+    return True
+
+def _crlf_sensitive(parsed):
+    """
+    Return True if the given parsed regular expression may match differently
+    whether the line endings are translated or not, i.e. if it has end anchors
+    ('$', '\\Z') or matches CR or LF characters.
+    """
+    for op, av in parsed:
+        if op is sre_parse.AT:
+            if av in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+                return True
+        elif op is sre_parse.LITERAL:
+            if av in (0x0a, 0x0d):
+                return True
+        elif op is sre_parse.IN:
+            for iop, iav in av:
+                if iop is sre_parse.LITERAL and iav in (0x0a, 0x0d):
+                    return True
+                elif (iop is sre_parse.RANGE and
+                      iav[0] <= 0x0d and iav[1] >= 0x0a):
+                    return True
+        elif op is sre_parse.BRANCH:
+            if any(_crlf_sensitive(branch) for branch in av[1]):
+                return True
+        elif isinstance(av, tuple):
+            for sub in av:
+                if (isinstance(sub, sre_parse.SubPattern) and
+                    _crlf_sensitive(sub)):
+                    return True
+    return False
+
+def grep_file(fn, opts):
+    """
+    Grep the given file for the select and ignore grep patterns, with a single
+    read through a memory map, and stop as soon as the decision is known.
+    Binary files (with NUL bytes near the beginning) are never selected.
+    Return the filename as a GreppedFilename if selected, None otherwise.
+    """
+    with open(fn, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            if buf.find(b'\0', 0, binary_sniff_size) != -1:
+                return None
+
+            # If either pattern cannot be run on bytes, or the line endings
+            # matter and need translating, decode the contents.
+            if ((opts.select_grep and not opts.greps[0]) or
+                (opts.ignore_grep and not opts.greps[1]) or
+                (opts.greps_crlf and buf.find(b'\r') != -1)):
+                text = io.TextIOWrapper(io.BytesIO(buf)).read()
+                greps = opts.select_grep, opts.ignore_grep
+            else:
+                text = buf
+                greps = opts.greps
+
+            sgrep, igrep = greps
+            if sgrep is not None and not sgrep.search(text):
+                return None
+            if igrep is not None and igrep.search(text):
+                return None
+
+            selfn = GreppedFilename(fn)
+            if size <= max_kept_size:
+                selfn.data = bytes(buf)
+            return selfn
+        finally:
+            if size:
+                buf.close()
+
+def read_data(fn):
+    """
+    Return the raw contents of the given selected file, reusing the contents
+    that were read when grepping if they were kept.
+    """
+    data = getattr(fn, 'data', None)
+    if data is None:
+        with open(fn, 'rb') as f:
+            return f.read()
+    return data
+
+def read_text(fn, data=None):
+    """
+    Return the contents of the given selected file as text, as if it had been
+    read from a file opened in 'r' mode, reusing the contents that were read
+    when grepping if they were kept, or the given raw contents.
+    """
+    if data is None:
+        data = getattr(fn, 'data', None)
+    if data is None:
+        with open(fn, 'r') as f:
+            return f.read()
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+# Maximum number of literal strings to expand a single pattern into.
+max_literals = 256
+
+class FilenameMatcher(object):
+    """
+    A matcher that tells if a filename matches any of a list of regular
+    expressions (with re.match() semantics), at a cost that does not grow with
+    the number of patterns.
+
+    Patterns that only match a small, finite set of literal strings, either
+    exactly, as a prefix or as a suffix (e.g. '.*\\.(h|cpp)$' for
+    extensions), are checked with set lookups.  All the other patterns are
+    combined into a single alternation, unless they cannot be combined (e.g.
+    they use backreferences or conflicting group names), in which case they are
+    tried one by one.
+    """
+    def __init__(self, regexps):
+        self.regexps = list(regexps)
+        "The original list of compiled regexps."
+
+        self.matchall = False
+        "True if any of the patterns matches all filenames."
+
+        self.exact = set()
+        self.prefixes = {}
+        self.suffixes = {}
+        """Literal strings to match exactly, and prefixes and suffixes, as maps of
+        their length to a set of strings."""
+
+        self.others = []
+        "The remaining regexps, possibly combined into a single one."
+
+        residual = []
+        for regexp in self.regexps:
+            kind, literals = _classify_pattern(regexp)
+            if kind == 'all':
+                self.matchall = True
+            elif kind == 'exact':
+                self.exact.update(literals)
+            elif kind in ('prefix', 'suffix'):
+                bylen = getattr(self, kind + 'es')
+                for lit in literals:
+                    bylen.setdefault(len(lit), set()).add(lit)
+            else:
+                residual.append(regexp)
+
+        self.others = _combine_patterns(residual)
+
+    def match(self, fn):
+        """
+        Return True if the filename 'fn' matches any of the patterns.
+        """
+        # Note: '.' and '$' treat newlines specially; let the regexps decide.
+        if '\n' in fn:
+            return any(regexp.match(fn) for regexp in self.regexps)
+
+        if self.matchall or fn in self.exact:
+            return True
+        for length, literals in self.prefixes.items():
+            if fn[:length] in literals:
+                return True
+        for length, literals in self.suffixes.items():
+            if length <= len(fn) and fn[len(fn)-length:] in literals:
+                return True
+        for regexp in self.others:
+            if regexp.match(fn):
+                return True
+        return False
+
+def _classify_pattern(regexp):
+    """
+    Classify the given compiled regexp as one of 'all', 'exact', 'prefix',
+    'suffix' (and the corresponding set of literal strings), or None if it has
+    to be run as a regular expression.
+    """
+    # Any flag may change what the pattern matches (e.g. '(?i)').
+    if regexp.flags & ~re.UNICODE:
+        return None, None
+    try:
+        parsed = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        return None, None
+
+    # Look for a leading '.*' and a trailing '$'.
+    anyprefix = (parsed and parsed[0][0] is sre_parse.MAX_REPEAT and
+                 parsed[0][1][:2] == (0, sre_parse.MAXREPEAT) and
+                 list(parsed[0][1][2]) == [(sre_parse.ANY, None)])
+    if anyprefix:
+        parsed = parsed[1:]
+    atend = parsed and parsed[-1] == (sre_parse.AT, sre_parse.AT_END)
+    if atend:
+        parsed = parsed[:-1]
+
+    if anyprefix and not parsed:
+        return ('all', None) if not atend else (None, None)
+
+    literals = _expand_literals(parsed)
+    if not literals or any('\n' in lit for lit in literals):
+        return None, None
+    if anyprefix:
+        return ('suffix', literals) if atend else (None, None)
+    else:
+        return ('exact' if atend else 'prefix'), literals
+
+def _expand_literals(parsed):
+    """
+    Expand a parsed regular expression into the finite set of literal strings
+    it matches, or return None if it is not finite or too large.
+    """
+    results = {''}
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            choices = {chr(av)}
+        elif op is sre_parse.IN:
+            if not all(iop is sre_parse.LITERAL for iop, _ in av):
+                return None
+            choices = {chr(c) for _, c in av}
+        elif op is sre_parse.SUBPATTERN:
+            # Scoped flags (e.g. '(?i:...)') may change what it matches.
+            if av[1] or av[2]:
+                return None
+            choices = _expand_literals(av[-1])
+        elif op is sre_parse.BRANCH:
+            choices = set()
+            for branch in av[1]:
+                bchoices = _expand_literals(branch)
+                if bchoices is None:
+                    return None
+                choices.update(bchoices)
+        elif (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and
+              av[:2] == (0, 1)):
+            choices = _expand_literals(av[2])
+            if choices is not None:
+                choices.add('')
+        else:
+            return None
+        if choices is None:
+            return None
+
+        results = {r + c for r in results for c in choices}
+        if len(results) > max_literals:
+            return None
+
+    return results
+
+# Regexp to detect constructs that refer to groups by number or name, which
+# would change meaning if the patterns were combined.
+groupref_re = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\\g<')
+
+def _combine_patterns(regexps):
+    """
+    Combine the given list of compiled regexps into a list with a single regexp
+    with the patterns as alternatives.  If the patterns cannot be combined, the
+    original list is returned.
+    """
+    if len(regexps) < 2:
+        return regexps
+
+    flags = set(regexp.flags for regexp in regexps)
+    if len(flags) > 1 or any(groupref_re.search(regexp.pattern)
+                             for regexp in regexps):
+        return regexps
+
+    try:
+        combined = re.compile('|'.join('(?:%s)' % regexp.pattern
+                                       for regexp in regexps), flags.pop())
+    except (re.error, OverflowError):
+        return regexps
+    return [combined]
+
+
+def select_from_git(rootdirs, opts):
+    """
+    Generator that selects files to process by regexps, like select_patterns(),
+    but that enumerates the files tracked in the git checkouts that contain the
+    root directories by reading their index directly, instead of walking the
+    directories.  If 'opts.select_git_untracked' is set, the untracked files
+    that are not ignored are also included (this spawns a single git process
+    per root).
+
+    Yields: selected filenames -> string
+    """
+    from xxdiff.scm import git
+
+    if getattr(opts, 'select_matcher', None) is None:
+        opts.select_matcher = FilenameMatcher(opts.select)
+    if getattr(opts, 'ignore_matcher', None) is None:
+        opts.ignore_matcher = FilenameMatcher(opts.ignore)
+    prepare_greps(opts)
+
+    for root in rootdirs:
+        toplevel, gitdir = git.find_toplevel(root)
+        if toplevel is None:
+            raise SystemExit("Error: '%s' is not in a git checkout." % root)
+        rel = relpath(abspath(root), toplevel)
+        if rel == os.curdir:
+            rel = ''
+        try:
+            paths = git.read_index(gitdir)
+        except ValueError:
+            # Let git read the index formats that we do not support.
+            paths = git.tracked_files(toplevel, rel)
+        except (IOError, struct.error) as e:
+            raise SystemExit("Error: reading git index: %s" % e)
+        if getattr(opts, 'select_git_untracked', None):
+            paths.extend(git.untracked_files(toplevel, rel))
+
+        # Cache of the decisions for the directories (relative to the root).
+        ignored = {'': False}
+        prefix = rel + '/' if rel else ''
+        for path in paths:
+            if not path.startswith(prefix):
+                continue
+            path = path[len(prefix):]
+            dn, fn = os.path.split(path)
+
+            if _ignore_reldir(dn, ignored, opts):
+                continue
+
+            # Skip files that do not exist anymore and special files.
+            if (opts.select_matcher.match(fn) and
+                not opts.ignore_matcher.match(fn) and
+                isfile(join(root, dn, fn))):
+                selfn = select_file(join(root, dn) if dn else root, fn, opts)
+                if selfn is not None:
+                    yield selfn
+
+def _ignore_reldir(dn, ignored, opts):
+    """
+    Return True if any of the components of the relative directory 'dn' is to be
+    ignored.  'ignored' is a cache of the decisions.
+    """
+    try:
+        return ignored[dn]
+    except KeyError:
+        parent, d = os.path.split(dn)
+        ignored[dn] = decision = (_ignore_reldir(parent, ignored, opts) or
+                                  ignore_dir(d, opts))
+        return decision
+
 
 def select_from_file(fn):
     """
@@ -0,0 +1,648 @@
+# This file is part of the xxdiff package.  See xxdiff for license and details.
+
+"""
+Compute and render the differences between text files in-process.
+
+The differences between two sequences of lines are computed with Myers' O(ND)
+algorithm (in its linear space, middle snake variant) over arrays of numbers
+identifying the lines, following the same steps and heuristics as GNU diff, so
+that the changes are lined up the same way.  They are rendered like 'diff
+--side-by-side --suppress-common-lines' would, so that the scripts do not need
+to spawn diff for every file they process.
+"""
+
+__author__ = 'Martin Blais <blais@furius.ca>'
+
+
+# stdlib imports.
+import os, re, mmap, unicodedata
+
+
+def read_lines(fn):
+    """
+    Read the lines of the given file as bytes, with their newlines.
+    """
+    with open(fn, 'rb') as f:
+        return f.readlines()
+
+
+# Cache of the results of identical(), keyed by the identity and modification
+# time of the files, and its maximum size.
+_identical_cache = {}
+identical_cache_size = 65536
+
+# Size of the chunks of the files to compare at a time.
+compare_chunk_size = 1 << 20
+
+def identical(fn1, fn2):
+    """
+    Return true if the two given files have the same contents.  This compares
+    their sizes first, and then their contents in chunks over mapped memory.
+    The results are cached per pair of (inode, modification time) of the files,
+    so that comparing files that have not changed again is instantaneous.
+    """
+    st1, st2 = os.stat(fn1), os.stat(fn2)
+    if st1.st_size != st2.st_size:
+        return False
+    if (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino) or not st1.st_size:
+        return True
+
+    key = (st1.st_dev, st1.st_ino, st1.st_mtime_ns,
+           st2.st_dev, st2.st_ino, st2.st_mtime_ns, st1.st_size)
+    try:
+        return _identical_cache[key]
+    except KeyError:
+        pass
+
+    with open(fn1, 'rb') as f1, open(fn2, 'rb') as f2:
+        with mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as m1, \
+             mmap.mmap(f2.fileno(), 0, access=mmap.ACCESS_READ) as m2:
+            size = min(len(m1), len(m2))
+            same = len(m1) == len(m2) and all(
+                m1[i:i + compare_chunk_size] == m2[i:i + compare_chunk_size]
+                for i in range(0, size, compare_chunk_size))
+
+    if len(_identical_cache) >= identical_cache_size:
+        _identical_cache.clear()
+    _identical_cache[key] = same
+    return same
+
+
+def diff_lines(lines1, lines2):
+    """
+    Compute the differences between two sequences of hashable lines.  Return a
+    list of the changed blocks, as (i1, i2, j1, j2) tuples meaning that the
+    lines1[i1:i2] have been replaced by lines2[j1:j2].
+    """
+    # Skip the identical lines at both ends.
+    n1, n2 = len(lines1), len(lines2)
+    prefix = 0
+    while prefix < n1 and prefix < n2 and lines1[prefix] == lines2[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < n1 - prefix and suffix < n2 - prefix and
+           lines1[n1 - 1 - suffix] == lines2[n2 - 1 - suffix]):
+        suffix += 1
+
+    # Map the remaining lines to numbers identifying their equivalence classes.
+    classes = {}
+    equivs1 = [classes.setdefault(line, len(classes))
+               for line in lines1[prefix:n1 - suffix]]
+    equivs2 = [classes.setdefault(line, len(classes))
+               for line in lines2[prefix:n2 - suffix]]
+
+    # The flags of changed lines, padded with a sentinel at both ends.
+    changed1 = [False] * (len(equivs1) + 2)
+    changed2 = [False] * (len(equivs2) + 2)
+
+    # Discard the lines that cannot or are unlikely to match, they are changes,
+    # and compare the remaining lines.
+    index1, index2 = _discard_confusing_lines(equivs1, equivs2,
+                                              changed1, changed2)
+    undiscarded1 = [equivs1[i] for i in index1]
+    undiscarded2 = [equivs2[j] for j in index2]
+    for i, j in _compare(undiscarded1, undiscarded2):
+        if i is not None:
+            changed1[index1[i] + 1] = True
+        else:
+            changed2[index2[j] + 1] = True
+
+    _shift_boundaries(equivs1, changed1, changed2)
+    _shift_boundaries(equivs2, changed2, changed1)
+
+    # Build the list of changed blocks.
+    blocks = []
+    m1, m2 = len(equivs1), len(equivs2)
+    i = j = 0
+    while i < m1 or j < m2:
+        if changed1[i + 1] or changed2[j + 1]:
+            i1, j1 = i, j
+            while changed1[i + 1]:
+                i += 1
+            while changed2[j + 1]:
+                j += 1
+            blocks.append((prefix + i1, prefix + i, prefix + j1, prefix + j))
+        else:
+            i += 1
+            j += 1
+    return blocks
+
+def _discard_confusing_lines(equivs1, equivs2, changed1, changed2):
+    """
+    Mark the lines that match no line of the other file as changed, as well as
+    the lines that match many lines when they are in the middle of a run of
+    such lines, like GNU diff does.  Return the lists of the indexes of the
+    lines that remain to be compared, for each file.
+    """
+    counts1, counts2 = {}, {}
+    for e in equivs1:
+        counts1[e] = counts1.get(e, 0) + 1
+    for e in equivs2:
+        counts2[e] = counts2.get(e, 0) + 1
+
+    indexes = []
+    for equivs, counts, changed in ((equivs1, counts2, changed1),
+                                    (equivs2, counts1, changed2)):
+        end = len(equivs)
+
+        # Discard the lines that match no line of the other file, and
+        # provisionally those that match many, where many is about the square
+        # root of the number of lines.
+        many = 5
+        tem = end // 64
+        while True:
+            tem >>= 2
+            if tem <= 0:
+                break
+            many *= 2
+        discards = [0] * end
+        for i, e in enumerate(equivs):
+            nmatch = counts.get(e, 0)
+            if nmatch == 0:
+                discards[i] = 1
+            elif nmatch > many:
+                discards[i] = 2
+
+        # Only discard the provisional lines that are in a run of discarded
+        # lines, with non-provisional ones at the beginning and end.
+        i = 0
+        while i < end:
+            if discards[i] == 2:
+                discards[i] = 0
+            elif discards[i] != 0:
+                provisional = 0
+                j = i
+                while j < end and discards[j] != 0:
+                    if discards[j] == 2:
+                        provisional += 1
+                    j += 1
+                while j > i and discards[j - 1] == 2:
+                    j -= 1
+                    discards[j] = 0
+                    provisional -= 1
+                length = j - i
+
+                if provisional * 4 > length:
+                    # Too many provisional lines, cancel them all.
+                    while j > i:
+                        j -= 1
+                        if discards[j] == 2:
+                            discards[j] = 0
+                else:
+                    # Cancel the subruns of 'minimum' or more provisionals,
+                    # where 'minimum' is about the square root of length/4.
+                    minimum = 1
+                    tem = length >> 2
+                    while True:
+                        tem >>= 2
+                        if tem <= 0:
+                            break
+                        minimum <<= 1
+                    minimum += 1
+                    j = consec = 0
+                    while j < length:
+                        if discards[i + j] != 2:
+                            consec = 0
+                        else:
+                            consec += 1
+                            if consec == minimum:
+                                j -= consec
+                            elif consec > minimum:
+                                discards[i + j] = 0
+                        j += 1
+
+                    # Cancel the provisionals at the beginning and end of the
+                    # run, until 3 non-provisionals in a row or the first
+                    # non-provisional at least 8 lines in.
+                    for step in (1, -1):
+                        if step < 0:
+                            i += length - 1
+                        consec = 0
+                        for j in range(length):
+                            k = i + j * step
+                            if j >= 8 and discards[k] == 1:
+                                break
+                            if discards[k] == 2:
+                                consec = 0
+                                discards[k] = 0
+                            elif discards[k] == 0:
+                                consec = 0
+                            else:
+                                consec += 1
+                            if consec == 3:
+                                break
+            i += 1
+
+        index = []
+        for i, discard in enumerate(discards):
+            if discard:
+                changed[i + 1] = True
+            else:
+                index.append(i)
+        indexes.append(index)
+
+    return indexes
+
+def _compare(seq1, seq2):
+    """
+    Generate the indexes of the elements of 'seq1' that are deleted, as (i,
+    None) pairs, and of the elements of 'seq2' that are inserted, as (None, j)
+    pairs, in a short edit script between the two sequences.
+    """
+    # Bound on the cost before the search for the middle snake gives up.
+    too_expensive = 1
+    ndiags = len(seq1) + len(seq2) + 3
+    while ndiags:
+        too_expensive <<= 1
+        ndiags >>= 2
+    too_expensive = max(4096, too_expensive)
+
+    # The furthest reaching paths on each diagonal, offset by 'voffset'.
+    voffset = len(seq2) + 1
+    vforward = [0] * (len(seq1) + len(seq2) + 3)
+    vbackward = list(vforward)
+
+    stack = [(0, len(seq1), 0, len(seq2), False)]
+    while stack:
+        lo1, hi1, lo2, hi2, minimal = stack.pop()
+
+        # Skip the common prefix and suffix.
+        while lo1 < hi1 and lo2 < hi2 and seq1[lo1] == seq2[lo2]:
+            lo1 += 1
+            lo2 += 1
+        while lo1 < hi1 and lo2 < hi2 and seq1[hi1 - 1] == seq2[hi2 - 1]:
+            hi1 -= 1
+            hi2 -= 1
+
+        if lo1 == hi1:
+            for j in range(lo2, hi2):
+                yield None, j
+        elif lo2 == hi2:
+            for i in range(lo1, hi1):
+                yield i, None
+        else:
+            x, y, lominimal, himinimal = _middle_snake(
+                seq1, lo1, hi1, seq2, lo2, hi2, minimal, too_expensive,
+                vforward, vbackward, voffset)
+            stack.append((x, hi1, y, hi2, himinimal))
+            stack.append((lo1, x, lo2, y, lominimal))
+
+def _middle_snake(seq1, lo1, hi1, seq2, lo2, hi2, minimal, too_expensive,
+                  fd, bd, voffset):
+    """
+    Find the midpoint of a shortest edit script between seq1[lo1:hi1] and
+    seq2[lo2:hi2], by searching from both ends simultaneously along the
+    diagonals.  Unless 'minimal' is true, give up when the cost gets too
+    expensive and return the best point found so far.  Return the point, and
+    whether the searches for each of the two halves should be minimal.
+    """
+    dmin = lo1 - hi2 + voffset
+    dmax = hi1 - lo2 + voffset
+    fmid = lo1 - lo2 + voffset
+    bmid = hi1 - hi2 + voffset
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    odd = (fmid - bmid) & 1
+    fd[fmid] = lo1
+    bd[bmid] = hi1
+    maxint = hi1 + 1
+
+    cost = 0
+    while True:
+        cost += 1
+
+        # Extend the forward search by an edit step in each diagonal.
+        if fmin > dmin:
+            fmin -= 1
+            fd[fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            fd[fmax + 1] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            tlo, thi = fd[d - 1], fd[d + 1]
+            x = thi if tlo < thi else tlo + 1
+            y = x - (d - voffset)
+            while x < hi1 and y < hi2 and seq1[x] == seq2[y]:
+                x += 1
+                y += 1
+            fd[d] = x
+            if odd and bmin <= d <= bmax and bd[d] <= x:
+                return x, y, True, True
+
+        # Extend the backward search similarly.
+        if bmin > dmin:
+            bmin -= 1
+            bd[bmin - 1] = maxint
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            bd[bmax + 1] = maxint
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            tlo, thi = bd[d - 1], bd[d + 1]
+            x = tlo if tlo < thi else thi - 1
+            y = x - (d - voffset)
+            while lo1 < x and lo2 < y and seq1[x - 1] == seq2[y - 1]:
+                x -= 1
+                y -= 1
+            bd[d] = x
+            if not odd and fmin <= d <= fmax and x <= fd[d]:
+                return x, y, True, True
+
+        if minimal or cost < too_expensive:
+            continue
+
+        # Give up and use the diagonal that made the most progress.
+        fxybest = -1
+        for d in range(fmax, fmin - 1, -2):
+            x = min(fd[d], hi1)
+            y = x - (d - voffset)
+            if hi2 < y:
+                x, y = hi2 + (d - voffset), hi2
+            if fxybest < x + y:
+                fxybest, fxbest = x + y, x
+        bxybest = maxint + hi2
+        for d in range(bmax, bmin - 1, -2):
+            x = max(lo1, bd[d])
+            y = x - (d - voffset)
+            if y < lo2:
+                x, y = lo2 + (d - voffset), lo2
+            if x + y < bxybest:
+                bxybest, bxbest = x + y, x
+        if (hi1 + hi2) - bxybest < fxybest - (lo1 + lo2):
+            return fxbest, fxybest - fxbest, True, False
+        else:
+            return bxbest, bxybest - bxbest, False, True
+
+def _shift_boundaries(equivs, changed, other_changed):
+    """
+    Move the runs of changed lines of a file as far down as possible, merging
+    them with the adjacent runs when they can slide, and then back up to line
+    up with a run of changes in the other file if possible, like GNU diff does.
+    The flags lists have a sentinel at each end, hence the index offsets.
+    """
+    i = j = 0
+    iend = len(equivs)
+    while True:
+        # Find the start of the next run of changes, and the corresponding
+        # point in the other file.
+        while i < iend and not changed[i + 1]:
+            while other_changed[j + 1]:
+                j += 1
+            j += 1
+            i += 1
+        if i == iend:
+            break
+        start = i
+
+        # Find the end of this run of changes.
+        i += 1
+        while changed[i + 1]:
+            i += 1
+        while other_changed[j + 1]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            # Move the run back while the previous unchanged line matches the
+            # last changed one, merging with the previous runs.
+            while start and equivs[start - 1] == equivs[i - 1]:
+                start -= 1
+                changed[start + 1] = True
+                i -= 1
+                changed[i + 1] = False
+                while changed[start]:
+                    start -= 1
+                j -= 1
+                while other_changed[j + 1]:
+                    j -= 1
+
+            # The end of the run at the last point where it corresponds to a
+            # run of changes in the other file, if any.
+            corresponding = i if other_changed[j] else iend
+
+            # Move the run forward while the first changed line matches the
+            # following unchanged one, merging with the following runs.
+            while i != iend and equivs[start] == equivs[i]:
+                changed[start + 1] = False
+                start += 1
+                changed[i + 1] = True
+                i += 1
+                while changed[i + 1]:
+                    i += 1
+                j += 1
+                while other_changed[j + 1]:
+                    j += 1
+                    corresponding = i
+
+            if runlength == i - start:
+                break
+
+        # Move the merged run back to line up with the run in the other file.
+        while corresponding < i:
+            start -= 1
+            changed[start + 1] = True
+            i -= 1
+            changed[i + 1] = False
+            j -= 1
+            while other_changed[j + 1]:
+                j -= 1
+
+
+# Default width of the side-by-side output, and size of the tabs.
+sbs_width = 130
+tab_size = 8
+
+# Size of the beginning of the files that is checked for binary contents.
+binary_sniff_size = 8192
+
+def sbs_diff(fn1, fn2, width=sbs_width):
+    """
+    Compare the two given files and return the differences rendered like the
+    output of 'diff --side-by-side --suppress-common-lines', or an empty string
+    if they are identical.
+    """
+    lines1, lines2 = read_lines(fn1), read_lines(fn2)
+    if lines1 == lines2:
+        return ''
+
+    # Like diff, do not render the differences of binary files.
+    if any(b'\0' in b''.join(lines)[:binary_sniff_size]
+           for lines in (lines1, lines2)):
+        return 'Binary files %s and %s differ\n' % (fn1, fn2)
+
+    return sbs_render(lines1, lines2, diff_lines(lines1, lines2), width)
+
+def sbs_render(lines1, lines2, blocks, width=sbs_width):
+    """
+    Render the given changed blocks between two lists of lines (as bytes) in
+    side-by-side format, with the common lines suppressed.
+    """
+    # Compute the columns like diff does.
+    offset = (width + tab_size + gutter_width) // (2 * tab_size) * tab_size
+    half_width = max(0, min(offset - gutter_width, width - offset))
+    column2 = offset if half_width else width
+
+    # Invalid bytes are decoded as surrogates, and output like diff does.
+    out = []
+    for i1, i2, j1, j2 in blocks:
+        left = [line.decode('utf-8', 'surrogateescape')
+                for line in lines1[i1:i2]]
+        right = [line.decode('utf-8', 'surrogateescape')
+                 for line in lines2[j1:j2]]
+        npairs = min(len(left), len(right))
+        for l, r in zip(left, right):
+            _render_line(out, l, '|', r, half_width, column2)
+        for r in right[npairs:]:
+            _render_line(out, None, '>', r, half_width, column2)
+        for l in left[npairs:]:
+            _render_line(out, l, '<', None, half_width, column2)
+    return ''.join(out).encode('utf-8', 'surrogateescape').decode('utf-8',
+                                                                  'replace')
+
+# Minimum width of the gutter between the columns.
+gutter_width = 3
+
+def _render_line(out, left, sep, right, half_width, column2):
+    """
+    Render a single side-by-side line, either side may be None.
+    """
+    column = 0
+    put_newline = False
+    if left is not None:
+        put_newline = left.endswith('\n')
+        column = _render_half_line(out, left, 0, half_width)
+
+    if sep != ' ':
+        column = _tab_from_to(out, column, (half_width + column2 - 1) // 2) + 1
+        if sep == '|' and put_newline != right.endswith('\n'):
+            sep = '/' if put_newline else '\\'
+        out.append(sep)
+
+    if right is not None:
+        put_newline |= right.endswith('\n')
+        if not right.startswith('\n'):
+            column = _tab_from_to(out, column, column2)
+            _render_half_line(out, right, column, half_width)
+
+    if put_newline:
+        out.append('\n')
+
+def _tab_from_to(out, start, end):
+    """
+    Output tabs and spaces to move from column 'start' to column 'end'.
+    """
+    tab = start + tab_size - start % tab_size
+    while tab <= end:
+        out.append('\t')
+        start = tab
+        tab += tab_size
+    if start < end:
+        out.append(' ' * (end - start))
+    return end
+
+# Regexp for the lines that only contain printable ASCII characters.
+simple_line_re = re.compile('[\x20-\x7e]*\n?\\Z')
+
+def _render_half_line(out, line, indent, bound):
+    """
+    Output one side of a line, truncated to the column 'bound'.  Return the
+    column where the output ended.
+    """
+    if simple_line_re.match(line):
+        text = line.rstrip('\n')[:bound]
+        out.append(text)
+        return len(text)
+
+    inpos = outpos = 0
+    for c in line:
+        if c == '\n':
+            break
+        elif c == '\t':
+            spaces = tab_size - inpos % tab_size
+            if inpos == outpos:
+                tabstop = outpos + spaces
+                if tabstop < bound:
+                    outpos = tabstop
+                    out.append(c)
+            inpos += spaces
+        elif c == '\r':
+            out.append(c)
+            _tab_from_to(out, 0, indent)
+            inpos = outpos = 0
+        elif c == '\b':
+            if inpos != 0:
+                inpos -= 1
+                if inpos < bound:
+                    if outpos <= inpos:
+                        # Make up for a tab suppressed past the bound.
+                        out.append(' ' * (inpos - outpos))
+                        outpos = inpos
+                    else:
+                        outpos = inpos
+                        out.append(c)
+        elif c in '\f\v' or '\udc80' <= c <= '\udcff':
+            if inpos < bound:
+                out.append(c)
+        else:
+            inpos += _char_width(c)
+            if inpos <= bound:
+                outpos = inpos
+                out.append(c)
+    return outpos
+
+def _char_width(c):
+    """
+    Return the number of columns that a character takes on a terminal.
+    """
+    if unicodedata.combining(c) or unicodedata.category(c) in ('Cc', 'Cf',
+                                                               'Mn', 'Me'):
+        return 0
+    elif unicodedata.east_asian_width(c) in ('W', 'F'):
+        return 2
+    return 1
+
+
+def test():
+    """
+    Compare the rendering of random edits of the given files with diff.
+    """
+    import sys, random, tempfile
+    from subprocess import Popen, PIPE
+
+    random.seed(0)
+    nbmismatch = 0
+    for fn in sys.argv[1:]:
+        lines = read_lines(fn)
+        for _ in range(10):
+            newlines = list(lines)
+            for _ in range(random.randint(1, 10)):
+                pos = random.randint(0, len(newlines))
+                op = random.choice(('del', 'ins', 'dup'))
+                if op == 'del':
+                    del newlines[pos:pos + random.randint(1, 5)]
+                elif op == 'ins':
+                    newlines[pos:pos] = [b'inserted %d\n' % pos]
+                elif lines:
+                    newlines.insert(pos, random.choice(lines))
+
+            with tempfile.NamedTemporaryFile() as tmpf:
+                tmpf.writelines(newlines)
+                tmpf.flush()
+                p = Popen(['diff', '--side-by-side', '--suppress-common-lines',
+                           fn, tmpf.name], stdout=PIPE)
+                expected = p.communicate()[0].decode('utf-8', 'replace')
+                if sbs_diff(fn, tmpf.name) != expected:
+                    nbmismatch += 1
+                    print('Mismatch: %s' % fn)
+    print('%d mismatches.' % nbmismatch)
+
+if __name__ == '__main__':
+    test()
@@ -8,7 +8,7 @@ __author__ = 'Martin Blais <blais@furius.ca>'
 
 
 # stdlib imports.
-import os, re
+import os, re, codecs
 from os.path import exists
 from curses.ascii import isalnum
 from subprocess import Popen, PIPE
@@ -47,6 +47,75 @@ def idify(s, strip=True, preserve_chars=[]):
     return ss
 
 
+# Cache of the results of istextfile(), keyed by the identity, modification
+# time and size of the files, and its maximum size.
+_istextfile_cache = {}
+istextfile_cache_size = 65536
+
+def istextfile(fn, usefile=False):
+    """
+    Attempts to guess if the file indicated by the given filename is a text file
+    or a binary file.  This looks at the beginning of the file (see
+    istextdata()), or runs the 'file' utility if 'usefile' is true.  The results
+    are cached per (inode, modification time, size) of the file.
+    """
+    try:
+        st = os.stat(fn)
+    except OSError as e:
+        raise RuntimeError("Error: cannot classify '%s': %s" % (fn, e))
+
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, bool(usefile))
+    try:
+        return _istextfile_cache[key]
+    except KeyError:
+        pass
+
+    if usefile:
+        istext = istextfile_file(fn)
+    else:
+        try:
+            with open(fn, 'rb') as f:
+                istext = istextdata(f.read(classify_size))
+        except IOError as e:
+            raise RuntimeError("Error: cannot classify '%s': %s" % (fn, e))
+
+    if len(_istextfile_cache) >= istextfile_cache_size:
+        _istextfile_cache.clear()
+    _istextfile_cache[key] = istext
+    return istext
+
+
+# Number of bytes read from the beginning of a file to classify it, and maximum
+# proportion of control characters in those of a text file.
+classify_size = 8192
+control_ratio = 0.1
+
+# Control characters that are not commonly found in text.  Backspace, tabs, line
+# and form feeds, carriage returns and escapes (for terminal sequences) are.
+control_bytes = bytes(sorted(set(range(0x20)) - set(b'\b\t\n\f\r\x1b'))) + b'\x7f'
+
+# Byte order marks of Unicode encodings whose text contains NUL bytes.
+wide_boms = (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE,
+             codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+def istextdata(data):
+    """
+    Guess if the given bytes from the beginning of a file are text.  Data with
+    NUL bytes is binary, unless it starts with the byte order mark of a UTF-16
+    or UTF-32 encoding.  Otherwise the data is text if at most a small
+    proportion of it are control characters.  Bytes above 127 are not
+    considered, as they are part of text in UTF-8 as well as in Latin-1 and the
+    other 8-bit encodings (e.g. 0x93 is a quote in cp1252).
+    """
+    if not data:
+        return True
+    if b'\0' in data:
+        return data.startswith(wide_boms)
+
+    nbcontrols = len(data) - len(data.translate(None, control_bytes))
+    return nbcontrols <= len(data) * control_ratio
+
+
 # Note: there has been a 'file' command for a long time under UNIX.  We favor
 # the short options to promote portability.  The --bried and --dereference
 # options were taken from Ian F. Darwin's file implementation.
@@ -55,10 +124,9 @@ text_re = re.compile('\\btext\\b')
 xml_re = re.compile('\\bXML\\b')
 empty_re = re.compile('^empty$')
 
-def istextfile(fn):
+def istextfile_file(fn):
     """
-    Attempts to guess if the file indicated by the given filename is a text file
-    or a binary file.
+    Guess if the given file is a text file by running the 'file' utility on it.
     """
 
     # Unfortunately 'file' does not return an appropriate return code when there
@@ -10,8 +10,10 @@ __author__ = "Martin Blais <blais@furius.ca>"
 
 
 # stdlib imports.
-import sys, os, tempfile
+import sys, os, tempfile, optparse, io, multiprocessing, pickle
 from os.path import *
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # xxdiff imports.
 import xxdiff.scripts
@@ -49,6 +51,47 @@ class Transformer(object):
         raise NotImplementedError
 
 
+def options_graft(parser):
+    """
+    Graft options on given parser for the transformation loop.
+    """
+    group = optparse.OptionGroup(parser, "Transformation loop options",
+                                 "These options affect how the selected "
+                                 "files are transformed.")
+
+    group.add_option('-P', '--prefetch', action='store', type='int',
+                     default=0, metavar='N',
+                     help="Transform up to N files ahead of the one being "
+                     "reviewed, with a pool of N worker threads.  Files whose "
+                     "transformation is unchanged are skipped without review. "
+                     "(default is 0, transform files one at a time).")
+
+    group.add_option('-J', '--apply-jobs', action='store', type='int',
+                     default=1, metavar='N',
+                     help="With --no-confirm, transform, backup and replace "
+                     "the files with N worker processes (use 0 for the number "
+                     "of CPUs).  Files are replaced atomically.")
+
+    parser.add_option_group(group)
+
+    return group
+
+
+def options_validate(opts, parser, logs=None):
+    """
+    Validate transformation loop options.
+    """
+    if opts.prefetch < 0:
+        parser.error("The number of files to prefetch must be positive.")
+
+    if opts.apply_jobs < 0:
+        parser.error("The number of apply jobs must be positive.")
+    if opts.apply_jobs == 0:
+        opts.apply_jobs = os.cpu_count() or 1
+    if opts.apply_jobs > 1 and not opts.no_confirm:
+        parser.error("Parallel apply jobs require --no-confirm.")
+
+
 def parse_args(parser):
     """
     Parse the options and return:
@@ -60,6 +103,7 @@ def parse_args(parser):
                  xxdiff.invoke, xxdiff.condrepl)
     for mod in xxmodules:
         mod.options_graft(parser)
+    options_graft(parser)
 
     xxdiff.scripts.install_autocomplete(parser)
 
@@ -69,6 +113,7 @@ def parse_args(parser):
     vargs = opts, parser, sys.stdout
     for mod in xxmodules[1:]:
         mod.options_validate(*vargs)
+    options_validate(*vargs)
     selector = xxdiff.selectfiles.options_validate(*vargs)
 
     return opts, args, selector
@@ -79,22 +124,43 @@ def transform_replace_loop(opts, selector, xformer, logs):
     Run a loop through the selected files and conditionally transform them by
     applying the given Transformer and invoking xxdiff to confirm.  Return a map
     of the filenames to the decision code that was used on each of them.
+
+    If 'opts.prefetch' is set, the files are transformed ahead of the review by
+    a pool of worker threads (see transform_ahead()); the files are still
+    reviewed, and the decisions recorded, in the order of the selector.
+
+    If 'opts.no_confirm' and 'opts.apply_jobs' are set, the files are processed
+    by worker processes instead (see apply_parallel()).
+
+    If a session pool is enabled, xxdiff is prelaunched for the next files while
+    the current one is being reviewed.
     """
+    apply_jobs = getattr(opts, 'apply_jobs', 1)
+    if apply_jobs > 1 and opts.no_confirm and fork_context is not None:
+        return apply_parallel(opts, selector, xformer, logs, apply_jobs)
+
     decision_map = {}
 
-    for fn in selector:
-        # Create temporary file to receive the transformed file.
-        tmpf = tempfile.NamedTemporaryFile(mode='w', prefix=tmpprefix)
+    prefetch = getattr(opts, 'prefetch', 0)
+    if prefetch:
+        xformed = transform_ahead(selector, xformer, prefetch)
+    else:
+        xformed = ((fn, transform_file(fn, xformer)) for fn in selector)
 
-        # Transform the file.
-        if xformer.transform(fn, tmpf) is False:
+    pool = getattr(opts, 'session_pool', None)
+    if pool is not None and not opts.no_confirm:
+        def launch(item):
+            fn, tmpf = item
+            if tmpf is not None:
+                xxdiff.condrepl.prelaunch_replace(fn, tmpf.name, opts)
+        xformed = xxdiff.invoke.prelaunch_ahead(xformed, pool.size, launch)
+
+    for fn, tmpf in xformed:
+        if tmpf is None:
             # This file is to be skipped by the transformer for some reason.
             decision_map[fn] = 'SKIPPED'
             continue
 
-        # Flush the temporary file before invoking xxdiff on it.
-        tmpf.flush()
-
         # Invoke conditional replacement via xxdiff.
         decision = xxdiff.condrepl.cond_replace(fn, tmpf.name, opts, logs)
         decision_map[fn] = decision
@@ -102,6 +168,155 @@ def transform_replace_loop(opts, selector, xformer, logs):
     return decision_map
 
 
+def transform_file(fn, xformer):
+    """
+    Transform the file 'fn' with the given Transformer to a new temporary file,
+    and return it, flushed and ready to be compared.  Return None if the file is
+    to be skipped.
+    """
+    # Create temporary file to receive the transformed file.
+    tmpf = tempfile.NamedTemporaryFile(mode='w', prefix=tmpprefix)
+
+    # Transform the file.
+    if xformer.transform(fn, tmpf) is False:
+        tmpf.close()
+        return None
+
+    # Flush the temporary file before invoking xxdiff on it.
+    tmpf.flush()
+
+    return tmpf
+
+
+def transform_ahead(selector, xformer, prefetch):
+    """
+    Generator that transforms the selected files with a pool of 'prefetch'
+    worker threads, keeping at most 'prefetch' transformed files ready ahead of
+    the consumer.  Yields (filename, temporary file) pairs in the order of the
+    selector, like transform_file().  The files whose contents are unchanged are
+    left to cond_replace(), which reports them like for the sequential loop.
+    """
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque()
+        try:
+            for fn in selector:
+                pending.append(
+                    (fn, executor.submit(transform_file, fn, xformer)))
+                if len(pending) > prefetch:
+                    fn, future = pending.popleft()
+                    yield fn, future.result()
+
+            while pending:
+                fn, future = pending.popleft()
+                yield fn, future.result()
+        finally:
+            # Do not bother transforming the rest if the caller bails out.
+            for fn, future in pending:
+                future.cancel()
+
+
+# Worker processes need to inherit the transformer rather than get a pickled
+# copy of it (it may hold unpicklable objects), so we require fork().
+try:
+    fork_context = multiprocessing.get_context('fork')
+except ValueError:
+    fork_context = None
+
+# The (options, transformer) pair used by the worker processes.
+_apply_state = None
+
+def _apply_init(opts, xformer):
+    """
+    Initialize a worker process of apply_parallel().
+    """
+    global _apply_state
+    _apply_state = opts, xformer
+
+def _apply_file(fn):
+    """
+    Transform and replace a single file in a worker process of
+    apply_parallel().  Return the filename, the decision code, the output that
+    would have been logged, and the exception that interrupted the processing
+    of the file, if any (including SystemExit, which must not kill the worker
+    without a result).
+    """
+    opts, xformer = _apply_state
+    logs = io.StringIO()
+    try:
+        tmpf = transform_file(fn, xformer)
+        if tmpf is None:
+            return fn, 'SKIPPED', '', None
+        try:
+            decision = xxdiff.condrepl.cond_replace(fn, tmpf.name, opts, logs)
+        finally:
+            tmpf.close()
+    except BaseException as e:
+        # The exception is sent back to the parent, make sure it can be.
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('%s: %s' % (type(e).__name__, e))
+        return fn, None, logs.getvalue(), e
+    return fn, decision, logs.getvalue(), None
+
+# Number of files submitted to the worker processes ahead of the one whose
+# result is awaited, per worker.
+apply_window = 4
+
+def apply_parallel(opts, selector, xformer, logs, jobs):
+    """
+    Transform the selected files and replace them without confirmation, with a
+    pool of 'jobs' worker processes.  The originals are backed up and replaced
+    atomically.  The output of each file is printed, and the decision map is
+    filled, in the order of the selector, followed by a summary of the
+    decisions.  Return the decision map.
+
+    The selector is consumed in this thread (not in the pool's task thread,
+    where its errors would be lost), a bounded number of files ahead.  An error
+    in a worker is raised again here, after the output of the previous files.
+    Files that are aliases of a file already selected (through symbolic links)
+    are skipped, so that no two workers rewrite the same file.
+    """
+    # Make sure that all the workers back up to the same directory.
+    if hasattr(opts, 'backup_type'):
+        xxdiff.backup.prepare_backup_dir(opts)
+    opts.atomic_replace = True
+
+    decision_map = {}
+    def collect(result):
+        fn, decision, output, error = result.get()
+        logs.write(output)
+        if error is not None:
+            raise error
+        decision_map[fn] = decision
+
+    with fork_context.Pool(jobs, _apply_init, (opts, xformer)) as pool:
+        pending = deque()
+        seen = set()
+        for fn in selector:
+            realfn = realpath(fn)
+            if realfn in seen:
+                decision_map[fn] = 'SKIPPED'
+                continue
+            seen.add(realfn)
+            pending.append(pool.apply_async(_apply_file, (fn,)))
+            if len(pending) >= jobs * apply_window:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    if opts.verbose >= 1:
+        counts = {}
+        for decision in decision_map.values():
+            counts[decision] = counts.get(decision, 0) + 1
+        print(file=logs)
+        print('Summary: %s' % ', '.join('%s %d' % (decision, counts[decision])
+                                       for decision in sorted(counts)),
+              file=logs)
+
+    return decision_map
+
+
 def postloop_footer(opts, decision_map=None):
     """
     Print some common stuff at the end of the looping scripts.